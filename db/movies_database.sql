@@ -14213,6 +14213,13 @@ ALTER TABLE ONLY public.django_session
 CREATE UNIQUE INDEX film_work_genre_idx ON content.genre_film_work USING btree (film_work_id, genre_id);
 
 
+--
+-- Name: film_work_modified_idx; Type: INDEX; Schema: content; Owner: app
+--
+
+CREATE INDEX film_work_modified_idx ON content.film_work USING btree (modified);
+
+
 --
 -- Name: film_work_person_idx; Type: INDEX; Schema: content; Owner: app
 --
@@ -14234,6 +14241,48 @@ CREATE UNIQUE INDEX film_work_title_date ON content.film_work USING btree (title
 CREATE UNIQUE INDEX film_work_type_rating_date ON content.film_work USING btree (type, rating, creation_date);
 
 
+--
+-- Name: genre_film_work_genre_idx; Type: INDEX; Schema: content; Owner: app
+--
+
+CREATE INDEX genre_film_work_genre_idx ON content.genre_film_work USING btree (genre_id);
+
+
+--
+-- Name: genre_film_work_modified_idx; Type: INDEX; Schema: content; Owner: app
+--
+
+CREATE INDEX genre_film_work_modified_idx ON content.genre_film_work USING btree (modified);
+
+
+--
+-- Name: genre_modified_idx; Type: INDEX; Schema: content; Owner: app
+--
+
+CREATE INDEX genre_modified_idx ON content.genre USING btree (modified);
+
+
+--
+-- Name: person_film_work_modified_idx; Type: INDEX; Schema: content; Owner: app
+--
+
+CREATE INDEX person_film_work_modified_idx ON content.person_film_work USING btree (modified);
+
+
+--
+-- Name: person_film_work_person_idx; Type: INDEX; Schema: content; Owner: app
+--
+
+CREATE INDEX person_film_work_person_idx ON content.person_film_work USING btree (person_id);
+
+
+--
+-- Name: person_modified_idx; Type: INDEX; Schema: content; Owner: app
+--
+
+CREATE INDEX person_modified_idx ON content.person USING btree (modified);
+
+
 --
 -- Name: auth_group_name_a6ea08ec_like; Type: INDEX; Schema: public; Owner: app
 --
@@ -12,6 +12,7 @@ class Settings(BaseSettings):
     elastic_port: str = Field(default=9200, env="ELASTIC_PORT")
     base_dir: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     cache_expire_in_seconds: int = Field(default=60, env="CACHE_EXPIRE_SEC")
+    elastic_mapping_cache_sec: int = Field(default=60, env="ELASTIC_MAPPING_CACHE_SEC")
     debug_log_level: bool = Field(default=False, env="DEBUG")
     log_format: str = Field(
         default="%(asctime)s - %(name)s - %(levelname)s - %(message)s", env="LOG_FORMAT"
@@ -32,6 +32,10 @@ class DataProvider(metaclass=ABCMeta):
     async def search(self, obj_name, body, from_, size, sort):
         pass
 
+    @abc.abstractmethod
+    async def get_mapping(self, obj_name: str) -> dict:
+        pass
+
 
 class DbAdapter(metaclass=ABCMeta):
     @abc.abstractmethod
@@ -16,6 +16,11 @@ class ElasticDataProvider(DataProvider):
     async def search(self, obj_name, body, from_, size, sort):
         return await self.es.search(index=obj_name, body=body, from_=from_, size=size, sort=sort)
 
+    async def get_mapping(self, obj_name: str) -> dict:
+        response = await self.es.indices.get_mapping(index=obj_name)
+        # Псевдоним указывает на одну версию индекса
+        return next(iter(response.values()))["mappings"]
+
 
 async def get_elastic_data_provider() -> ElasticDataProvider:
     return ElasticDataProvider(es=es)
@@ -1,8 +1,9 @@
 import logging
 import re
-from copy import deepcopy
+from time import monotonic
 from typing import Any, Type
 
+from core.config import settings
 from db.base_db import DataProvider, DbAdapter, ObjectName, SortingOrder
 from elasticsearch import NotFoundError
 from models.film import FilmDetail
@@ -14,6 +15,38 @@ from pydantic.main import ModelMetaclass
 logger = logging.getLogger(__name__)
 
 
+class IndexLayout:
+    """
+    Поля индекса, от которых зависят фильтры: пути nested объектов и
+    нормализованные подполя keyword, по которым фильтр terms читает doc values.
+    """
+
+    def __init__(self):
+        self.nested: set[str] = set()
+        self.keyword_fields: dict[str, str] = {}
+
+    @classmethod
+    def from_mapping(cls, mapping: dict) -> "IndexLayout":
+        layout = cls()
+        layout._collect(mapping.get("properties", {}), "")
+        return layout
+
+    def _collect(self, properties: dict, prefix: str) -> None:
+        for name, field_mapping in properties.items():
+            path = f"{prefix}{name}"
+            if field_mapping.get("type") == "nested":
+                self.nested.add(path)
+            for subfield, subfield_mapping in field_mapping.get("fields", {}).items():
+                if subfield_mapping.get("type") == "keyword" and "normalizer" in subfield_mapping:
+                    self.keyword_fields[path] = f"{path}.{subfield}"
+            self._collect(field_mapping.get("properties", {}), f"{path}.")
+
+
+# Схемы индексов по именам: после переиндексации псевдоним может указывать на
+# индекс с другой схемой, поэтому схема перечитывается раз в elastic_mapping_cache_sec
+_layouts: dict[str, tuple[float, IndexLayout | None]] = {}
+
+
 class ElasticAdapter(DbAdapter):
     def __init__(self, data_provider: DataProvider, allowed_sort_fields: dict):
         self.data_provider = data_provider
@@ -57,7 +90,11 @@ class ElasticAdapter(DbAdapter):
 
         filters = {k: v for k, v in filters.items() if v is not None}
 
-        body = self._add_query_filters(body, filters, model)
+        layout = await self._get_layout(obj_name) if filters else None
+        body = self._add_query_filters(body, filters, model, layout)
+        # Сервису не нужно общее число совпадений: без его подсчета запрос с
+        # сортировкой индекса заканчивается на первых документах сегмента
+        body["track_total_hits"] = False
         logger.info(f"Elastic query: {body}")
 
         try:
@@ -91,12 +128,25 @@ class ElasticAdapter(DbAdapter):
         logger.info(f"Elastic sorting: {','.join(prepared_sort_fields)}")
         return ",".join(prepared_sort_fields)
 
-    def _add_query_filters(self, query: dict, filters: dict, model: Type[BaseModel]) -> dict:
+    async def _get_layout(self, obj_name: ObjectName) -> IndexLayout | None:
+        cached_at, layout = _layouts.get(obj_name.value, (None, None))
+        if cached_at is not None and monotonic() - cached_at < settings.elastic_mapping_cache_sec:
+            return layout
+        try:
+            layout = IndexLayout.from_mapping(await self.data_provider.get_mapping(obj_name.value))
+        except NotFoundError:
+            layout = None
+        _layouts[obj_name.value] = monotonic(), layout
+        return layout
+
+    def _add_query_filters(
+        self, query: dict, filters: dict, model: Type[BaseModel], layout: IndexLayout | None
+    ) -> dict:
         query_filters = list()
 
         for filter_field, values in filters.items():
             if path := self._generate_filter_path(filter_field, model):
-                query_filter = self._generate_filter(path, values)
+                query_filter = self._generate_filter(path, values, layout)
                 query_filters.append(query_filter)
 
         if query_filters:
@@ -105,17 +155,28 @@ class ElasticAdapter(DbAdapter):
         return query
 
     @staticmethod
-    def _generate_filter(path: list, values: Any):
-        inner_insert = {"nested": {"path": str(), "query": {}}}
-        curr: dict = dict()
-
-        for i in range(1, len(path)):
-            curr.update(deepcopy(inner_insert))
-            curr["nested"]["path"] = ".".join(path[:i])
-            curr = curr["nested"]["query"]
-        curr.update({"terms": {".".join(path): values}})
+    def _generate_filter(path: list, values: Any, layout: IndexLayout | None = None):
+        """
+        Фильтр terms по полю path. Без известной схемы каждый уровень пути
+        считается nested, как в схеме индексов по умолчанию.
+
+        Если у поля есть нормализованное подполе keyword (схема ES_INDEX_MAPPING=search),
+        фильтр идет по нему и совпадает со значением целиком без учета регистра:
+        genres_name=science fiction находит жанр "Science Fiction", а отдельное слово
+        fiction - уже нет. По анализируемому полю схемы по умолчанию terms сравнивает
+        значение с отдельными токенами после анализатора.
+        """
+        field_path = ".".join(path)
+        if layout:
+            field_path = layout.keyword_fields.get(field_path, field_path)
+        query: dict = {"terms": {field_path: values}}
+
+        for i in range(len(path) - 1, 0, -1):
+            nested_path = ".".join(path[:i])
+            if layout is None or nested_path in layout.nested:
+                query = {"nested": {"path": nested_path, "query": query}}
 
-        return curr
+        return query
 
     @staticmethod
     def _generate_filter_path(filter_path: list, root_model: Type[BaseModel]):
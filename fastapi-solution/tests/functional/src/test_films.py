@@ -4,6 +4,7 @@ import uuid
 from http import HTTPStatus
 
 import pytest
+from testdata.schemes.es_schema import INDEXES, search_optimized
 
 
 async def test_film_by_id_not_found(make_get_request):
@@ -306,3 +307,43 @@ async def test_films_list_length(
     status, response = await make_get_request("films/")
     assert status == HTTPStatus.OK
     assert len(response) == expected_answer
+
+
+@pytest.mark.parametrize(
+    "genres_name, expected_answer",
+    [
+        (["science fiction"], {"1"}),
+        (["SCIENCE FICTION"], {"1"}),
+        (["fiction"], {"2"}),
+        (["fiction", "Science Fiction"], {"1", "2"}),
+    ],
+)
+async def test_films_filter_by_genre_name_in_search_mapping(
+    es_client,
+    es_write_data,
+    make_get_request,
+    genres_name: list[str],
+    expected_answer: set[str],
+):
+    # В схеме ES_INDEX_MAPPING=search имя жанра сравнивается целиком без учета регистра
+    await es_client.indices.delete(index="movies")
+    await es_client.indices.create(index="movies", body=search_optimized(INDEXES["movies"]))
+    await es_write_data(
+        "movies",
+        (
+            {
+                "id": id,
+                "title": genre,
+                "imdb_rating": 5,
+                "actors": [],
+                "writers": [],
+                "directors": [],
+                "genres": [{"id": str(uuid.uuid4()), "name": genre}],
+            }
+            for id, genre in (("1", "Science Fiction"), ("2", "Fiction"))
+        ),
+    )
+
+    status, response = await make_get_request("films/", params={"genres_name": genres_name})
+    assert status == HTTPStatus.OK
+    assert {film["id"] for film in response} == expected_answer
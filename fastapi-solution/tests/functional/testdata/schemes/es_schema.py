@@ -1,3 +1,5 @@
+from copy import deepcopy
+
 COMMON_INDEX_SETTINGS = {
     "refresh_interval": "1s",
     "analysis": {
@@ -117,3 +119,23 @@ INDEXES = {
         },
     },
 }
+
+
+def search_optimized(index: dict) -> dict:
+    """Вариант схемы ES_INDEX_MAPPING=search, как его строит postgres_to_es/es_schema.py."""
+    index = deepcopy(index)
+    index["settings"]["index"] = {"sort.field": "id", "sort.order": "desc"}
+    index["settings"]["analysis"]["normalizer"] = {
+        "lowercase": {"type": "custom", "filter": ["lowercase"]}
+    }
+    _optimize_properties(index["mappings"]["properties"])
+    return index
+
+
+def _optimize_properties(properties: dict) -> None:
+    for name, field in properties.items():
+        if field.get("type") == "nested":
+            field["type"] = "object"
+            _optimize_properties(field["properties"])
+        elif field.get("type") == "text" and (name == "name" or "raw" in field.get("fields", {})):
+            field["fields"] = {"raw": {"type": "keyword", "normalizer": "lowercase"}}
@@ -0,0 +1,331 @@
+"""
+Повторная загрузка части сущности по диапазону идентификаторов и (или) modified.
+
+Нужна после восстановления индекса или добавления поля в документ, когда ждать
+прохода инкрементального ETL с нулевого watermark слишком долго. Строки
+диапазона делятся на части по ETL_BACKFILL_CHUNK_SIZE идентификаторов, части
+загружаются в ETL_BACKFILL_WORKERS потоков. Каждые ETL_BACKFILL_PROGRESS_SEC
+выводятся число загруженных строк, скорость и оставшееся время.
+
+План частей и номера загруженных частей хранятся в Redis. Запуск с теми же
+аргументами после остановки (Ctrl+C) или сбоя продолжает с незагруженных частей,
+--restart строит план заново. Диапазон modified относится к строкам самой
+сущности. Документы пишутся без сравнения с сохраненными хешами и без внешних
+версий: цель - переписать их по текущим данным, даже если в индексе они новее.
+
+Запуск:
+    python backfill.py filmwork [--id-from UUID] [--id-to UUID]
+        [--modified-from DATE] [--modified-to DATE] [--workers N] [--restart]
+"""
+import argparse
+import json
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta
+from queue import Empty, Queue
+from threading import Event, Lock, Thread
+from time import monotonic
+from typing import Optional
+
+import redis
+from connections import postgres_pool
+from data_transform import DataTransform, get_transformer
+from dead_letters import get_dead_letters
+from decorators import backoff
+from elasticsearch_loader import BulkLoadError, ElasticsearchLoader
+from etl import ETLHandler
+from loguru import logger
+from postgres_extractor import PostgresExtractor
+from settings import (
+    ETL_BACKFILL_CHUNK_SIZE,
+    ETL_BACKFILL_PROGRESS_SEC,
+    ETL_BACKFILL_WORKERS,
+    ETL_BATCH_SIZE,
+    REDIS_ADAPTER,
+)
+
+TABLES = {
+    "filmwork": "content.film_work",
+    "person": "content.person",
+    "genre": "content.genre",
+}
+
+_RANGE_CONDITION = """
+            (%(id_from)s::uuid IS NULL OR t.id >= %(id_from)s::uuid)
+            AND (%(id_to)s::uuid IS NULL OR t.id <= %(id_to)s::uuid)
+            AND (%(modified_from)s::timestamptz IS NULL OR t.modified >= %(modified_from)s)
+            AND (%(modified_to)s::timestamptz IS NULL OR t.modified < %(modified_to)s)
+"""
+# Границы частей по порядку идентификаторов: в каждой части chunk_size строк
+CHUNKS_QUERY = f"""
+        SELECT MIN(numbered.id) as first_id, MAX(numbered.id) as last_id, COUNT(*) as rows
+        FROM (
+            SELECT
+                t.id::text as id,
+                (ROW_NUMBER() OVER (ORDER BY t.id) - 1) / %(chunk_size)s as chunk
+            FROM {{table}} t
+            WHERE {_RANGE_CONDITION}
+        ) numbered
+        GROUP BY numbered.chunk
+        ORDER BY numbered.chunk
+"""
+CHUNK_IDS_QUERY = f"""
+        SELECT t.id
+        FROM {{table}} t
+        WHERE t.id BETWEEN %(first_id)s::uuid AND %(last_id)s::uuid
+            AND {_RANGE_CONDITION}
+        ORDER BY t.id
+"""
+
+
+@dataclass
+class Chunk:
+    number: int
+    first_id: str
+    last_id: str
+    rows: int
+
+
+class BackfillCheckpoints:
+    """План частей задания в ключе backfill:<задание> и номера загруженных частей в :done."""
+
+    def __init__(self, redis_adapter: redis.Redis, job: str):
+        self.redis_adapter = redis_adapter
+        self.key = f"backfill:{job}"
+
+    @backoff()
+    def load_plan(self) -> Optional[list[Chunk]]:
+        plan = self.redis_adapter.get(self.key)
+        return [Chunk(**chunk) for chunk in json.loads(plan)] if plan else None
+
+    @backoff()
+    def save_plan(self, chunks: list[Chunk]) -> None:
+        self.redis_adapter.delete(f"{self.key}:done")
+        self.redis_adapter.set(self.key, json.dumps([asdict(chunk) for chunk in chunks]))
+
+    @backoff()
+    def done(self) -> set[int]:
+        return {int(number) for number in self.redis_adapter.smembers(f"{self.key}:done")}
+
+    @backoff()
+    def mark_done(self, number: int) -> None:
+        self.redis_adapter.sadd(f"{self.key}:done", number)
+
+    @backoff()
+    def clear(self) -> None:
+        self.redis_adapter.delete(self.key, f"{self.key}:done")
+
+
+class Progress:
+    """Ход загрузки. Скорость считается по строкам этого запуска, без загруженных раньше."""
+
+    def __init__(self, obj_type: str, chunks: list[Chunk], done: set[int]):
+        self.obj_type = obj_type
+        self.total_rows = sum(chunk.rows for chunk in chunks)
+        self.total_chunks = len(chunks)
+        self.done_rows = sum(chunk.rows for chunk in chunks if chunk.number in done)
+        self.done_chunks = len(done)
+        self.rows = 0
+        self.started = monotonic()
+        self._lock = Lock()
+
+    def add_rows(self, rows: int) -> None:
+        with self._lock:
+            self.rows += rows
+
+    def add_chunk(self) -> None:
+        with self._lock:
+            self.done_chunks += 1
+
+    def __str__(self) -> str:
+        with self._lock:
+            rows, done_chunks = self.rows, self.done_chunks
+        loaded = self.done_rows + rows
+        rate = rows / max(monotonic() - self.started, 1e-9)
+        share = loaded / self.total_rows * 100 if self.total_rows else 100
+        eta = (
+            str(timedelta(seconds=int((self.total_rows - loaded) / rate)))
+            if rate and loaded < self.total_rows
+            else "-"
+        )
+        return (
+            f"{self.obj_type}: {loaded} из {self.total_rows} строк ({share:.1f}%), "
+            f"частей {done_chunks} из {self.total_chunks}, {rate:.0f} строк/с, осталось {eta}"
+        )
+
+
+class Backfill:
+    def __init__(
+        self,
+        obj_type: str,
+        ranges: dict,
+        checkpoints: BackfillCheckpoints,
+        transformer: DataTransform,
+        workers: int = ETL_BACKFILL_WORKERS,
+        chunk_size: int = ETL_BACKFILL_CHUNK_SIZE,
+    ):
+        self.obj_type = obj_type
+        self.etl = ETLHandler.get_etl(obj_type)
+        self.table = TABLES[obj_type]
+        self.ranges = ranges
+        self.checkpoints = checkpoints
+        self.transformer = transformer
+        self.dead_letters = get_dead_letters()
+        self.workers = workers
+        self.chunk_size = chunk_size
+
+        self.chunks: Queue = Queue()
+        self.stop = Event()
+        self.errors: list[Exception] = []
+        self.progress: Optional[Progress] = None
+
+    def plan(self, extractor: PostgresExtractor, restart: bool = False) -> list[Chunk]:
+        if not restart and (chunks := self.checkpoints.load_plan()) is not None:
+            return chunks
+        with extractor.connection.cursor() as cursor:
+            cursor.execute(
+                CHUNKS_QUERY.format(table=self.table),
+                {**self.ranges, "chunk_size": self.chunk_size},
+            )
+            chunks = [Chunk(number, **row) for number, row in enumerate(cursor.fetchall())]
+        self.checkpoints.save_plan(chunks)
+        return chunks
+
+    def run(self, restart: bool = False, progress_sec: float = ETL_BACKFILL_PROGRESS_SEC) -> int:
+        """Загружает незагруженные части и возвращает число строк, загруженных этим запуском."""
+        extractor = PostgresExtractor()
+        try:
+            extractor.create_connection()
+            chunks = self.plan(extractor, restart)
+        finally:
+            extractor.close()
+        done = self.checkpoints.done()
+        self.progress = Progress(self.obj_type, chunks, done)
+        for chunk in chunks:
+            if chunk.number not in done:
+                self.chunks.put(chunk)
+        logger.info(f"Повторная загрузка {self.progress}")
+        if self.workers > postgres_pool.size:
+            logger.warning(
+                f"Потоков {self.workers}, а соединений в пуле {postgres_pool.size}: "
+                "лишние потоки будут ждать соединения"
+            )
+
+        threads = [
+            Thread(target=self._work, name=f"{self.obj_type}-backfill-{number}")
+            for number in range(self.workers)
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            while any(thread.is_alive() for thread in threads):
+                deadline = monotonic() + progress_sec
+                for thread in threads:
+                    thread.join(max(deadline - monotonic(), 0))
+                logger.info(str(self.progress))
+        except KeyboardInterrupt:
+            logger.warning("Остановка после загрузки частей, которые уже в работе")
+            self.stop.set()
+            for thread in threads:
+                thread.join()
+
+        if self.errors:
+            raise self.errors[0]
+        if self.stop.is_set():
+            logger.info(f"Загрузка остановлена: {self.progress}. Продолжение - тот же запуск")
+        else:
+            self.checkpoints.clear()
+            logger.info(f"Повторная загрузка завершена: {self.progress}")
+        return self.progress.rows
+
+    def _work(self) -> None:
+        extractor = PostgresExtractor()
+        loader = ElasticsearchLoader()
+        try:
+            extractor.create_connection()
+            loader.create_connection()
+            while not self.stop.is_set():
+                try:
+                    chunk = self.chunks.get_nowait()
+                except Empty:
+                    return
+                self._load_chunk(chunk, extractor, loader)
+                self.checkpoints.mark_done(chunk.number)
+                self.progress.add_chunk()
+        except Exception as e:
+            logger.error(f"Ошибка повторной загрузки {self.obj_type}: {e}")
+            self.errors.append(e)
+            self.stop.set()
+        finally:
+            extractor.close()
+
+    def _load_chunk(
+        self, chunk: Chunk, extractor: PostgresExtractor, loader: ElasticsearchLoader
+    ) -> None:
+        with extractor.connection.cursor() as cursor:
+            cursor.execute(
+                CHUNK_IDS_QUERY.format(table=self.table),
+                {**self.ranges, "first_id": chunk.first_id, "last_id": chunk.last_id},
+            )
+            ids = [row["id"] for row in cursor.fetchall()]
+        for start in range(0, len(ids), ETL_BATCH_SIZE):
+            rows = extractor.extract_by_ids(self.etl.by_ids_query, ids[start:][:ETL_BATCH_SIZE])
+            # Открытая транзакция удерживала бы SAFE_CUTOFF_QUERY инкрементального ETL
+            extractor.connection.rollback()
+            documents = self.dead_letters.transform(
+                self.transformer, self.obj_type, self.etl.transform_model, rows
+            )
+            result = self.dead_letters.divert(
+                self.obj_type,
+                rows,
+                loader.load_data(
+                    self.etl.elastic_index_name, self.etl.elastic_index_params, documents
+                ),
+            )
+            if result.errors:
+                raise BulkLoadError(
+                    f"{len(result.errors)} документов части {chunk.number} не загружено, "
+                    "часть будет загружена заново при продолжении"
+                )
+            self.progress.add_rows(len(rows))
+
+
+def job_name(obj_type: str, ranges: dict) -> str:
+    return ":".join([obj_type, *(str(ranges[key] or "") for key in sorted(ranges))])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Повторная загрузка части сущности")
+    parser.add_argument("obj_type", choices=list(ETLHandler.PARAMS))
+    parser.add_argument("--id-from", help="первый идентификатор диапазона")
+    parser.add_argument("--id-to", help="последний идентификатор диапазона")
+    parser.add_argument(
+        "--modified-from", type=datetime.fromisoformat, help="modified не раньше, ISO 8601"
+    )
+    parser.add_argument(
+        "--modified-to", type=datetime.fromisoformat, help="modified раньше, ISO 8601"
+    )
+    parser.add_argument("--workers", type=int, default=ETL_BACKFILL_WORKERS)
+    parser.add_argument("--chunk-size", type=int, default=ETL_BACKFILL_CHUNK_SIZE)
+    parser.add_argument(
+        "--restart", action="store_true", help="построить план заново, а не продолжать"
+    )
+    args = parser.parse_args()
+
+    ranges = {
+        "id_from": args.id_from,
+        "id_to": args.id_to,
+        "modified_from": args.modified_from,
+        "modified_to": args.modified_to,
+    }
+    transformer = get_transformer()
+    try:
+        Backfill(
+            args.obj_type,
+            ranges,
+            BackfillCheckpoints(REDIS_ADAPTER, job_name(args.obj_type, ranges)),
+            transformer,
+            args.workers,
+            args.chunk_size,
+        ).run(args.restart)
+    finally:
+        transformer.close()
@@ -0,0 +1,109 @@
+from threading import Lock
+
+import metrics
+from elasticsearch_loader import BulkResult
+from loguru import logger
+from settings import (
+    ETL_BATCH_ADAPTIVE,
+    ETL_BATCH_MAX_SIZE,
+    ETL_BATCH_MIN_SIZE,
+    ETL_BATCH_SIZE,
+    ETL_BATCH_TARGET_BYTES,
+    ETL_BATCH_TARGET_LATENCY_SEC,
+)
+
+# Вес последнего пакета в скользящей оценке размера документа
+_SMOOTHING = 0.3
+
+
+class BatchSizer:
+    """
+    Размер пакета сущности. Извлечение читает size перед каждым пакетом, загрузка
+    сообщает о результате через observe. Без ETL_BATCH_ADAPTIVE размер постоянный.
+    """
+
+    def __init__(self, entity: str, size: int = ETL_BATCH_SIZE):
+        self.entity = entity
+        self.size = size
+        metrics.BATCH_SIZE.labels(entity).set(size)
+
+    def observe(self, result: BulkResult, seconds: float) -> None:
+        pass
+
+
+class AdaptiveBatchSizer(BatchSizer):
+    """
+    Подбирает размер пакета так, чтобы bulk-запрос весил около target_bytes и
+    выполнялся не дольше target_latency_sec. Отказ 429 или превышение задержки
+    сразу уменьшают пакет, рост к целевому размеру идет постепенно, не больше
+    чем вдвое за пакет:
+        по объему = target_bytes / средний размер документа
+        по времени = size * target_latency_sec / время загрузки пакета
+        429 - size / 2
+    """
+
+    def __init__(
+        self,
+        entity: str,
+        size: int = ETL_BATCH_SIZE,
+        min_size: int = ETL_BATCH_MIN_SIZE,
+        max_size: int = ETL_BATCH_MAX_SIZE,
+        target_bytes: int = ETL_BATCH_TARGET_BYTES,
+        target_latency_sec: float = ETL_BATCH_TARGET_LATENCY_SEC,
+    ):
+        super().__init__(entity, size)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_bytes = target_bytes
+        self.target_latency_sec = target_latency_sec
+        self.document_bytes = 0.0
+        self._lock = Lock()
+
+    def observe(self, result: BulkResult, seconds: float) -> None:
+        sent = result.indexed + len(result.errors)
+        with self._lock:
+            if result.throttled:
+                metrics.THROTTLED.labels(self.entity).inc(result.throttled)
+                return self._resize(self.size // 2, f"отказы 429: {result.throttled}")
+            # Все документы пропущены без изменений: о задержке и объеме судить не по чему
+            if not sent:
+                return
+
+            document_bytes = result.payload_bytes / sent
+            self.document_bytes = (
+                document_bytes
+                if not self.document_bytes
+                else _SMOOTHING * document_bytes + (1 - _SMOOTHING) * self.document_bytes
+            )
+            target = self.target_bytes / self.document_bytes
+            if seconds > 0:
+                target = min(target, sent * self.target_latency_sec / seconds)
+
+            if target < self.size:
+                reason = f"{seconds:.2f} с, {result.payload_bytes} байт на {sent} документов"
+                self._resize(int(target), reason)
+            # Пакет, оборвавшийся на конце выборки, ничего не говорит о пределе размера
+            elif sent + result.skipped >= self.size:
+                self._resize(int(min(target, self.size * 2)), "запас по объему и времени")
+
+    def _resize(self, size: int, reason: str) -> None:
+        size = max(self.min_size, min(size, self.max_size))
+        if size == self.size:
+            return
+        logger.info(f"Размер пакета {self.entity}: {self.size} -> {size} ({reason})")
+        self.size = size
+        metrics.BATCH_SIZE.labels(self.entity).set(size)
+
+
+_sizers: dict[str, BatchSizer] = {}
+_sizers_lock = Lock()
+
+
+def get_batch_sizer(entity: str) -> BatchSizer:
+    """Размер пакета сущности, подобранный в прошлых запусках, сохраняется до перезапуска ETL."""
+    with _sizers_lock:
+        if entity not in _sizers:
+            _sizers[entity] = (
+                AdaptiveBatchSizer(entity) if ETL_BATCH_ADAPTIVE else BatchSizer(entity)
+            )
+        return _sizers[entity]
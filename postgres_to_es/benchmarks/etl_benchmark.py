@@ -0,0 +1,132 @@
+"""
+Замер полного прогона ETL по каждой сущности из ETLHandler.PARAMS: Postgres из
+настроек (DB_*), загрузка в имитацию elasticsearch в этом же процессе или по
+--es-url. Состояние хранится во временном файле, поэтому каждый прогон
+начинается с нуля и не трогает watermark в Redis.
+
+Режимы ETL задаются теми же переменными окружения, что и в работе:
+    cd postgres_to_es && DB_NAME=movies_benchmark ETL_TRANSFORM_MODE=fast \\
+        python benchmarks/etl_benchmark.py --mode staged
+"""
+import argparse
+import os
+import resource
+import sys
+import tempfile
+import tracemalloc
+from time import perf_counter
+from typing import Any, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_elasticsearch import FakeElasticsearch  # noqa: E402
+
+STAGES = ("extract", "transform", "load")
+
+
+def configure(es_url: Optional[str], latency_ms: float) -> Optional[FakeElasticsearch]:
+    """Настраивает окружение до импорта settings: адрес ES, без хешей и экспорта метрик."""
+    fake = None
+    if not es_url:
+        fake = FakeElasticsearch(latency_ms=latency_ms).start()
+        es_url = fake.url
+    host, port = es_url.removeprefix("http://").rsplit(":", 1)
+    os.environ["ELASTIC_HOST"], os.environ["ELASTIC_PORT"] = host, port
+    os.environ["ETL_FINGERPRINTS"] = "off"
+    os.environ["ETL_METRICS_MODE"] = "off"
+    return fake
+
+
+def run(obj_type: str, mode: str, transformer: Any, trace_memory: bool) -> dict:
+    import metrics
+    from elasticsearch_loader import ElasticsearchLoader
+    from etl import run_etl, run_staged_etl
+    from postgres_extractor import PostgresExtractor
+    from state import JsonFileStorage, State
+
+    with tempfile.NamedTemporaryFile(suffix=".json") as state_file:
+        state_file.write(b"{}")
+        state_file.flush()
+        state = State(JsonFileStorage(state_file.name))
+
+        if trace_memory:
+            tracemalloc.start()
+        started = perf_counter()
+        if mode == "staged":
+            documents = run_staged_etl(obj_type, state, transformer)
+        else:
+            extractor, loader = PostgresExtractor(), ElasticsearchLoader()
+            try:
+                extractor.create_connection()
+                loader.create_connection()
+                documents = run_etl(obj_type, state, extractor, transformer, loader)
+            finally:
+                extractor.close()
+        elapsed = perf_counter() - started
+        traced_peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        tracemalloc.stop()
+
+    def sample(name: str, **labels) -> float:
+        return metrics.REGISTRY.get_sample_value(name, {"entity": obj_type, **labels}) or 0
+
+    return {
+        "entity": obj_type,
+        "rows": int(sample("etl_rows_total")),
+        "documents": documents,
+        "seconds": elapsed,
+        "stages": {stage: sample("etl_stage_seconds_sum", stage=stage) for stage in STAGES},
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "traced_peak_mb": traced_peak / 2**20 if traced_peak is not None else None,
+    }
+
+
+def report(result: dict) -> None:
+    stages = ", ".join(f"{stage} {sec:.2f} с" for stage, sec in result["stages"].items())
+    memory = f"пик RSS {result['peak_rss_mb']:.0f} МБ"
+    if result["traced_peak_mb"] is not None:
+        memory += f", пик tracemalloc {result['traced_peak_mb']:.1f} МБ"
+    print(
+        f"{result['entity']}: {result['rows']} строк, {result['documents']} документов "
+        f"за {result['seconds']:.2f} с, {result['rows'] / result['seconds']:.0f} строк/с\n"
+        f"    {stages}\n"
+        f"    {memory}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("entities", nargs="*", help="по умолчанию все сущности")
+    parser.add_argument("--mode", choices=("serial", "staged"), default="serial")
+    parser.add_argument("--es-url", help="внешний elasticsearch или его имитация")
+    parser.add_argument("--latency-ms", type=float, default=0, help="задержка имитации на bulk")
+    parser.add_argument(
+        "--tracemalloc", action="store_true", help="пик памяти Python, замедляет прогон"
+    )
+    args = parser.parse_args()
+
+    fake = configure(args.es_url, args.latency_ms)
+
+    import settings  # noqa: E402
+    from data_transform import get_transformer  # noqa: E402
+    from etl import ETLHandler  # noqa: E402
+
+    print(
+        f"ETL_BATCH_SIZE={settings.ETL_BATCH_SIZE} "
+        f"ETL_TRANSFORM_MODE={settings.ETL_TRANSFORM_MODE} "
+        f"ETL_TRANSFORM_WORKERS={settings.ETL_TRANSFORM_WORKERS} "
+        f"ES_BULK_MODE={settings.ES_BULK_MODE} "
+        f"ETL_TWO_PHASE_EXTRACT={settings.ETL_TWO_PHASE_EXTRACT} "
+        f"режим {args.mode}"
+    )
+    transformer = get_transformer()
+    try:
+        for obj_type in args.entities or ETLHandler.PARAMS:
+            report(run(obj_type, args.mode, transformer, args.tracemalloc))
+    finally:
+        transformer.close()
+    if fake:
+        print(
+            f"bulk: {fake.stats.requests} запросов, {fake.stats.documents} документов, "
+            f"{fake.stats.bytes / 2**20:.1f} МБ"
+        )
+        fake.stop()
@@ -0,0 +1,174 @@
+"""
+Имитация elasticsearch для замеров: принимает bulk-запросы и запросы управления
+индексами, которые делает загрузчик, но ничего не индексирует и не хранит.
+Время загрузки в замерах складывается из работы ETL и разбора ответа, а не из
+скорости настоящего кластера.
+
+Можно запустить отдельным процессом, чтобы он не делил GIL с ETL:
+    python benchmarks/fake_elasticsearch.py --port 9201 --latency-ms 5
+"""
+import argparse
+import gzip
+import json
+from dataclasses import dataclass
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import sleep
+from typing import Optional
+
+
+@dataclass
+class BulkStats:
+    requests: int = 0
+    documents: int = 0
+    bytes: int = 0
+
+
+class FakeElasticsearch:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency_ms: float = 0):
+        self.latency_sec = latency_ms / 1000
+        self.stats = BulkStats()
+        # Индекс -> псевдонимы
+        self.indices: dict[str, set[str]] = {}
+        self._lock = Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread: Optional[Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def serve_forever(self) -> None:
+        self._server.serve_forever()
+
+    def start(self) -> "FakeElasticsearch":
+        self._thread = Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def resolve(self, name: str) -> list[str]:
+        if name in self.indices:
+            return [name]
+        return [index for index, aliases in self.indices.items() if name in aliases]
+
+    def bulk(self, body: bytes) -> dict:
+        lines = body.splitlines()
+        items = []
+        for action_line in lines[::2]:
+            action, meta = next(iter(json.loads(action_line).items()))
+            items.append(
+                {action: {"_index": meta.get("_index"), "_id": meta.get("_id"), "status": 201}}
+            )
+        with self._lock:
+            self.stats.requests += 1
+            self.stats.documents += len(items)
+            self.stats.bytes += len(body)
+        if self.latency_sec:
+            sleep(self.latency_sec)
+        return {"took": 1, "errors": False, "items": items}
+
+    def update_aliases(self, actions: list[dict]) -> None:
+        with self._lock:
+            for action in actions:
+                ((kind, params),) = action.items()
+                if kind == "add":
+                    self.indices[params["index"]].add(params["alias"])
+                elif kind == "remove":
+                    self.indices[params["index"]].discard(params["alias"])
+                elif kind == "remove_index":
+                    self.indices.pop(params["index"], None)
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Заголовки и тело уходят отдельными пакетами, с алгоритмом Нейгла
+            # каждый ответ ждал бы отложенного подтверждения
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def _body(self) -> bytes:
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.headers.get("Content-Encoding") == "gzip":
+                    body = gzip.decompress(body)
+                return body
+
+            def _reply(self, status: int, payload: Optional[dict] = None) -> None:
+                data = json.dumps(payload if payload is not None else {}).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("X-Elastic-Product", "Elasticsearch")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(data)
+
+            def _route(self) -> None:
+                path = self.path.split("?")[0].strip("/")
+                parts = path.split("/") if path else []
+                body = self._body()
+
+                if not parts:
+                    return self._reply(
+                        HTTPStatus.OK,
+                        {"version": {"number": "8.6.2"}, "tagline": "You Know, for Search"},
+                    )
+                if parts[-1] == "_bulk":
+                    return self._reply(HTTPStatus.OK, fake.bulk(body))
+                if parts == ["_aliases"]:
+                    fake.update_aliases(json.loads(body)["actions"])
+                    return self._reply(HTTPStatus.OK, {"acknowledged": True})
+                if parts[0] == "_alias" and len(parts) == 2:
+                    found = {index: {"aliases": {parts[1]: {}}} for index in fake.resolve(parts[1])}
+                    found.pop(parts[1], None)
+                    return self._reply(HTTPStatus.OK if found else HTTPStatus.NOT_FOUND, found)
+                if len(parts) == 2 and parts[1] in ("_refresh", "_forcemerge", "_settings"):
+                    return self._reply(HTTPStatus.OK, {"acknowledged": True})
+                if len(parts) == 1:
+                    return self._index(parts[0], body)
+                return self._reply(HTTPStatus.OK, {"acknowledged": True})
+
+            def _index(self, name: str, body: bytes) -> None:
+                if self.command == "HEAD":
+                    found = fake.resolve(name)
+                    return self._reply(HTTPStatus.OK if found else HTTPStatus.NOT_FOUND)
+                if self.command == "PUT":
+                    with fake._lock:
+                        if name in fake.indices:
+                            return self._reply(HTTPStatus.BAD_REQUEST, {"error": "exists"})
+                        aliases = json.loads(body or b"{}").get("aliases", {})
+                        fake.indices[name] = set(aliases)
+                    return self._reply(HTTPStatus.OK, {"acknowledged": True, "index": name})
+                if self.command == "DELETE":
+                    with fake._lock:
+                        fake.indices.pop(name, None)
+                return self._reply(HTTPStatus.OK, {"acknowledged": True})
+
+            do_GET = do_HEAD = do_PUT = do_POST = do_DELETE = _route
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9201)
+    parser.add_argument("--latency-ms", type=float, default=0, help="задержка ответа на bulk")
+    args = parser.parse_args()
+
+    fake = FakeElasticsearch(args.host, args.port, args.latency_ms)
+    print(f"Имитация elasticsearch на {fake.url}")
+    try:
+        fake.serve_forever()
+    except KeyboardInterrupt:
+        print(f"Принято: {fake.stats}")
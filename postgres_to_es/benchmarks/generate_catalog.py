@@ -0,0 +1,142 @@
+"""
+Синтетический каталог для замеров ETL в схеме db/movies_database.sql.
+
+Разветвление такое же, как в дампе: в среднем 3.5 актера, 1.5 сценариста,
+0.8 режиссера и 2 жанра на фильм. Строки собираются на стороне Postgres через
+generate_series, идентификаторы выводятся из номеров, поэтому повторный запуск
+с тем же масштабом не создает дублей.
+
+Базу лучше завести отдельную, со схемой из дампа:
+    createdb movies_benchmark && psql -d movies_benchmark -f db/movies_database.sql
+    cd postgres_to_es && DB_NAME=movies_benchmark python benchmarks/generate_catalog.py \\
+        --films 100000 --reset
+"""
+import argparse
+import os
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psycopg2  # noqa: E402
+from settings import POSTGRES_CONNECTION_SETTINGS  # noqa: E402
+
+GENRES_SQL = """
+    INSERT INTO content.genre (id, name, description, created, modified)
+    SELECT md5('genre' || g)::uuid, 'Genre ' || g, 'Synthetic genre ' || g, now(), now()
+    FROM generate_series(1, %(genres)s) g
+    ON CONFLICT DO NOTHING
+"""
+
+PERSONS_SQL = """
+    INSERT INTO content.person (id, full_name, created, modified)
+    SELECT md5('person' || p)::uuid, 'Person ' || p, now(),
+        now() - make_interval(secs => abs(hashtext('person' || p)) %% 31536000)
+    FROM generate_series(%(start)s, %(stop)s) p
+    ON CONFLICT DO NOTHING
+"""
+
+# В схеме дампа уникальны (title, creation_date) и (type, rating, creation_date),
+# поэтому рейтинг, тип и дата выхода выводятся из номера фильма без повторов
+FILMS_SQL = """
+    INSERT INTO content.film_work (id, title, description, creation_date, rating, type,
+        created, modified)
+    SELECT md5('film' || f)::uuid, 'Film ' || f,
+        repeat('Synthetic description. ', abs(hashtext('description' || f)) %% 20),
+        date '1950-01-01' + f / 400,
+        CASE WHEN f %% 100 > 0 THEN (f %% 100) / 10.0 END,
+        (ARRAY['movie', 'tv_show', 'series', 'cartoons'])[1 + f / 100 %% 4]::content.type, now(),
+        now() - make_interval(secs => abs(hashtext('film' || f)) %% 31536000)
+    FROM generate_series(%(start)s, %(stop)s) f
+    ON CONFLICT DO NOTHING
+"""
+
+# Число участников каждой роли выводится из хеша номера фильма
+PERSON_FILM_WORK_SQL = """
+    INSERT INTO content.person_film_work (id, person_id, film_work_id, role, created, modified)
+    SELECT md5(concat('pfw', f, roles.role, n))::uuid,
+        md5('person' || (1 + abs(hashtext(concat(f, roles.role, n))) %% %(persons)s))::uuid,
+        md5('film' || f)::uuid, roles.role, now(),
+        now() - make_interval(secs => abs(hashtext(concat('pfw', f, roles.role, n))) %% 31536000)
+    FROM generate_series(%(start)s, %(stop)s) f,
+        LATERAL (VALUES
+            ('actor', 1 + abs(hashtext('actors' || f)) %% 6),
+            ('writer', abs(hashtext('writers' || f)) %% 4),
+            ('director', CASE WHEN abs(hashtext('directors' || f)) %% 5 = 0 THEN 0 ELSE 1 END)
+        ) AS roles(role, total),
+        LATERAL generate_series(1, roles.total) n
+    ON CONFLICT DO NOTHING
+"""
+
+GENRE_FILM_WORK_SQL = """
+    INSERT INTO content.genre_film_work (id, genre_id, film_work_id, created, modified)
+    SELECT md5(concat('gfw', f, n))::uuid,
+        md5('genre' || (1 + abs(hashtext(concat('genre', f, n))) %% %(genres)s))::uuid,
+        md5('film' || f)::uuid, now(),
+        now() - make_interval(secs => abs(hashtext(concat('gfw', f, n))) %% 31536000)
+    FROM generate_series(%(start)s, %(stop)s) f,
+        LATERAL generate_series(1, 1 + abs(hashtext('genres' || f)) %% 3) n
+    ON CONFLICT DO NOTHING
+"""
+
+RESET_SQL = """
+    TRUNCATE content.person_film_work, content.genre_film_work,
+        content.film_work, content.person, content.genre
+"""
+
+
+def generate(connection, films: int, persons: int, genres: int, chunk: int) -> None:
+    with connection.cursor() as cursor:
+        cursor.execute(GENRES_SQL, {"genres": genres})
+        for start in range(1, persons + 1, chunk):
+            cursor.execute(PERSONS_SQL, {"start": start, "stop": min(start + chunk - 1, persons)})
+            connection.commit()
+
+        for start in range(1, films + 1, chunk):
+            params = {
+                "start": start,
+                "stop": min(start + chunk - 1, films),
+                "persons": persons,
+                "genres": genres,
+            }
+            started = perf_counter()
+            cursor.execute(FILMS_SQL, params)
+            cursor.execute(PERSON_FILM_WORK_SQL, params)
+            cursor.execute(GENRE_FILM_WORK_SQL, params)
+            connection.commit()
+            print(f"Фильмы {start}-{params['stop']}: {perf_counter() - started:.1f} с")
+
+        cursor.execute("ANALYZE content.film_work, content.person, content.genre")
+        cursor.execute("ANALYZE content.person_film_work, content.genre_film_work")
+        connection.commit()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--films", type=int, default=100_000)
+    parser.add_argument(
+        "--persons-per-film", type=float, default=1.0, help="отношение числа персон к фильмам"
+    )
+    parser.add_argument("--genres", type=int, default=30)
+    parser.add_argument("--chunk", type=int, default=50_000, help="фильмов в одной транзакции")
+    parser.add_argument("--reset", action="store_true", help="очистить таблицы content")
+    args = parser.parse_args()
+
+    connection = psycopg2.connect(**POSTGRES_CONNECTION_SETTINGS)
+    try:
+        if args.reset:
+            with connection.cursor() as cursor:
+                cursor.execute(RESET_SQL)
+            connection.commit()
+
+        started = perf_counter()
+        generate(
+            connection,
+            films=args.films,
+            persons=max(1, int(args.films * args.persons_per_film)),
+            genres=args.genres,
+            chunk=args.chunk,
+        )
+        print(f"Каталог из {args.films} фильмов создан за {perf_counter() - started:.1f} с")
+    finally:
+        connection.close()
@@ -0,0 +1,86 @@
+"""
+Сравнение путей преобразования строк фильмов в тела документов elasticsearch.
+
+    cd postgres_to_es && python benchmarks/transform_benchmark.py --films 10000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import uuid
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_transform import DataTransform  # noqa: E402
+from elasticsearch.serializer import JSONSerializer  # noqa: E402
+from models import ESFilmworkData  # noqa: E402
+
+
+def make_person() -> dict:
+    return {"id": str(uuid.uuid4()), "name": f"Person {random.randint(0, 10**6)}"}
+
+
+def make_film_row() -> dict:
+    actors = [make_person() for _ in range(random.randint(0, 30))]
+    writers = [make_person() for _ in range(random.randint(0, 5))]
+    directors = [make_person() for _ in range(random.randint(0, 2))]
+    return {
+        "id": str(uuid.uuid4()),
+        "title": f"Film {random.randint(0, 10**6)}",
+        "description": "Lorem ipsum " * random.randint(0, 100) or None,
+        "imdb_rating": random.choice([None, round(random.uniform(1, 10), 1)]),
+        "actors": actors,
+        "writers": writers,
+        "directors": directors,
+        "genres": [{"id": str(uuid.uuid4()), "name": "Drama"} for _ in range(random.randint(1, 3))],
+        "actors_names": sorted({person["name"] for person in actors}),
+        "writers_names": sorted({person["name"] for person in writers}),
+        "directors_names": sorted({person["name"] for person in directors}),
+    }
+
+
+def pydantic_path(transformer: DataTransform, rows: list[dict]) -> list[bytes]:
+    # То же, что делает текущий путь: модели, затем .dict() в загрузчике и сериализация клиентом
+    serializer = JSONSerializer()
+    models = transformer.validate_and_transform(ESFilmworkData, rows)
+    return [serializer.dumps(model.dict()) for model in models]
+
+
+def fast_path(transformer: DataTransform, rows: list[dict]) -> list[bytes]:
+    return [document.source for document in transformer.to_documents(ESFilmworkData, rows)]
+
+
+def measure(func, transformer: DataTransform, rows: list[dict], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = perf_counter()
+        func(transformer, rows)
+        best = min(best, perf_counter() - started)
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--films", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    random.seed(0)
+    rows = [make_film_row() for _ in range(args.films)]
+    transformer = DataTransform()
+
+    slow = pydantic_path(transformer, rows)
+    fast = fast_path(transformer, rows)
+    assert [json.loads(document) for document in slow] == [
+        json.loads(document) for document in fast
+    ], "Пути преобразования дают разные документы"
+
+    per_10k = 10000 / args.films
+    pydantic_sec = measure(pydantic_path, transformer, rows, args.repeat)
+    fast_sec = measure(fast_path, transformer, rows, args.repeat)
+    print(f"Фильмов: {args.films}, лучший из {args.repeat} прогонов")
+    print(f"pydantic: {pydantic_sec * per_10k * 1000:.1f} мс на 10k фильмов")
+    print(f"fast:     {fast_sec * per_10k * 1000:.1f} мс на 10k фильмов")
+    print(f"Ускорение: x{pydantic_sec / fast_sec:.1f}")
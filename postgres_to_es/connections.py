@@ -0,0 +1,166 @@
+from collections import Counter
+from threading import BoundedSemaphore, Lock
+from time import monotonic
+from typing import Any, Optional
+
+import psycopg2
+from elasticsearch import Elasticsearch
+from loguru import logger
+from psycopg2.extras import RealDictCursor
+from settings import (
+    ELASTIC_SEARCH_URL,
+    ES_CONNECTIONS_PER_NODE,
+    ES_HTTP_COMPRESS,
+    ETL_CONNECTION_CHECK_INTERVAL_SEC,
+    ETL_PG_POOL_SIZE,
+    POSTGRES_CONNECTION_SETTINGS,
+)
+
+_opened: Counter = Counter()
+_opened_lock = Lock()
+
+
+def _count_opened(backend: str) -> None:
+    with _opened_lock:
+        _opened[backend] += 1
+
+
+class PostgresPool:
+    """
+    Соединения с postgresql, общие для всех циклов и потоков ETL. Соединение,
+    простоявшее дольше ETL_CONNECTION_CHECK_INTERVAL_SEC, перед выдачей проверяется
+    запросом SELECT 1, оборванное закрывается и заменяется новым. Когда все
+    ETL_PG_POOL_SIZE соединений заняты, acquire ждет освобождения.
+    """
+
+    def __init__(self, size: int = ETL_PG_POOL_SIZE):
+        self.size = size
+        self._slots = BoundedSemaphore(size)
+        self._lock = Lock()
+        # Свободные соединения и время их возврата, последнее возвращенное - в конце
+        self._idle: list[tuple[Any, float]] = []
+        self._in_use = 0
+
+    def acquire(self):
+        self._slots.acquire()
+        try:
+            connection = self._take_alive()
+            if connection is None:
+                connection = psycopg2.connect(
+                    **POSTGRES_CONNECTION_SETTINGS, cursor_factory=RealDictCursor
+                )
+                _count_opened("postgres")
+                logger.debug(
+                    f"Открыто соединение с postgresql, всего открывалось {_opened['postgres']}"
+                )
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._in_use += 1
+        return connection
+
+    def release(self, connection) -> None:
+        """Завершает открытую транзакцию и возвращает соединение в пул."""
+        try:
+            if not connection.closed:
+                # Открытая транзакция удерживала бы SAFE_CUTOFF_QUERY других процессов ETL
+                connection.rollback()
+        except psycopg2.Error:
+            connection.close()
+        with self._lock:
+            self._in_use -= 1
+            if not connection.closed:
+                self._idle.append((connection, monotonic()))
+        self._slots.release()
+
+    def _take_alive(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                connection, released_at = self._idle.pop()
+            if self._is_alive(connection, released_at):
+                return connection
+            logger.warning("Соединение с postgresql из пула оборвано, открывается новое")
+            connection.close()
+
+    @staticmethod
+    def _is_alive(connection, released_at: float) -> bool:
+        if connection.closed:
+            return False
+        if monotonic() - released_at < ETL_CONNECTION_CHECK_INTERVAL_SEC:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            connection.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {"in_use": self._in_use, "idle": len(self._idle)}
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, _ in idle:
+            connection.close()
+
+
+postgres_pool = PostgresPool()
+
+_es_client: Optional[Elasticsearch] = None
+_es_lock = Lock()
+
+
+def get_es_client() -> Elasticsearch:
+    """
+    Клиент elasticsearch, общий для всех циклов и потоков ETL. Клиент держит пул
+    HTTP-соединений keep-alive к каждому узлу и сам переподключается после обрыва.
+    """
+    global _es_client
+    with _es_lock:
+        if _es_client is None:
+            _es_client = Elasticsearch(
+                ELASTIC_SEARCH_URL,
+                http_compress=ES_HTTP_COMPRESS,
+                connections_per_node=ES_CONNECTIONS_PER_NODE,
+            )
+        return _es_client
+
+
+def _es_stats() -> tuple[int, int]:
+    """Простаивающие и всего открытые HTTP-соединения клиента elasticsearch."""
+    idle = opened = 0
+    if _es_client is None:
+        return idle, opened
+    for node in _es_client.transport.node_pool.all():
+        # Внутренности urllib3: в очереди пула лежат простаивающие соединения и
+        # пустые места (None) под новые, num_connections растет с каждым открытием
+        pool = getattr(node, "pool", None)
+        if pool is None:
+            continue
+        idle += sum(1 for connection in list(pool.pool.queue) if connection is not None)
+        opened += pool.num_connections
+    return idle, opened
+
+
+def connection_stats() -> dict[tuple[str, str], int]:
+    """Соединения по бэкендам и состояниям in_use и idle для экспорта в метрики."""
+    postgres = postgres_pool.stats()
+    es_idle, _ = _es_stats()
+    return {
+        ("postgres", "in_use"): postgres["in_use"],
+        ("postgres", "idle"): postgres["idle"],
+        ("elasticsearch", "idle"): es_idle,
+    }
+
+
+def opened_connections() -> dict[str, int]:
+    """Сколько соединений открыто с запуска ETL: в установившемся режиме не растет."""
+    _, es_opened = _es_stats()
+    with _opened_lock:
+        return {"postgres": _opened["postgres"], "elasticsearch": es_opened}
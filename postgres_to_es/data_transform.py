@@ -1,8 +1,199 @@
-from decorators import backoff
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import chain
+from multiprocessing import get_context
+from typing import Any, Callable, Type
+
+import orjson
+from loguru import logger
+from models import BulkDocument
 from pydantic import BaseModel
+from pydantic.fields import SHAPE_LIST, SHAPE_SINGLETON, ModelField
+from settings import ETL_TRANSFORM_MODE, ETL_TRANSFORM_WORKERS
+
+_SCALAR_TYPES = {
+    str: (str,),
+    float: (float, int),
+    int: (int,),
+    bool: (bool,),
+}
+
+
+class TransformError(ValueError):
+    pass
+
+
+def _compile_field(field: ModelField) -> Callable[[Any, str], Any]:
+    if isinstance(field.type_, type) and issubclass(field.type_, BaseModel):
+        convert_item = compile_converter(field.type_)
+    elif field.type_ in _SCALAR_TYPES:
+        allowed = _SCALAR_TYPES[field.type_]
+
+        def convert_item(value: Any, path: str) -> Any:
+            if not isinstance(value, allowed):
+                raise TransformError(f"{path}: ожидался {field.type_.__name__}, получено {value!r}")
+            return value
+
+    else:
+        raise TypeError(f"Поле {field.name}: тип {field.outer_type_} не поддерживается")
+
+    if field.shape == SHAPE_SINGLETON:
+        return convert_item
+    if field.shape == SHAPE_LIST:
+
+        def convert_list(value: Any, path: str) -> list:
+            if not isinstance(value, list):
+                raise TransformError(f"{path}: ожидался список, получено {value!r}")
+            return [convert_item(item, f"{path}[{i}]") for i, item in enumerate(value)]
+
+        return convert_list
+    raise TypeError(f"Поле {field.name}: тип {field.outer_type_} не поддерживается")
+
+
+def compile_converter(model: Type[BaseModel]) -> Callable[[Any, str], dict]:
+    """
+    Собирает по описанию pydantic-модели функцию, которая проверяет обязательность,
+    None и типы полей и оставляет только поля модели. В отличие от модели не создает
+    объектов и не приводит типы, поэтому рассчитана на данные, уже собранные SQL-запросом.
+    """
+    fields = [
+        (
+            name,
+            field.required,
+            field.allow_none,
+            field.get_default(),
+            _compile_field(field),
+        )
+        for name, field in model.__fields__.items()
+    ]
+
+    def convert(obj: Any, path: str = model.__name__) -> dict:
+        if not isinstance(obj, dict):
+            raise TransformError(f"{path}: ожидался объект, получено {obj!r}")
+        document = {}
+        for name, required, allow_none, default, convert_field in fields:
+            value = obj.get(name)
+            if value is None:
+                if name in obj and allow_none:
+                    document[name] = None
+                elif required or not allow_none and name in obj:
+                    raise TransformError(f"{path}.{name}: обязательное поле не заполнено")
+                else:
+                    document[name] = default
+                continue
+            document[name] = convert_field(value, f"{path}.{name}")
+        return document
+
+    return convert
 
 
 class DataTransform:
-    @backoff()
+    # Сколько пакетов конвейеру держать в преобразовании одновременно
+    in_flight = 1
+
+    def __init__(self):
+        self._converters: dict[Type[BaseModel], Callable[[Any, str], dict]] = {}
+
     def validate_and_transform(self, model: BaseModel, objects: list[dict]) -> list[BaseModel]:
         return [model(**dict(obj)) for obj in objects]
+
+    def to_documents(self, model: Type[BaseModel], objects: list[dict]) -> list[BulkDocument]:
+        """Быстрый путь: строки сразу превращаются в готовые к отправке тела документов."""
+        if model not in self._converters:
+            self._converters[model] = compile_converter(model)
+        convert = self._converters[model]
+
+        documents = []
+        for obj in objects:
+            document = convert(obj)
+            documents.append(BulkDocument(id=document["id"], source=orjson.dumps(document)))
+        return documents
+
+    def transform(self, model: Type[BaseModel], objects: list[dict]) -> list:
+        if ETL_TRANSFORM_MODE == "fast":
+            return self.to_documents(model, objects)
+        return self.validate_and_transform(model, objects)
+
+    def transform_each(
+        self, model: Type[BaseModel], objects: list[dict]
+    ) -> tuple[list, list[tuple[dict, str]]]:
+        """
+        Преобразует строки по одной в этом процессе, чтобы отделить не прошедшие
+        проверку от остальных. Возвращает документы и отвергнутые строки с причиной.
+        """
+        documents, rejected = [], []
+        for obj in objects:
+            try:
+                documents.extend(DataTransform.transform(self, model, [obj]))
+            except ValueError as e:
+                rejected.append((obj, str(e)))
+        return documents, rejected
+
+    def submit(self, model: Type[BaseModel], objects: list[dict]) -> Future:
+        future: Future = Future()
+        try:
+            future.set_result(self.transform(model, objects))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def close(self) -> None:
+        pass
+
+
+_worker_transform = None
+
+
+def _init_worker() -> None:
+    global _worker_transform
+    _worker_transform = DataTransform()
+
+
+def _transform_in_worker(model: Type[BaseModel], payload: bytes) -> list[BulkDocument]:
+    """
+    Преобразует пакет в процессе-обработчике. Строки приходят одним JSON-блоком,
+    а возвращаются уже сериализованные тела документов, поэтому между процессами
+    не передаются ни словари строк, ни модели pydantic.
+    """
+    documents = _worker_transform.transform(model, orjson.loads(payload))
+    if ETL_TRANSFORM_MODE == "fast":
+        return documents
+    return [
+        BulkDocument(id=document.id, source=orjson.dumps(document.dict())) for document in documents
+    ]
+
+
+class ProcessTransform(DataTransform):
+    """
+    Преобразование в пуле из ETL_TRANSFORM_WORKERS процессов. Конвейер держит в
+    работе по пакету на процесс (submit), последовательный ETL делит каждый пакет
+    между процессами (transform). Результаты возвращаются в порядке строк пакета.
+    """
+
+    def __init__(self, workers: int):
+        super().__init__()
+        self.in_flight = workers
+        # spawn: процессы-обработчики не наследуют потоки и соединения ETL
+        self.pool = ProcessPoolExecutor(
+            workers, mp_context=get_context("spawn"), initializer=_init_worker
+        )
+
+    def submit(self, model: Type[BaseModel], objects: list[dict]) -> Future:
+        return self.pool.submit(_transform_in_worker, model, orjson.dumps(objects))
+
+    def transform(self, model: Type[BaseModel], objects: list[dict]) -> list[BulkDocument]:
+        chunk_size = max(-(-len(objects) // self.in_flight), 1)
+        futures = [
+            self.submit(model, objects[start:][:chunk_size])
+            for start in range(0, len(objects), chunk_size)
+        ]
+        return list(chain.from_iterable(future.result() for future in futures))
+
+    def close(self) -> None:
+        self.pool.shutdown(cancel_futures=True)
+
+
+def get_transformer() -> DataTransform:
+    if ETL_TRANSFORM_WORKERS > 0:
+        logger.info(f"Преобразование в {ETL_TRANSFORM_WORKERS} процессах")
+        return ProcessTransform(ETL_TRANSFORM_WORKERS)
+    return DataTransform()
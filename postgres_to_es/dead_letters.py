@@ -0,0 +1,248 @@
+import abc
+import json
+import os
+from dataclasses import dataclass, replace
+from datetime import datetime
+from threading import Lock
+from typing import Optional, Type
+from uuid import uuid4
+
+import metrics
+import orjson
+import redis
+from data_transform import DataTransform
+from decorators import TRANSIENT_STATUSES, backoff
+from elasticsearch_loader import BulkResult
+from loguru import logger
+from pydantic import BaseModel
+from settings import (
+    ETL_DEAD_LETTERS,
+    ETL_DEAD_LETTERS_FILE,
+    ETL_DEAD_LETTERS_MAX_LEN,
+    REDIS_ADAPTER,
+)
+
+
+@dataclass
+class DeadLetter:
+    """
+    Строка, которую ETL пропустил: stage transform - не прошла проверку модели,
+    load - отклонена elasticsearch без надежды на успех повтора.
+    """
+
+    entity: str
+    id: str
+    stage: str
+    reason: str
+    row: str = "null"
+    created: str = ""
+    # Ключ записи в хранилище, по нему запись удаляется после повтора
+    key: Optional[str] = None
+
+    def to_fields(self) -> dict[str, str]:
+        return {
+            "id": self.id,
+            "stage": self.stage,
+            "reason": self.reason,
+            "row": self.row,
+            "created": self.created,
+        }
+
+
+class BaseDeadLetterStorage(metaclass=abc.ABCMeta):
+    @abc.abstractmethod
+    def add(self, entity: str, letters: list[DeadLetter]) -> None:
+        pass
+
+    @abc.abstractmethod
+    def read(self, entity: str) -> list[DeadLetter]:
+        pass
+
+    @abc.abstractmethod
+    def remove(self, entity: str, keys: list[str]) -> None:
+        pass
+
+
+class RedisDeadLetterStorage(BaseDeadLetterStorage):
+    """Поток Redis на сущность, не длиннее ETL_DEAD_LETTERS_MAX_LEN записей."""
+
+    def __init__(self, redis_adapter: redis.Redis, max_len: int = ETL_DEAD_LETTERS_MAX_LEN):
+        self.redis_adapter = redis_adapter
+        self.max_len = max_len
+
+    @staticmethod
+    def _key(entity: str) -> str:
+        return f"dead_letters:{entity}"
+
+    @backoff()
+    def add(self, entity: str, letters: list[DeadLetter]) -> None:
+        pipeline = self.redis_adapter.pipeline()
+        for letter in letters:
+            pipeline.xadd(
+                self._key(entity), letter.to_fields(), maxlen=self.max_len, approximate=True
+            )
+        pipeline.execute()
+
+    @backoff()
+    def read(self, entity: str) -> list[DeadLetter]:
+        return [
+            DeadLetter(entity=entity, key=_decode(key), **_decode(fields))
+            for key, fields in self.redis_adapter.xrange(self._key(entity))
+        ]
+
+    @backoff()
+    def remove(self, entity: str, keys: list[str]) -> None:
+        if keys:
+            self.redis_adapter.xdel(self._key(entity), *keys)
+
+
+def _decode(value):
+    if isinstance(value, bytes):
+        return value.decode()
+    if isinstance(value, dict):
+        return {_decode(key): _decode(item) for key, item in value.items()}
+    return value
+
+
+class FileDeadLetterStorage(BaseDeadLetterStorage):
+    """Файл JSON Lines, общий для всех сущностей."""
+
+    def __init__(self, file_path: str = ETL_DEAD_LETTERS_FILE):
+        self.file_path = file_path
+        # В файл пишут ETL разных сущностей из параллельных потоков
+        self._lock = Lock()
+
+    def add(self, entity: str, letters: list[DeadLetter]) -> None:
+        with self._lock, open(self.file_path, "a") as letters_file:
+            for letter in letters:
+                record = {"entity": entity, "key": uuid4().hex, **letter.to_fields()}
+                letters_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def _read_all(self) -> list[dict]:
+        if not os.path.exists(self.file_path):
+            return []
+        with open(self.file_path) as letters_file:
+            return [json.loads(line) for line in letters_file if line.strip()]
+
+    def read(self, entity: str) -> list[DeadLetter]:
+        with self._lock:
+            records = self._read_all()
+        return [DeadLetter(**record) for record in records if record["entity"] == entity]
+
+    def remove(self, entity: str, keys: list[str]) -> None:
+        removed = set(keys)
+        with self._lock:
+            records = [record for record in self._read_all() if record["key"] not in removed]
+            with open(f"{self.file_path}.tmp", "w") as letters_file:
+                for record in records:
+                    letters_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            os.replace(f"{self.file_path}.tmp", self.file_path)
+
+
+def get_dead_letter_storage() -> Optional[BaseDeadLetterStorage]:
+    if ETL_DEAD_LETTERS == "redis":
+        return RedisDeadLetterStorage(REDIS_ADAPTER)
+    if ETL_DEAD_LETTERS == "file":
+        return FileDeadLetterStorage(ETL_DEAD_LETTERS_FILE)
+    return None
+
+
+class DeadLetterQueue:
+    """
+    Отделяет от пакета строки, которые не станут загружаемыми от повтора, и
+    откладывает их в хранилище с причиной, а остальные строки пакета идут
+    дальше. Без хранилища (ETL_DEAD_LETTERS=off) ошибка, как и раньше,
+    останавливает загрузку на этом пакете.
+    """
+
+    def __init__(self, storage: Optional[BaseDeadLetterStorage]):
+        self.storage = storage
+
+    def transform(
+        self, transformer: DataTransform, entity: str, model: Type[BaseModel], rows: list[dict]
+    ) -> list:
+        try:
+            return transformer.transform(model, rows)
+        except ValueError as e:
+            return self.isolate(transformer, entity, model, rows, e)
+
+    def isolate(
+        self,
+        transformer: DataTransform,
+        entity: str,
+        model: Type[BaseModel],
+        rows: list[dict],
+        error: ValueError,
+    ) -> list:
+        """Преобразует по одной строки пакета, преобразование которого завершилось error."""
+        if self.storage is None:
+            raise error
+        documents, rejected = transformer.transform_each(model, rows)
+        self._add(
+            entity,
+            [
+                DeadLetter(entity, str(row["id"]), "transform", reason, _dump(row))
+                for row, reason in rejected
+            ],
+        )
+        return documents
+
+    def divert(self, entity: str, rows: list[dict], result: BulkResult) -> BulkResult:
+        """
+        Откладывает документы, отклоненные elasticsearch окончательно, например
+        из-за несовпадения со схемой. Временные отказы остаются в результате,
+        и пакет будет загружен повторно.
+        """
+        if self.storage is None or not result.errors:
+            return result
+        transient, rejected = [], []
+        for error in result.errors:
+            info = next(iter(error.values()))
+            if info.get("status") in TRANSIENT_STATUSES:
+                transient.append(error)
+            else:
+                rejected.append(info)
+        if not rejected:
+            return result
+
+        rows_by_id = {str(row["id"]): row for row in rows}
+        self._add(
+            entity,
+            [
+                DeadLetter(
+                    entity,
+                    info["_id"],
+                    "load",
+                    json.dumps(info.get("error"), ensure_ascii=False),
+                    _dump(rows_by_id.get(info["_id"])),
+                )
+                for info in rejected
+            ],
+        )
+        return replace(result, errors=transient)
+
+    def _add(self, entity: str, letters: list[DeadLetter]) -> None:
+        if not letters:
+            return
+        created = datetime.utcnow().isoformat()
+        letters = [replace(letter, created=created) for letter in letters]
+        self.storage.add(entity, letters)
+        for letter in letters:
+            metrics.DEAD_LETTERS.labels(entity, letter.stage).inc()
+            logger.error(f"Строка {entity} {letter.id} отложена ({letter.stage}): {letter.reason}")
+
+
+def _dump(row: Optional[dict]) -> str:
+    return orjson.dumps(row, default=str).decode()
+
+
+_queue: Optional[DeadLetterQueue] = None
+_queue_lock = Lock()
+
+
+def get_dead_letters() -> DeadLetterQueue:
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = DeadLetterQueue(get_dead_letter_storage())
+        return _queue
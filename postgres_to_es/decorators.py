@@ -1,48 +1,179 @@
+import inspect
+from collections import Counter
+from dataclasses import dataclass
 from functools import wraps
-from time import sleep
+from random import uniform
+from threading import Lock
+from time import monotonic, sleep
+from typing import Any, Callable, Optional
 
+import elasticsearch
+import psycopg2
+import redis
 from loguru import logger
+from settings import ETL_RETRY_DEADLINE_SEC, ETL_RETRY_MAX_ATTEMPTS
 
+TRANSIENT_ERRORS = (
+    ConnectionError,
+    TimeoutError,
+    psycopg2.OperationalError,
+    psycopg2.InterfaceError,
+    elasticsearch.ConnectionError,
+    elasticsearch.ConnectionTimeout,
+    redis.ConnectionError,
+    redis.TimeoutError,
+)
+# Ответы elasticsearch, после которых запрос имеет смысл повторить
+TRANSIENT_STATUSES = {429, 502, 503, 504}
 
-def backoff(start_sleep_time=0.1, factor=2, border_sleep_time=10):
+_counters: Counter = Counter()
+_counters_lock = Lock()
+
+
+def is_transient(error: Exception) -> bool:
+    if isinstance(error, elasticsearch.ApiError):
+        return error.status_code in TRANSIENT_STATUSES
+    return isinstance(error, TRANSIENT_ERRORS)
+
+
+def retry_counters() -> dict[tuple[str, str], int]:
+    """Число повторов (retry), отказов после исчерпания попыток (giveup) и
+    непоправимых ошибок (permanent) по функциям, для экспорта в метрики."""
+    with _counters_lock:
+        return dict(_counters)
+
+
+def _count(name: str, outcome: str) -> None:
+    with _counters_lock:
+        _counters[name, outcome] += 1
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
     """
-    Функция для повторного выполнения функции через некоторое время, если возникла ошибка.
-    Использует наивный экспоненциальный рост времени повтора (factor)
-    до граничного времени ожидания (border_sleep_time)
+    Экспоненциальный рост паузы между попытками (factor) до border_sleep_time со
+    случайным разбросом в пределах половины паузы, чтобы несколько потоков не
+    повторяли запросы одновременно. Первая попытка выполняется без ожидания.
     Формула:
-        t = start_sleep_time * 2^(n) if t < border_sleep_time
-        t = border_sleep_time if t >= border_sleep_time
-    :param start_sleep_time: начальное время повтора
-    :param factor: во сколько раз нужно увеличить время ожидания
+        t = min(start_sleep_time * factor^(n - 1), border_sleep_time)
+        пауза перед n + 1 попыткой - случайное число от t / 2 до t
+    """
+
+    start_sleep_time: float = 0.1
+    factor: float = 2
+    border_sleep_time: float = 10
+    max_attempts: Optional[int] = ETL_RETRY_MAX_ATTEMPTS
+    deadline: Optional[float] = ETL_RETRY_DEADLINE_SEC
+    is_transient: Callable[[Exception], bool] = is_transient
+
+    def delay(self, failures: int) -> float:
+        t = min(self.start_sleep_time * self.factor ** (failures - 1), self.border_sleep_time)
+        return uniform(t / 2, t)
+
+
+class _Attempts:
+    def __init__(self, policy: RetryPolicy, name: str):
+        self.policy = policy
+        self.name = name
+        self.reset()
+
+    def reset(self) -> None:
+        self.failures = 0
+        self.restart_deadline()
+
+    def restart_deadline(self) -> None:
+        self.started = monotonic()
+
+    def retry(self, error: Exception) -> bool:
+        """Решает, повторять ли вызов после ошибки, и выжидает паузу перед повтором."""
+        policy = self.policy
+        if not policy.is_transient(error):
+            _count(self.name, "permanent")
+            logger.error(f"Ошибка {error!r} в {self.name} не исправится повтором")
+            return False
+
+        self.failures += 1
+        delay = policy.delay(self.failures)
+        if (policy.max_attempts and self.failures >= policy.max_attempts) or (
+            policy.deadline and monotonic() + delay - self.started > policy.deadline
+        ):
+            _count(self.name, "giveup")
+            logger.error(f"{self.name} не выполнена за {self.failures} попыток: {error!r}")
+            return False
+
+        _count(self.name, "retry")
+        logger.warning(
+            f"Ошибка {error!r} в {self.name}, попытка {self.failures + 1} через {delay:.2f} с"
+        )
+        sleep(delay)
+        return True
+
+
+def backoff(
+    start_sleep_time: float = 0.1,
+    factor: float = 2,
+    border_sleep_time: float = 10,
+    max_attempts: Optional[int] = ETL_RETRY_MAX_ATTEMPTS,
+    deadline: Optional[float] = ETL_RETRY_DEADLINE_SEC,
+    resume: Optional[Callable[[dict, Any], None]] = None,
+):
+    """
+    Повторяет функцию после временных ошибок (is_transient) по RetryPolicy,
+    остальные ошибки пробрасываются сразу.
+    :param start_sleep_time: пауза после первой ошибки
+    :param factor: во сколько раз растет пауза
     :param border_sleep_time: граничное время ожидания
+    :param max_attempts: сколько всего попыток сделать, None - без ограничения
+    :param deadline: сколько секунд повторять, None - без ограничения
+    :param resume: для генераторов - функция, которая перед повтором получает
+        аргументы вызова и последний отданный элемент (или None) и меняет аргументы
+        так, чтобы генератор продолжил с этого места. max_attempts для генератора -
+        на весь поток, а deadline отсчитывается заново, если после прошлой ошибки
+        генератор отдал хотя бы один элемент
     :return: результат выполнения функции
     """
+    policy = RetryPolicy(start_sleep_time, factor, border_sleep_time, max_attempts, deadline)
 
-    if start_sleep_time < 0.001:
-        logger.warning("start_sleep_time менее 0.001. Устанавливаем минимум 0.001")
-        start_sleep_time = 0.001
+    def decorator(func):
+        name = func.__qualname__
 
-    if border_sleep_time < 1:
-        logger.warning("border_sleep_time менее 1. Устанавливаем минимум 1")
-        border_sleep_time = 1
+        if inspect.isgeneratorfunction(func):
+            signature = inspect.signature(func)
+
+            @wraps(func)
+            def retry_generator(*args, **kwargs):
+                arguments = signature.bind(*args, **kwargs)
+                attempts = _Attempts(policy, name)
+                last = None
+                progressed = False
+                while True:
+                    try:
+                        for item in func(*arguments.args, **arguments.kwargs):
+                            yield item
+                            last = item
+                            progressed = True
+                        return
+                    except Exception as e:
+                        # Поток, который обрывается после каждого элемента, не должен
+                        # повторяться бесконечно: попытки не сбрасываются продвижением
+                        if progressed:
+                            attempts.restart_deadline()
+                            progressed = False
+                        if not (resume and attempts.retry(e)):
+                            raise
+                        resume(arguments.arguments, last)
+
+            return retry_generator
 
-    def decorator(func):
         @wraps(func)
         def retry(*args, **kwargs):
-            n, t = 0, 0
+            attempts = _Attempts(policy, name)
             while True:
-                t = start_sleep_time * factor**n if t < border_sleep_time else border_sleep_time
-
                 try:
-                    n += 1
-                    sleep(t)
                     return func(*args, **kwargs)
                 except Exception as e:
-                    logger.error(f"Ошибка {e}")
-                    logger.exception(e)
-                    logger.warning(
-                        f"Ожидаем {t} секунд переда перезапуском функции {func.__name__}"
-                    )
+                    if not attempts.retry(e):
+                        raise
 
         return retry
 
@@ -1,37 +1,449 @@
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
 from http import HTTPStatus
+from math import ceil
+from typing import Iterator, Optional
 
+import orjson
+from connections import get_es_client
 from decorators import backoff
-from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk
+from elasticsearch import NotFoundError
+from elasticsearch.helpers import bulk, parallel_bulk, streaming_bulk
+from fingerprints import BaseFingerprintStorage, fingerprint
 from loguru import logger
+from models import BulkDocument
 from pydantic import BaseModel
-from settings import ELASTIC_SEARCH_URL
+from settings import (
+    ES_BULK_CHUNK_SIZE,
+    ES_BULK_MAX_CHUNK_BYTES,
+    ES_BULK_MAX_RETRIES,
+    ES_BULK_MODE,
+    ES_BULK_WORKERS,
+    ES_EXTERNAL_VERSIONS,
+    ES_FORCEMERGE_TIMEOUT_SEC,
+    ES_INDEX_REPLICAS,
+    ES_UPDATE_BY_QUERY_TIMEOUT_SEC,
+    ETL_BATCH_ADAPTIVE,
+)
+
+# Настройки на время полной загрузки: без обновления поиска и без реплик
+BULK_INDEX_SETTINGS = {"refresh_interval": "-1", "number_of_replicas": 0}
+
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+# Сколько point in time живет между страницами чтения индекса
+_SCAN_KEEP_ALIVE = "1m"
+
+
+class BulkLoadError(Exception):
+    pass
+
+
+def external_versions(rows: list[dict]) -> Optional[dict[str, int]]:
+    """Версии документов строк для ES_EXTERNAL_VERSIONS: version строки в микросекундах."""
+    if not ES_EXTERNAL_VERSIONS:
+        return None
+    return {str(row["id"]): (row["version"] - _EPOCH) // timedelta(microseconds=1) for row in rows}
+
+
+def _resume_scan(arguments: dict, page: Optional[list[dict]]) -> None:
+    """Продолжает чтение индекса после последнего отданного документа."""
+    if page:
+        arguments["after"] = page[-1]["_id"]
+
+
+@dataclass
+class BulkResult:
+    indexed: int = 0
+    errors: list[dict] = field(default_factory=list)
+    skipped: int = 0
+    # Объем отправленных тел документов и число отказов 429 для подбора размера пакета
+    payload_bytes: int = 0
+    throttled: int = 0
+    # Документы, не записанные из-за более новой внешней версии в индексе
+    stale_ids: set[str] = field(default_factory=set)
+
+    @property
+    def failed_ids(self) -> set[str]:
+        return {next(iter(error.values()))["_id"] for error in self.errors}
 
 
 class ElasticsearchLoader:
-    @backoff()
+    def __init__(self, fingerprints: Optional[BaseFingerprintStorage] = None):
+        self.client = None
+        self.fingerprints = fingerprints
+        self._existing_indices: set[str] = set()
+
     def create_connection(self):
-        self.client = Elasticsearch(ELASTIC_SEARCH_URL)
+        """Подключает загрузчик к общему клиенту elasticsearch, закрывать его не нужно."""
+        if self.client is None:
+            self.client = get_es_client()
+        # Индекс мог быть удален между циклами ETL
+        self._existing_indices.clear()
         return self.client
 
+    @staticmethod
+    def versioned_index_name(alias: str) -> str:
+        return f"{alias}_{datetime.utcnow():%Y%m%d%H%M%S%f}"
+
     @backoff()
     def _create_index(self, index_name: str, index_params: dict) -> None:
+        # Данные лежат в версионном индексе, а читаются через псевдоним index_name,
+        # чтобы при полной переиндексации индекс можно было подменить атомарно
         self.client.indices.create(
-            index=index_name,
+            index=self.versioned_index_name(index_name),
             ignore=HTTPStatus.BAD_REQUEST,
-            body=index_params,
+            body={**index_params, "aliases": {index_name: {}}},
+        )
+        # Индекс пустой, поэтому ранее загруженные документы нужно отправить заново
+        if self.fingerprints:
+            self.fingerprints.clear(index_name)
+        logger.debug(f"Индекс {index_name} создан")
+
+    @backoff()
+    def create_versioned_index(self, alias: str, index_params: dict) -> str:
+        """Создает новую версию индекса без псевдонима с настройками для быстрой загрузки."""
+        index_name = self.versioned_index_name(alias)
+        settings = {**index_params.get("settings", {}), **BULK_INDEX_SETTINGS}
+        self.client.indices.create(index=index_name, body={**index_params, "settings": settings})
+        if self.fingerprints:
+            self.fingerprints.clear(index_name)
+        logger.info(f"Создан индекс {index_name} для переиндексации {alias}")
+        return index_name
+
+    @backoff()
+    def finalize_index(self, index_name: str, index_params: dict) -> None:
+        """Сливает сегменты загруженного индекса и возвращает ему обычные настройки."""
+        self.client.indices.refresh(index=index_name)
+        # Сливаем до включения реплик, чтобы они копировали уже слитые сегменты
+        self.client.options(request_timeout=ES_FORCEMERGE_TIMEOUT_SEC).indices.forcemerge(
+            index=index_name, max_num_segments=1
+        )
+        settings = index_params.get("settings", {})
+        self.client.indices.put_settings(
+            index=index_name,
+            settings={
+                "refresh_interval": settings.get("refresh_interval", "1s"),
+                "number_of_replicas": settings.get("number_of_replicas", ES_INDEX_REPLICAS),
+            },
+        )
+        logger.info(f"Индекс {index_name} готов к поиску")
+
+    @backoff()
+    def swap_alias(self, alias: str, index_name: str) -> list[str]:
+        """
+        Одним запросом переключает псевдоним alias на index_name и возвращает индексы,
+        на которые он указывал раньше. Индекс, созданный до появления псевдонимов под
+        именем alias, удаляется в том же запросе: иначе псевдоним с таким именем не создать.
+        """
+        actions = [{"add": {"index": index_name, "alias": alias}}]
+        try:
+            old_indices = list(self.client.indices.get_alias(name=alias))
+        except NotFoundError:
+            old_indices = []
+            if self.client.indices.exists(index=alias):
+                actions.append({"remove_index": {"index": alias}})
+        actions.extend(
+            {"remove": {"index": old_index, "alias": alias}}
+            for old_index in old_indices
+            if old_index != index_name
+        )
+        self.client.indices.update_aliases(actions=actions)
+        self._existing_indices.discard(alias)
+        # Хеши описывают содержимое нового индекса, теперь доступного по псевдониму
+        if self.fingerprints:
+            self.fingerprints.move(index_name, alias)
+        logger.info(f"Псевдоним {alias} переключен на {index_name}")
+        return [old_index for old_index in old_indices if old_index != index_name]
+
+    @backoff()
+    def delete_indices(self, index_names: list[str]) -> None:
+        for index_name in index_names:
+            self.client.indices.delete(index=index_name, ignore_unavailable=True)
+            logger.info(f"Индекс {index_name} удален")
+
+    @backoff()
+    def nested_paths(self, index_name: str) -> Optional[set[str]]:
+        """Поля верхнего уровня с типом nested по схеме индекса, None - индекса нет."""
+        try:
+            mappings = self.client.indices.get_mapping(index=index_name)
+        except NotFoundError:
+            return None
+        return {
+            name
+            for index in mappings.values()
+            for name, params in index["mappings"].get("properties", {}).items()
+            if params.get("type") == "nested"
+        }
+
+    @backoff()
+    def update_by_query(self, index_name: str, query: dict, script: dict) -> int:
+        """
+        Обновляет скриптом документы, найденные запросом, и возвращает число
+        измененных. Документы, которые параллельно переписала загрузка, запрос
+        пропускает с конфликтом версий и обновляет при повторе, поэтому скрипт
+        должен давать тот же результат при повторном применении.
+        """
+        updated = 0
+        for _ in range(ES_BULK_MAX_RETRIES + 1):
+            response = self.client.options(
+                request_timeout=ES_UPDATE_BY_QUERY_TIMEOUT_SEC
+            ).update_by_query(
+                index=index_name, query=query, script=script, conflicts="proceed", slices="auto"
+            )
+            if response["failures"]:
+                raise BulkLoadError(
+                    f"Обновление документов {index_name} по запросу завершилось с ошибками: "
+                    f"{response['failures'][:3]}"
+                )
+            updated += response["updated"]
+            if not response["version_conflicts"]:
+                return updated
+            logger.warning(
+                f"Конфликты версий при обновлении {index_name}: {response['version_conflicts']}"
+            )
+        raise BulkLoadError(
+            f"Документы {index_name} не обновлены за {ES_BULK_MAX_RETRIES + 1} попыток "
+            "из-за конфликтов версий"
         )
-        logger.debug("Индекс %s создан", index_name)
+
+    @backoff(resume=_resume_scan)
+    def scan(
+        self,
+        index_name: str,
+        query: dict,
+        fields: list[str],
+        page_size: int = ES_BULK_CHUNK_SIZE,
+        after: Optional[str] = None,
+    ) -> Iterator[list[dict]]:
+        """
+        Читает страницами найденные query документы в порядке id, из _source только
+        поля fields. Страницы берутся из одного point in time через search_after, после
+        временной ошибки чтение продолжается со следующего id в новом point in time.
+        Индекса нет - документов нет.
+        """
+        if after:
+            query = {"bool": {"filter": [query, {"range": {"id": {"gt": after}}}]}}
+        try:
+            pit = self.client.open_point_in_time(index=index_name, keep_alive=_SCAN_KEEP_ALIVE)
+        except NotFoundError:
+            return
+        pit_id = pit["id"]
+        try:
+            search_after = None
+            while True:
+                response = self.client.search(
+                    pit={"id": pit_id, "keep_alive": _SCAN_KEEP_ALIVE},
+                    query=query,
+                    sort=[{"id": "asc"}],
+                    search_after=search_after,
+                    size=page_size,
+                    source=fields,
+                    track_total_hits=False,
+                )
+                pit_id = response.get("pit_id", pit_id)
+                if not (hits := response["hits"]["hits"]):
+                    return
+                yield hits
+                search_after = hits[-1]["sort"]
+        finally:
+            # Истекший point in time elasticsearch удалил сам
+            self.client.options(ignore_status=HTTPStatus.NOT_FOUND).close_point_in_time(id=pit_id)
 
     @backoff()
-    def load_data(self, index_name: str, index_params: dict, data: list[BaseModel]) -> None:
+    def delete_data(self, index_name: str, ids: list[str]) -> int:
+        """Удаляет документы ids и их хеши. Документ, которого уже нет, считается удаленным."""
+        deleted = 0
+        errors = []
+        for ok, item in streaming_bulk(
+            self.client,
+            ({"_op_type": "delete", "_index": index_name, "_id": id_} for id_ in ids),
+            chunk_size=ES_BULK_CHUNK_SIZE,
+            max_retries=ES_BULK_MAX_RETRIES,
+            raise_on_error=False,
+        ):
+            if ok or next(iter(item.values())).get("status") == HTTPStatus.NOT_FOUND:
+                deleted += 1
+            else:
+                errors.append(item)
+        if self.fingerprints:
+            self.fingerprints.remove(index_name, ids)
+        if errors:
+            raise BulkLoadError(f"{len(errors)} документов {index_name} не удалено: {errors[:3]}")
+        return deleted
+
+    def _ensure_index(self, index_name: str, index_params: dict) -> None:
+        if index_name in self._existing_indices:
+            return
+        if not self.client.indices.exists(index=index_name):
+            self._create_index(index_name, index_params)
+        self._existing_indices.add(index_name)
+
+    @backoff()
+    def load_data(
+        self,
+        index_name: str,
+        index_params: dict,
+        data: list[BaseModel | BulkDocument],
+        versions: Optional[dict[str, int]] = None,
+    ) -> BulkResult:
+        """
+        С versions документы пишутся с внешней версией external_gte: документ, который
+        в индексе уже записан с большей версией, не перезаписывается и считается
+        пропущенным. Так устаревшие данные, записанные одним процессом ETL позже
+        более новых, записанных другим, не затирают их.
+        """
         if not self.client:
             raise Exception(
                 "Клиент elasticsearch не инициализирован. Воспользуйтесь create_connection."
             )
 
-        if not self.client.indices.exists(index=index_name):
-            self._create_index(index_name, index_params)
+        self._ensure_index(index_name, index_params)
+
+        documents = [
+            {
+                "_index": index_name,
+                "_id": row.id,
+                # Уже сериализованное тело отправляется в bulk как есть
+                "_source": row.source
+                if isinstance(row, BulkDocument)
+                else orjson.dumps(row.dict()),
+            }
+            for row in data
+        ]
+        if versions:
+            for document in documents:
+                document["_version"] = versions[document["_id"]]
+                document["_version_type"] = "external_gte"
+        if not self.fingerprints:
+            return self._bulk(index_name, documents)
+
+        documents, hashes = self._skip_unchanged(index_name, documents)
+        result = self._bulk(index_name, documents)
+        result.skipped += len(data) - len(documents)
+
+        # Хеш устаревших данных помешал бы отправить их снова, когда они станут актуальными
+        failed_ids = result.failed_ids | result.stale_ids
+        self.fingerprints.save(
+            index_name, {id_: hash_ for id_, hash_ in hashes.items() if id_ not in failed_ids}
+        )
+        return result
+
+    def load_prepared(self, index_name: str, documents: list[dict]) -> BulkResult:
+        """
+        Загружает готовые действия bulk с телами в байтах в ES_BULK_WORKERS потоков,
+        не сравнивая их с сохраненными хешами: загрузка идет в новый индекс. Хеши
+        загруженных документов сохраняются, чтобы ETL не отправлял их повторно.
+        """
+        result = self._parallel_bulk(documents, ES_BULK_CHUNK_SIZE)
+        result.payload_bytes = sum(len(document["_source"]) for document in documents)
+        for error in result.errors:
+            logger.error(f"Документ не загружен в {index_name}: {error}")
+        if self.fingerprints:
+            failed_ids = result.failed_ids
+            self.fingerprints.save(
+                index_name,
+                {
+                    document["_id"]: fingerprint(document["_source"])
+                    for document in documents
+                    if document["_id"] not in failed_ids
+                },
+            )
+        return result
+
+    def _skip_unchanged(self, index_name: str, documents: list[dict]) -> tuple[list[dict], dict]:
+        """
+        Отбрасывает документы, хеш содержимого которых совпадает с сохраненным
+        при прошлой загрузке. Возвращает оставшиеся документы и их новые хеши.
+        """
+        stored = self.fingerprints.get(index_name, [document["_id"] for document in documents])
+        changed, hashes = [], {}
+        for document, stored_hash in zip(documents, stored):
+            hash_ = fingerprint(document["_source"])
+            if hash_ != stored_hash:
+                changed.append(document)
+                hashes[document["_id"]] = hash_
+        return changed, hashes
+
+    def _bulk(self, index_name: str, documents: list[dict]) -> BulkResult:
+        if not documents:
+            return BulkResult()
+        payload_bytes = sum(len(document["_source"]) for document in documents)
+        if ES_BULK_MODE == "bulk":
+            result = BulkResult()
+            # Ошибки разбираются так же, как в остальных режимах: отказ из-за версии
+            # документа - не ошибка
+            result.indexed, errors = bulk(self.client, documents, raise_on_error=False)
+            for item in errors:
+                self._collect(result, False, item)
+        elif ES_BULK_MODE == "parallel":
+            result = self._parallel_bulk(
+                documents,
+                # Загрузчик получает один пакет ETL_BATCH_SIZE, поэтому делим его поровну
+                # между потоками, иначе весь пакет уходит одним запросом
+                chunk_size=max(1, min(ES_BULK_CHUNK_SIZE, ceil(len(documents) / ES_BULK_WORKERS))),
+            )
+        else:
+            # Размер пакета подобран под один bulk-запрос, дробить его незачем
+            chunk_size = max(ES_BULK_CHUNK_SIZE, len(documents)) if ETL_BATCH_ADAPTIVE else None
+            result = self._streaming_bulk(documents, chunk_size)
+        result.payload_bytes = payload_bytes
+
+        for error in result.errors:
+            logger.error(f"Документ не загружен в {index_name}: {error}")
+        return result
+
+    def _streaming_bulk(
+        self, documents: list[dict], chunk_size: Optional[int] = None
+    ) -> BulkResult:
+        # streaming_bulk сам повторяет отклоненные с 429 документы, не трогая успешные
+        result = BulkResult()
+        for ok, item in streaming_bulk(
+            self.client,
+            documents,
+            chunk_size=chunk_size or ES_BULK_CHUNK_SIZE,
+            max_chunk_bytes=ES_BULK_MAX_CHUNK_BYTES,
+            max_retries=ES_BULK_MAX_RETRIES,
+            raise_on_error=False,
+        ):
+            self._collect(result, ok, item)
+        return result
+
+    def _parallel_bulk(self, documents: list[dict], chunk_size: int) -> BulkResult:
+        result = BulkResult()
+        rejected = []
+        documents_by_id = {document["_id"]: document for document in documents}
+        for ok, item in parallel_bulk(
+            self.client,
+            documents,
+            thread_count=ES_BULK_WORKERS,
+            chunk_size=chunk_size,
+            max_chunk_bytes=ES_BULK_MAX_CHUNK_BYTES,
+            raise_on_error=False,
+        ):
+            info = next(iter(item.values()))
+            if not ok and info.get("status") == HTTPStatus.TOO_MANY_REQUESTS:
+                rejected.append(documents_by_id[info["_id"]])
+                continue
+            self._collect(result, ok, item)
+
+        result.throttled = len(rejected)
+        if rejected:
+            logger.warning(f"Повторная отправка {len(rejected)} документов, отклоненных с 429")
+            retried = self._streaming_bulk(rejected)
+            result.indexed += retried.indexed
+            result.errors.extend(retried.errors)
+            result.skipped += retried.skipped
+            result.stale_ids |= retried.stale_ids
+        return result
 
-        documents = [{"_index": index_name, "_id": row.id, "_source": row.dict()} for row in data]
-        bulk(self.client, documents)
+    @staticmethod
+    def _collect(result: BulkResult, ok: bool, item: dict) -> None:
+        if ok:
+            result.indexed += 1
+        elif (info := next(iter(item.values()))).get("status") == HTTPStatus.CONFLICT:
+            # В индексе документ с большей внешней версией: эти данные устарели
+            result.skipped += 1
+            result.stale_ids.add(info["_id"])
+        else:
+            result.errors.append(item)
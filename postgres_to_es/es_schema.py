@@ -1,3 +1,7 @@
+from copy import deepcopy
+
+from settings import ES_INDEX_MAPPING
+
 MOVIES_INDEX = {
     "settings": {
         "refresh_interval": "1s",
@@ -150,3 +154,44 @@ GENRES_INDEX = {
         },
     },
 }
+
+
+# Сортировка сервиса фильмов по умолчанию (ElasticAdapter._make_sort_string)
+SEARCH_INDEX_SORT = {"sort.field": "id", "sort.order": "desc"}
+# Нормализатор подполей raw: фильтр по имени не зависит от регистра
+SEARCH_NORMALIZERS = {"lowercase": {"type": "custom", "filter": ["lowercase"]}}
+
+
+def search_optimized(index: dict) -> dict:
+    """
+    Вариант схемы для запросов сервиса фильмов.
+
+    Индекс упорядочен на диске по ключу сортировки по умолчанию, и запрос без
+    подсчета всех совпадений заканчивается на первых документах каждого сегмента.
+    Индекс с nested полями упорядочить нельзя, поэтому вложенные списки хранятся
+    как object: сервис фильтрует по одному полю вложенного объекта, и результат
+    от этого не меняется. Имена и поля с подполем raw получают нормализованное
+    подполе keyword, по которому фильтр terms читает doc values и кешируется.
+    Фильтр по такому подполю сравнивает имя целиком без учета регистра, а не
+    отдельные слова, как по анализируемому полю.
+    """
+    index = deepcopy(index)
+    settings = index["settings"]
+    settings["index"] = dict(SEARCH_INDEX_SORT)
+    settings["analysis"]["normalizer"] = deepcopy(SEARCH_NORMALIZERS)
+    _optimize_properties(index["mappings"]["properties"])
+    return index
+
+
+def _optimize_properties(properties: dict) -> None:
+    for name, field in properties.items():
+        if field.get("type") == "nested":
+            field["type"] = "object"
+            _optimize_properties(field["properties"])
+        elif field.get("type") == "text" and (name == "name" or "raw" in field.get("fields", {})):
+            field["fields"] = {"raw": {"type": "keyword", "normalizer": "lowercase"}}
+
+
+def index_params(index: dict) -> dict:
+    """Схема индекса в варианте ES_INDEX_MAPPING."""
+    return search_optimized(index) if ES_INDEX_MAPPING == "search" else index
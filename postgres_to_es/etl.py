@@ -1,40 +1,102 @@
-from datetime import datetime
-from time import sleep
-from typing import Any
+from functools import partial
+from random import sample
+from time import monotonic, perf_counter, sleep
+from typing import Any, Callable, Iterator, Optional
 
-from data_transform import DataTransform
-from elasticsearch_loader import ElasticsearchLoader
-from es_schema import GENRES_INDEX, MOVIES_INDEX, PERSONS_INDEX
+import metrics
+from batch_sizing import BatchSizer, get_batch_sizer
+from data_transform import DataTransform, get_transformer
+from dead_letters import get_dead_letters
+from elasticsearch_loader import ElasticsearchLoader, external_versions
+from es_schema import GENRES_INDEX, MOVIES_INDEX, PERSONS_INDEX, index_params
+from fingerprints import BaseFingerprintStorage, get_fingerprint_storage
+from leases import get_leases
+from listener import ChangeListener
 from loguru import logger
 from models import ESFilmworkData, ESGenreData, ESPersonData
-from postgres_extractor import FILMWORKS_QUERY, GENRES_QUERY, PERSONS_QUERY, PostgresExtractor
+from pipeline import DerivedDocuments, StagedPipeline, run_in_parallel
+from postgres_extractor import (
+    FILMWORKS_BY_IDS_QUERY,
+    FILMWORKS_CHANGED_IDS_QUERY,
+    FILMWORKS_LINKS_CHANGED_IDS_QUERY,
+    FILMWORKS_QUERY,
+    GENRE_RENAMES_QUERY,
+    GENRES_BY_IDS_QUERY,
+    GENRES_QUERY,
+    PERSON_RENAMES_QUERY,
+    PERSONS_BY_IDS_QUERY,
+    PERSONS_OWN_CHANGES_QUERY,
+    PERSONS_QUERY,
+    PostgresExtractor,
+    shard_query,
+)
 from pydantic import BaseModel
-from settings import ETL_REPEAT_INTERVAL_TIME_SEC, REDIS_ADAPTER
-from state import RedisStorage, State
+from renames import RenamePropagator
+from requeue import RequeueQueue, get_requeue
+from scheduler import Schedule, Scheduler
+from settings import (
+    ETL_BATCH_SIZE,
+    ETL_DERIVE_PERSONS,
+    ETL_ENSURE_INDEXES,
+    ETL_PIPELINE_MODE,
+    ETL_RENAMES,
+    ETL_REPEAT_INTERVAL_TIME_SEC,
+    ETL_SCHEDULES,
+    ETL_TWO_PHASE_EXTRACT,
+    ETL_WAKEUP_MODE,
+    REDIS_ADAPTER,
+)
+from state import RedisStorage, State, Watermark
+
+
+def persons_of_films(rows: list[dict]) -> set[str]:
+    return {
+        person["id"]
+        for row in rows
+        for role in ("actors", "writers", "directors")
+        for person in row[role]
+    }
 
 
 class ETLHandler:
     PARAMS = {
         "filmwork": {
             "sql_query": FILMWORKS_QUERY,
+            "changed_ids_query": FILMWORKS_CHANGED_IDS_QUERY
+            if ETL_RENAMES == "reindex"
+            else FILMWORKS_LINKS_CHANGED_IDS_QUERY,
+            "by_ids_query": FILMWORKS_BY_IDS_QUERY,
             "elastic_index_name": "movies",
-            "elastic_index_params": MOVIES_INDEX,
+            "elastic_index_params": index_params(MOVIES_INDEX),
             "transform_model": ESFilmworkData,
-            "param_count": 3,
+            "watermark_state_key": "filmwork_watermark",
+            "derives": ["person"],
+            "renames": ["person", "genre"],
+            **ETL_SCHEDULES["filmwork"],
         },
         "person": {
             "sql_query": PERSONS_QUERY,
+            "own_changes_query": PERSONS_OWN_CHANGES_QUERY,
+            "by_ids_query": PERSONS_BY_IDS_QUERY,
+            "touched_ids": persons_of_films,
+            "renames_query": PERSON_RENAMES_QUERY,
+            "renames_state_key": "person_rename_watermark",
             "elastic_index_name": "persons",
-            "elastic_index_params": PERSONS_INDEX,
+            "elastic_index_params": index_params(PERSONS_INDEX),
             "transform_model": ESPersonData,
-            "param_count": 2,
+            "watermark_state_key": "person_watermark",
+            **ETL_SCHEDULES["person"],
         },
         "genre": {
             "sql_query": GENRES_QUERY,
+            "by_ids_query": GENRES_BY_IDS_QUERY,
+            "renames_query": GENRE_RENAMES_QUERY,
+            "renames_state_key": "genre_rename_watermark",
             "elastic_index_name": "genres",
-            "elastic_index_params": GENRES_INDEX,
+            "elastic_index_params": index_params(GENRES_INDEX),
             "transform_model": ESGenreData,
-            "param_count": 1,
+            "watermark_state_key": "genre_watermark",
+            **ETL_SCHEDULES["genre"],
         },
     }
 
@@ -47,43 +109,412 @@ class ETLHandler:
         elastic_index_name: str
         elastic_index_params: dict
         transform_model: Any
-        param_count: int
+        watermark_state_key: str
+        changed_ids_query: Optional[str] = None
+        by_ids_query: Optional[str] = None
+        # Сущности, документы которых в режиме ETL_DERIVE_PERSONS строятся по пакетам этой
+        derives: list[str] = []
+        # Для производной сущности: собственные изменения и идентификаторы, затронутые пакетом
+        own_changes_query: Optional[str] = None
+        touched_ids: Optional[Callable[[list[dict]], set[str]]] = None
+        # Сущности, новые имена которых в режиме ETL_RENAMES=script переносятся в
+        # документы этой скриптом, и для переименованной сущности - выборка имен
+        renames: list[str] = []
+        renames_query: Optional[str] = None
+        renames_state_key: Optional[str] = None
+        interval_sec: float = ETL_REPEAT_INTERVAL_TIME_SEC
+        priority: int = 0
+        budget_sec: Optional[float] = None
+        # Число частей по идентификаторам и для части - watermark сущности целиком,
+        # с которого часть начинает, пока у нее нет своего
+        shards: int = 1
+        base_watermark_state_key: Optional[str] = None
+
+        def extract(
+            self, extractor: PostgresExtractor, watermark: Watermark, batch_sizer: BatchSizer
+        ) -> Iterator:
+            def batch_size() -> int:
+                return batch_sizer.size
+
+            if ETL_DERIVE_PERSONS and self.own_changes_query:
+                return extractor.extract_data(self.own_changes_query, watermark, batch_size)
+            # Запрос одной фазы следит и за переименованиями, которые переносит скрипт
+            two_phase = ETL_TWO_PHASE_EXTRACT or ETL_RENAMES == "script"
+            if two_phase and self.changed_ids_query:
+                return extractor.extract_changed_data(
+                    self.changed_ids_query, self.by_ids_query, watermark, batch_size
+                )
+            return extractor.extract_data(self.sql_query, watermark, batch_size)
+
+        def shard(self, number: int) -> "ETLHandler.ETL":
+            """
+            Часть number из shards: выборки ограничены ее строками, у части свой
+            watermark. Переименования обновляют весь индекс и переносятся первой частью.
+            """
+            if self.shards == 1:
+                return self
+
+            def limit(query: Optional[str]) -> Optional[str]:
+                return query and shard_query(query, number, self.shards)
+
+            return self.copy(
+                update={
+                    "sql_query": limit(self.sql_query),
+                    "changed_ids_query": limit(self.changed_ids_query),
+                    "own_changes_query": limit(self.own_changes_query),
+                    "watermark_state_key": f"{self.watermark_state_key}:{number}/{self.shards}",
+                    "base_watermark_state_key": self.watermark_state_key,
+                    "renames": self.renames if number == 0 else [],
+                }
+            )
+
+        def has_watermark(self, state: State) -> bool:
+            """Сущность уже выбиралась целиком или хотя бы одной из частей."""
+            return any(
+                state.get_watermark(self.shard(number).watermark_state_key)
+                for number in range(self.shards)
+            ) or bool(state.get_watermark(self.watermark_state_key))
+
+        def schedule(self) -> Schedule:
+            return Schedule(self.interval_sec, self.priority, self.budget_sec)
+
+        def derived_etls(self) -> dict[str, "ETLHandler.ETL"]:
+            if not ETL_DERIVE_PERSONS:
+                return {}
+            return {obj_type: ETLHandler.get_etl(obj_type) for obj_type in self.derives}
+
+        def renamed_etls(self) -> dict[str, "ETLHandler.ETL"]:
+            if ETL_RENAMES != "script":
+                return {}
+            return {obj_type: ETLHandler.get_etl(obj_type) for obj_type in self.renames}
+
+
+def get_watermark(state: State, etl: ETLHandler.ETL) -> Watermark:
+    for key in (etl.watermark_state_key, etl.base_watermark_state_key):
+        if key and (watermark := state.get_watermark(key)):
+            return watermark
+    # Продолжаем с общей отметки времени, которую хранили предыдущие версии ETL
+    if last_modified_datetime := state.get_state("last_modified_datetime"):
+        return Watermark(modified=last_modified_datetime)
+    return Watermark()
+
+
+def run_etl(
+    obj_type: str,
+    state: State,
+    extractor: PostgresExtractor,
+    transformer: DataTransform,
+    loader: ElasticsearchLoader,
+    etl: Optional[ETLHandler.ETL] = None,
+    budget_sec: Optional[float] = None,
+    held: Optional[Callable[[], bool]] = None,
+) -> int:
+    """
+    Загружает изменения сущности с сохраненного watermark. С budget_sec выборка
+    прерывается после пакета, на котором бюджет исчерпан, и продолжится со
+    следующего запуска. С held выборка прерывается, как только held сообщит о
+    потере аренды части: пакет, загруженный после потери, в watermark не попадает.
+    """
+    etl = etl or ETLHandler.get_etl(obj_type)
+    watermark = get_watermark(state, etl)
+    logger.info(f"Запуск ETL для {obj_type} с позиции {watermark}")
+
+    count = skipped = 0
+    dead_letters = get_dead_letters()
+    derived = DerivedDocuments(state, etl, extractor, transformer, loader)
+    batch_sizer = get_batch_sizer(obj_type)
+    deadline = monotonic() + budget_sec if budget_sec else None
+    interrupted = False
+    for data in metrics.timed_batches(obj_type, etl.extract(extractor, watermark, batch_sizer)):
+        with metrics.stage_timer(obj_type, "transform"):
+            transformed_data = dead_letters.transform(
+                transformer, obj_type, etl.transform_model, data
+            )
+        with metrics.stage_timer(obj_type, "load"):
+            started = perf_counter()
+            result = loader.load_data(
+                etl.elastic_index_name,
+                etl.elastic_index_params,
+                transformed_data,
+                external_versions(data),
+            )
+            batch_sizer.observe(result, perf_counter() - started)
+        result = dead_letters.divert(obj_type, data, result)
+        metrics.observe_load(obj_type, data, result)
+        count += result.indexed
+        skipped += result.skipped
+        logger.info(f"Загружено всего {count} записей для {obj_type}")
+        if held and not held():
+            logger.warning(f"ETL для {obj_type} прерван: аренда части потеряна")
+            interrupted = True
+            break
+        derived.save(data, result)
+
+        if deadline and monotonic() > deadline:
+            logger.info(f"ETL для {obj_type} прерван по бюджету {budget_sec} с")
+            interrupted = True
+            break
+    derived.flush()
+    if not interrupted:
+        metrics.observe_success(obj_type)
+    logger.info(f"ETL для {obj_type}: отправлено {count}, без изменений пропущено {skipped}")
+    return count
+
+
+def run_renames(
+    obj_type: str,
+    state: State,
+    extractor: PostgresExtractor,
+    loader: ElasticsearchLoader,
+    etl: Optional[ETLHandler.ETL] = None,
+) -> int:
+    """
+    Переносит в документы obj_type имена сущностей ETL.renames, измененных с их
+    watermark переименований. Запускается перед выборкой самой сущности.
+    """
+    etl = etl or ETLHandler.get_etl(obj_type)
+    renamed_etls = etl.renamed_etls()
+    if not renamed_etls:
+        return 0
+
+    count = 0
+    propagator = RenamePropagator(loader, etl.elastic_index_name)
+    for renamed_type, renamed in renamed_etls.items():
+        watermark = state.get_watermark(renamed.renames_state_key)
+        if watermark is None:
+            # До включения режима переименования переносила выборка самой сущности,
+            # и до ее текущей позиции они уже в индексе. Первая выборка с нуля возьмет
+            # все имена из Postgres, переносить нужно только более поздние
+            position = get_watermark(state, etl)
+            watermark = Watermark(
+                modified=position.modified
+                if position != Watermark()
+                else extractor.get_safe_cutoff()
+            )
+        for data in extractor.extract_data(renamed.renames_query, watermark):
+            updated = propagator.propagate(
+                renamed_type, {str(row["id"]): row["name"] for row in data}
+            )
+            metrics.DOCUMENTS.labels(obj_type, "renamed").inc(updated)
+            state.set_watermark(
+                renamed.renames_state_key,
+                Watermark(modified=data[-1]["modified"], id=data[-1]["id"]),
+            )
+            count += updated
+    return count
+
+
+def run_requeued(
+    obj_type: str,
+    requeue: RequeueQueue,
+    extractor: PostgresExtractor,
+    transformer: DataTransform,
+    loader: ElasticsearchLoader,
+    etl: Optional[ETLHandler.ETL] = None,
+) -> int:
+    """
+    Загружает заново строки из очереди requeue независимо от watermark. Забранные
+    из очереди идентификаторы, которые не удалось загрузить, возвращаются в нее
+    до следующего запуска. Документы, которые индекс отклонил как устаревшие,
+    считаются незагруженными и в очередь не возвращаются: повтор с той же версией
+    снова будет отклонен.
+    """
+    etl = etl or ETLHandler.get_etl(obj_type)
+    dead_letters = get_dead_letters()
+    count = 0
+    while ids := requeue.pop(obj_type, ETL_BATCH_SIZE):
+        try:
+            rows = extractor.extract_by_ids(etl.by_ids_query, ids)
+            documents = dead_letters.transform(transformer, obj_type, etl.transform_model, rows)
+            result = dead_letters.divert(
+                obj_type,
+                rows,
+                loader.load_data(
+                    etl.elastic_index_name,
+                    etl.elastic_index_params,
+                    documents,
+                    external_versions(rows),
+                ),
+            )
+        except Exception:
+            requeue.add(obj_type, ids)
+            raise
+        metrics.DOCUMENTS.labels(obj_type, "requeued").inc(result.indexed)
+        count += result.indexed
+        if result.stale_ids:
+            metrics.DOCUMENTS.labels(obj_type, "failed").inc(len(result.stale_ids))
+            logger.warning(
+                f"{len(result.stale_ids)} строк {obj_type} из очереди не загружено: в индексе "
+                f"документы с более новой версией, например {sorted(result.stale_ids)[:3]}"
+            )
+        if result.errors:
+            requeue.add(obj_type, list(result.failed_ids))
+            logger.warning(
+                f"{len(result.errors)} строк {obj_type} из очереди не загружено, "
+                "они вернулись в очередь"
+            )
+            break
+    if count:
+        logger.info(f"Загружено заново по очереди {count} документов {obj_type}")
+    return count
+
+
+def run_staged_etl(
+    obj_type: str,
+    state: State,
+    transformer: DataTransform,
+    fingerprints: Optional[BaseFingerprintStorage] = None,
+    budget_sec: Optional[float] = None,
+    etl: Optional[ETLHandler.ETL] = None,
+    requeue: Optional[RequeueQueue] = None,
+    held: Optional[Callable[[], bool]] = None,
+) -> int:
+    """
+    Конвейер ETL сущности. С requeue перед выборкой загружаются строки из очереди,
+    held прерывает конвейер при потере аренды части, как в run_etl.
+    """
+    etl = etl or ETLHandler.get_etl(obj_type)
+    watermark = get_watermark(state, etl)
+    logger.info(f"Запуск конвейера ETL для {obj_type} с позиции {watermark}")
+
+    # У каждого конвейера свои подключения: соединение psycopg2 нельзя
+    # использовать из нескольких потоков одновременно
+    extractor = PostgresExtractor()
+    loader = ElasticsearchLoader(fingerprints)
+    try:
+        extractor.create_connection()
+        loader.create_connection()
+        run_renames(obj_type, state, extractor, loader, etl)
+        if requeue:
+            run_requeued(obj_type, requeue, extractor, transformer, loader, etl)
+        pipeline = StagedPipeline(obj_type, etl, state, extractor, transformer, loader)
+        return pipeline.run(watermark, budget_sec, held)
+    finally:
+        extractor.close()
+
+
+def shard_unit(obj_type: str, number: int, shards: int) -> str:
+    """Имя части работы ETL для аренды."""
+    return f"{obj_type}:{number}/{shards}" if shards > 1 else obj_type
+
+
+def wait_for_schedule(scheduler: Scheduler, listener: Optional[ChangeListener]) -> None:
+    """Ждет ближайшего запуска по расписанию, а с listener - и уведомлений об изменениях."""
+    timeout = scheduler.sleep_time()
+    if listener:
+        scheduler.notify(listener.wait(timeout))
+    else:
+        sleep(timeout)
 
 
 if __name__ == "__main__":
     state = State(RedisStorage(REDIS_ADAPTER))
 
     extractor = PostgresExtractor()
-    transformer = DataTransform()
-    loader = ElasticsearchLoader()
+    transformer = get_transformer()
+    fingerprints = get_fingerprint_storage()
+    loader = ElasticsearchLoader(fingerprints)
 
     etl_for = ("filmwork", "person", "genre")
+    scheduler = Scheduler(
+        {obj_type: ETLHandler.get_etl(obj_type).schedule() for obj_type in etl_for}
+    )
+
+    if ETL_ENSURE_INDEXES:
+        extractor.ensure_indexes()
+
+    metrics.start_exporter()
+
+    leases = get_leases()
+    requeue = get_requeue()
+
+    listener = None
+    if ETL_WAKEUP_MODE == "notify":
+        listener = ChangeListener()
+        listener.create_connection()
+
+    def run_shard(
+        obj_type: str,
+        etl: ETLHandler.ETL,
+        budget_sec: Optional[float],
+        held: Optional[Callable[[], bool]],
+    ) -> int:
+        if ETL_PIPELINE_MODE == "staged":
+            return run_staged_etl(
+                obj_type,
+                state,
+                transformer,
+                fingerprints,
+                budget_sec=budget_sec,
+                etl=etl,
+                requeue=requeue,
+                held=held,
+            )
+        run_renames(obj_type, state, extractor, loader, etl)
+        run_requeued(obj_type, requeue, extractor, transformer, loader, etl)
+        return run_etl(
+            obj_type,
+            state,
+            extractor,
+            transformer,
+            loader,
+            etl=etl,
+            budget_sec=budget_sec,
+            held=held,
+        )
+
+    def run_scheduled(obj_type: str) -> int:
+        schedule = scheduler.schedules[obj_type]
+        started = monotonic()
+        etl = ETLHandler.get_etl(obj_type)
+        count = 0
+        try:
+            # Процессы перебирают части в разном порядке и реже сталкиваются на арендах
+            for number in sample(range(etl.shards), etl.shards):
+                unit = shard_unit(obj_type, number, etl.shards)
+                if leases and not leases.acquire(unit):
+                    logger.debug(f"Часть {unit} обрабатывает другой процесс")
+                    continue
+                held = partial(leases.held, unit) if leases else None
+                try:
+                    count += run_shard(obj_type, etl.shard(number), schedule.budget_sec, held)
+                finally:
+                    if leases:
+                        if not leases.held(unit):
+                            # Документы защищены внешними версиями, а watermark части
+                            # после потери аренды не сдвигался: строки выберутся повторно
+                            logger.warning(f"Часть {unit} прервана после потери аренды")
+                        leases.release(unit)
+            return count
+        finally:
+            scheduler.done(obj_type, started)
 
     while True:
+        if not (obj_types := scheduler.due()):
+            try:
+                wait_for_schedule(scheduler, listener)
+            except Exception as e:
+                # Без уведомлений ETL продолжает работать по расписанию, а соединение
+                # для них восстанавливается при следующем ожидании
+                logger.error(f"Ожидание уведомлений прервано: {e}")
+                sleep(scheduler.sleep_time())
+            continue
         try:
-            logger.info("Запуск ETL PostgreSQL to Elasticsearch")
-
-            with extractor.create_connection(), loader.create_connection():
-                last_modified_datetime = state.get_state("last_modified_datetime") or datetime.min
-
-                for obj_type in etl_for:
-                    etl = ETLHandler.get_etl(obj_type)
-                    count = 0
-                    for data in extractor.extract_data(
-                        etl.sql_query, etl.param_count, last_modified_datetime
-                    ):
-                        transformed_data = transformer.validate_and_transform(
-                            etl.transform_model, data
-                        )
-                        loader.load_data(
-                            etl.elastic_index_name, etl.elastic_index_params, transformed_data
-                        )
-                        count += len(transformed_data)
-                        logger.info(f"Загружено всего {count} записей для {obj_type}")
-
-                state.set_state("last_modified_datetime", datetime.now().isoformat())
+            logger.info(f"Запуск ETL PostgreSQL to Elasticsearch для {', '.join(obj_types)}")
+
+            if ETL_PIPELINE_MODE == "staged":
+                run_in_parallel(obj_types, run_scheduled)
+                continue
+
+            try:
+                extractor.create_connection()
+                loader.create_connection()
+                for obj_type in obj_types:
+                    run_scheduled(obj_type)
+            finally:
+                extractor.close()
 
         except Exception as e:
             logger.error(e)
         finally:
-            sleep(ETL_REPEAT_INTERVAL_TIME_SEC)
+            metrics.flush()
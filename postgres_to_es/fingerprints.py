@@ -0,0 +1,129 @@
+import abc
+import sqlite3
+from hashlib import blake2b
+from threading import Lock
+from typing import Optional
+
+import redis
+from decorators import backoff
+from settings import ETL_FINGERPRINTS, ETL_FINGERPRINTS_FILE, REDIS_ADAPTER
+
+
+def fingerprint(source: bytes) -> str:
+    return blake2b(source, digest_size=16).hexdigest()
+
+
+class BaseFingerprintStorage(metaclass=abc.ABCMeta):
+    """Хеши содержимого документов, уже загруженных в индекс."""
+
+    @abc.abstractmethod
+    def get(self, index_name: str, ids: list[str]) -> list[Optional[str]]:
+        pass
+
+    @abc.abstractmethod
+    def save(self, index_name: str, fingerprints: dict[str, str]) -> None:
+        pass
+
+    @abc.abstractmethod
+    def remove(self, index_name: str, ids: list[str]) -> None:
+        """Забывает хеши документов, которые нужно отправить снова или которых больше нет."""
+
+    @abc.abstractmethod
+    def clear(self, index_name: str) -> None:
+        pass
+
+    @abc.abstractmethod
+    def move(self, index_name: str, new_index_name: str) -> None:
+        """Переносит хеши на другое имя индекса, заменяя прежние."""
+
+
+class RedisFingerprintStorage(BaseFingerprintStorage):
+    def __init__(self, redis_adapter: redis.Redis):
+        self.redis_adapter = redis_adapter
+
+    @staticmethod
+    def _key(index_name: str) -> str:
+        return f"fingerprints:{index_name}"
+
+    @backoff()
+    def get(self, index_name: str, ids: list[str]) -> list[Optional[str]]:
+        return self.redis_adapter.hmget(self._key(index_name), ids) if ids else []
+
+    @backoff()
+    def save(self, index_name: str, fingerprints: dict[str, str]) -> None:
+        if fingerprints:
+            self.redis_adapter.hset(self._key(index_name), mapping=fingerprints)
+
+    @backoff()
+    def remove(self, index_name: str, ids: list[str]) -> None:
+        if ids:
+            self.redis_adapter.hdel(self._key(index_name), *ids)
+
+    @backoff()
+    def clear(self, index_name: str) -> None:
+        self.redis_adapter.delete(self._key(index_name))
+
+    @backoff()
+    def move(self, index_name: str, new_index_name: str) -> None:
+        if self.redis_adapter.exists(self._key(index_name)):
+            self.redis_adapter.rename(self._key(index_name), self._key(new_index_name))
+        else:
+            self.clear(new_index_name)
+
+
+class SqliteFingerprintStorage(BaseFingerprintStorage):
+    def __init__(self, file_path: Optional[str] = "./fingerprints.db"):
+        self._lock = Lock()
+        # Хранилище используют загрузчики из потоков разных сущностей
+        self.connection = sqlite3.connect(file_path, check_same_thread=False)
+        with self._lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS fingerprints ("
+                "index_name TEXT, id TEXT, hash TEXT, PRIMARY KEY (index_name, id))"
+            )
+
+    def get(self, index_name: str, ids: list[str]) -> list[Optional[str]]:
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT id, hash FROM fingerprints "
+                f"WHERE index_name = ? AND id IN ({', '.join('?' * len(ids))})",
+                [index_name, *ids],
+            ).fetchall()
+        hashes = dict(rows)
+        return [hashes.get(id_) for id_ in ids]
+
+    def save(self, index_name: str, fingerprints: dict[str, str]) -> None:
+        with self._lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?)",
+                [(index_name, id_, hash_) for id_, hash_ in fingerprints.items()],
+            )
+
+    def remove(self, index_name: str, ids: list[str]) -> None:
+        with self._lock, self.connection:
+            self.connection.executemany(
+                "DELETE FROM fingerprints WHERE index_name = ? AND id = ?",
+                [(index_name, id_) for id_ in ids],
+            )
+
+    def clear(self, index_name: str) -> None:
+        with self._lock, self.connection:
+            self.connection.execute("DELETE FROM fingerprints WHERE index_name = ?", [index_name])
+
+    def move(self, index_name: str, new_index_name: str) -> None:
+        with self._lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM fingerprints WHERE index_name = ?", [new_index_name]
+            )
+            self.connection.execute(
+                "UPDATE fingerprints SET index_name = ? WHERE index_name = ?",
+                [new_index_name, index_name],
+            )
+
+
+def get_fingerprint_storage() -> Optional[BaseFingerprintStorage]:
+    if ETL_FINGERPRINTS == "redis":
+        return RedisFingerprintStorage(REDIS_ADAPTER)
+    if ETL_FINGERPRINTS == "file":
+        return SqliteFingerprintStorage(ETL_FINGERPRINTS_FILE)
+    return None
@@ -0,0 +1,11 @@
+-- Индексы, на которые опирается двухфазное извлечение фильмов (ETL_TWO_PHASE_EXTRACT).
+-- В db/movies_database.sql они уже есть, для существующих баз скрипт идемпотентен:
+--     psql -d <db> -f postgres_to_es/indexes.sql
+-- Эти же запросы ETL выполняет при старте, если ETL_ENSURE_INDEXES=True.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS film_work_modified_idx ON content.film_work USING btree (modified);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS person_modified_idx ON content.person USING btree (modified);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS genre_modified_idx ON content.genre USING btree (modified);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS person_film_work_modified_idx ON content.person_film_work USING btree (modified);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS genre_film_work_modified_idx ON content.genre_film_work USING btree (modified);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS person_film_work_person_idx ON content.person_film_work USING btree (person_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS genre_film_work_genre_idx ON content.genre_film_work USING btree (genre_id);
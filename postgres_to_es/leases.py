@@ -0,0 +1,112 @@
+from threading import Event, Lock, Thread
+from typing import Optional
+
+import redis
+from decorators import backoff
+from loguru import logger
+from settings import ETL_LEASE_TTL_SEC, ETL_WORKER_ID, ETL_WORKERS_MODE, REDIS_ADAPTER
+
+# Продлить или снять аренду может только ее владелец: аренду, которую после
+# истечения срока забрал другой процесс, прежний владелец не трогает
+_RENEW_SCRIPT = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('pexpire', KEYS[1], ARGV[2])
+    end
+    return 0
+"""
+_RELEASE_SCRIPT = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('del', KEYS[1])
+    end
+    return 0
+"""
+
+
+class LeaseManager:
+    """
+    Аренды частей работы ETL между несколькими процессами. Аренда - ключ Redis
+    lease:<часть> с идентификатором процесса и сроком ETL_LEASE_TTL_SEC. Пока
+    процесс жив, фоновый поток продлевает его аренды каждую треть срока. Аренду
+    упавшего или зависшего процесса после истечения срока получает другой.
+    """
+
+    def __init__(
+        self,
+        redis_adapter: redis.Redis,
+        worker_id: str = ETL_WORKER_ID,
+        ttl_sec: float = ETL_LEASE_TTL_SEC,
+    ):
+        self.redis_adapter = redis_adapter
+        self.worker_id = worker_id
+        self.ttl_ms = int(ttl_sec * 1000)
+        self._renew = redis_adapter.register_script(_RENEW_SCRIPT)
+        self._release = redis_adapter.register_script(_RELEASE_SCRIPT)
+        self._held: set[str] = set()
+        self._lock = Lock()
+        self._stop = Event()
+        self._heartbeat: Optional[Thread] = None
+
+    @staticmethod
+    def _key(unit: str) -> str:
+        return f"lease:{unit}"
+
+    @backoff()
+    def acquire(self, unit: str) -> bool:
+        if not self.redis_adapter.set(self._key(unit), self.worker_id, nx=True, px=self.ttl_ms):
+            return False
+        with self._lock:
+            self._held.add(unit)
+        self._start_heartbeat()
+        logger.info(f"Процесс {self.worker_id} получил аренду {unit}")
+        return True
+
+    @backoff()
+    def release(self, unit: str) -> None:
+        with self._lock:
+            self._held.discard(unit)
+        self._release(keys=[self._key(unit)], args=[self.worker_id])
+
+    def held(self, unit: str) -> bool:
+        """Аренда не потеряна: продление не опоздало и ее не забрал другой процесс."""
+        with self._lock:
+            return unit in self._held
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._heartbeat:
+            self._heartbeat.join()
+        with self._lock:
+            units = list(self._held)
+        for unit in units:
+            self.release(unit)
+
+    def _start_heartbeat(self) -> None:
+        # Аренды берут потоки разных сущностей, фоновый поток нужен один
+        with self._lock:
+            if self._heartbeat is None:
+                self._heartbeat = Thread(target=self._run_heartbeat, name="leases", daemon=True)
+                self._heartbeat.start()
+
+    def _run_heartbeat(self) -> None:
+        while not self._stop.wait(self.ttl_ms / 3000):
+            with self._lock:
+                units = list(self._held)
+            for unit in units:
+                try:
+                    renewed = self._renew(
+                        keys=[self._key(unit)], args=[self.worker_id, self.ttl_ms]
+                    )
+                except redis.RedisError as e:
+                    # Аренда истечет сама, если Redis недоступен дольше ее срока
+                    logger.warning(f"Аренда {unit} не продлена: {e!r}")
+                    continue
+                if not renewed:
+                    with self._lock:
+                        self._held.discard(unit)
+                    logger.error(f"Аренда {unit} потеряна процессом {self.worker_id}")
+
+
+def get_leases() -> Optional[LeaseManager]:
+    if ETL_WORKERS_MODE == "leases":
+        return LeaseManager(REDIS_ADAPTER)
+    return None
@@ -0,0 +1,108 @@
+import json
+import os
+import select
+from collections import defaultdict
+from time import monotonic
+
+import psycopg2
+from decorators import backoff
+from loguru import logger
+from settings import (
+    ETL_INSTALL_TRIGGERS,
+    ETL_NOTIFY_DEBOUNCE_SEC,
+    ETL_NOTIFY_MAX_DELAY_SEC,
+    POSTGRES_CONNECTION_SETTINGS,
+)
+
+CHANNEL = "etl_changes"
+TRIGGERS_SCRIPT = os.path.join(os.path.dirname(__file__), "triggers.sql")
+
+# (таблица, колонка из уведомления) -> сущность, документ которой с этим id изменился
+ID_ENTITIES = {
+    ("film_work", "id"): "filmwork",
+    ("person", "id"): "person",
+    ("genre", "id"): "genre",
+    ("person_film_work", "film_work_id"): "filmwork",
+    ("person_film_work", "person_id"): "person",
+    ("genre_film_work", "film_work_id"): "filmwork",
+}
+# Сущности, документы которых изменение таблицы затрагивает через связи
+RELATED_ENTITIES = {
+    "film_work": ("person",),
+    "person": ("filmwork",),
+    "genre": ("filmwork",),
+}
+ENTITIES = tuple(dict.fromkeys(ID_ENTITIES.values()))
+
+
+class ChangeListener:
+    """
+    Слушает уведомления триггеров из triggers.sql и собирает их в пакеты: после
+    первого уведомления ждет, пока поток не затихнет на ETL_NOTIFY_DEBOUNCE_SEC,
+    но не дольше ETL_NOTIFY_MAX_DELAY_SEC, и отдает идентификаторы, сгруппированные
+    по сущностям. Сами данные ETL по-прежнему выбирает по watermark.
+    """
+
+    def __init__(self):
+        self.connection = None
+
+    @backoff()
+    def create_connection(self):
+        self.connection = psycopg2.connect(**POSTGRES_CONNECTION_SETTINGS)
+        # Уведомления доставляются только вне транзакции
+        self.connection.autocommit = True
+        with self.connection.cursor() as cursor:
+            if ETL_INSTALL_TRIGGERS:
+                with open(TRIGGERS_SCRIPT) as script:
+                    cursor.execute(script.read())
+            cursor.execute(f"LISTEN {CHANNEL}")
+        logger.info(f"Ожидание изменений в канале {CHANNEL}")
+        return self.connection
+
+    def close(self) -> None:
+        if self.connection and not self.connection.closed:
+            self.connection.close()
+
+    def wait(self, timeout: float) -> dict[str, set[str]]:
+        """
+        Ждет изменений не дольше timeout. Возвращает измененные идентификаторы по
+        сущностям, пустой словарь, если изменений не было, и все сущности, если
+        соединение было потеряно и уведомления могли пропасть.
+        """
+        changes: dict[str, set[str]] = defaultdict(set)
+        try:
+            if not self._poll(changes, timeout):
+                return {}
+            deadline = monotonic() + ETL_NOTIFY_MAX_DELAY_SEC
+            while (remaining := deadline - monotonic()) > 0:
+                if not self._poll(changes, min(ETL_NOTIFY_DEBOUNCE_SEC, remaining)):
+                    break
+        except (psycopg2.Error, OSError) as e:
+            logger.error(f"Соединение для уведомлений потеряно: {e}")
+            self.close()
+            self.create_connection()
+            return {entity: set() for entity in ENTITIES}
+
+        summary = ", ".join(f"{entity} ({len(ids)} id)" for entity, ids in changes.items())
+        logger.debug(f"Изменения: {summary}")
+        return dict(changes)
+
+    def _poll(self, changes: dict[str, set[str]], timeout: float) -> bool:
+        """Добавляет в changes уведомления, пришедшие за timeout. Возвращает, были ли они."""
+        if not self.connection.notifies:
+            readable, _, _ = select.select([self.connection], [], [], timeout)
+            if not readable:
+                return False
+            self.connection.poll()
+
+        received = bool(self.connection.notifies)
+        while self.connection.notifies:
+            notify = self.connection.notifies.pop(0)
+            payload = json.loads(notify.payload)
+            for column, value in payload["ids"].items():
+                entity = ID_ENTITIES.get((payload["table"], column))
+                if entity and value:
+                    changes[entity].add(value)
+            for entity in RELATED_ENTITIES.get(payload["table"], ()):
+                changes.setdefault(entity, set())
+        return received
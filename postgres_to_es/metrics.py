@@ -0,0 +1,154 @@
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from time import perf_counter, time
+from typing import Iterable, Iterator
+
+from connections import connection_stats, opened_connections
+from decorators import retry_counters
+from elasticsearch_loader import BulkResult
+from loguru import logger
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    start_http_server,
+    write_to_textfile,
+)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from settings import ETL_METRICS_MODE, ETL_METRICS_PORT, ETL_METRICS_TEXTFILE
+
+REGISTRY = CollectorRegistry()
+
+ROWS = Counter("etl_rows", "Строки, выбранные из Postgres", ["entity"], registry=REGISTRY)
+BATCHES = Counter("etl_batches", "Пакеты, прошедшие все этапы", ["entity"], registry=REGISTRY)
+DOCUMENTS = Counter(
+    "etl_documents",
+    "Документы по результату загрузки: indexed, skipped, failed, renamed - обновлены "
+    "скриптом или requeued - загружены заново по очереди requeue",
+    ["entity", "result"],
+    registry=REGISTRY,
+)
+STAGE_SECONDS = Histogram(
+    "etl_stage_seconds",
+    "Время обработки одного пакета на этапе extract, transform или load",
+    ["entity", "stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+    registry=REGISTRY,
+)
+WATERMARK_LAG = Gauge(
+    "etl_watermark_lag_seconds",
+    "Насколько последняя загруженная строка старше текущего времени, 0 - ETL догнал Postgres",
+    ["entity"],
+    registry=REGISTRY,
+)
+BATCH_SIZE = Gauge(
+    "etl_batch_size", "Текущий размер пакета извлечения в строках", ["entity"], registry=REGISTRY
+)
+THROTTLED = Counter(
+    "etl_bulk_throttled",
+    "Документы, отклоненные elasticsearch с 429 и уменьшившие пакет",
+    ["entity"],
+    registry=REGISTRY,
+)
+DEAD_LETTERS = Counter(
+    "etl_dead_letters",
+    "Строки, отложенные в dead letter: transform - не прошли проверку, load - отклонены",
+    ["entity", "stage"],
+    registry=REGISTRY,
+)
+LAST_SUCCESS = Gauge(
+    "etl_last_success_timestamp_seconds",
+    "Время последнего запуска ETL, завершившегося без ошибок",
+    ["entity"],
+    registry=REGISTRY,
+)
+
+
+class _RetryCollector:
+    def collect(self):
+        family = CounterMetricFamily(
+            "etl_retries",
+            "Повторы после ошибок по функциям: retry, giveup или permanent",
+            labels=["function", "outcome"],
+        )
+        for (function, outcome), value in retry_counters().items():
+            family.add_metric([function, outcome], value)
+        yield family
+
+
+class _ConnectionCollector:
+    def collect(self):
+        current = GaugeMetricFamily(
+            "etl_connections",
+            "Соединения ETL по бэкендам: in_use - выданы, idle - ждут в пуле",
+            labels=["backend", "state"],
+        )
+        for (backend, state), value in connection_stats().items():
+            current.add_metric([backend, state], value)
+        yield current
+
+        opened = CounterMetricFamily(
+            "etl_connections_opened",
+            "Соединения, открытые с запуска ETL",
+            labels=["backend"],
+        )
+        for backend, value in opened_connections().items():
+            opened.add_metric([backend], value)
+        yield opened
+
+
+REGISTRY.register(_RetryCollector())
+REGISTRY.register(_ConnectionCollector())
+
+
+def start_exporter() -> None:
+    if ETL_METRICS_MODE == "http":
+        start_http_server(ETL_METRICS_PORT, registry=REGISTRY)
+        logger.info(f"Метрики ETL доступны на порту {ETL_METRICS_PORT}")
+
+
+def flush() -> None:
+    """Записывает метрики в файл для textfile-коллектора node_exporter."""
+    if ETL_METRICS_MODE == "textfile":
+        write_to_textfile(ETL_METRICS_TEXTFILE, REGISTRY)
+
+
+@contextmanager
+def stage_timer(entity: str, stage: str) -> Iterator[None]:
+    started = perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(entity, stage).observe(perf_counter() - started)
+
+
+def timed_batches(entity: str, batches: Iterable[list[dict]]) -> Iterator[list[dict]]:
+    """Замеряет выборку каждого пакета: у генератора extract нет одной точки вызова."""
+    iterator = iter(batches)
+    try:
+        while True:
+            with stage_timer(entity, "extract"):
+                batch = next(iterator, None)
+            if batch is None:
+                return
+            ROWS.labels(entity).inc(len(batch))
+            yield batch
+    finally:
+        # Закрываем генератор извлечения сразу, чтобы освободить серверный курсор
+        getattr(iterator, "close", lambda: None)()
+
+
+def observe_load(entity: str, data: list[dict], result: BulkResult) -> None:
+    BATCHES.labels(entity).inc()
+    DOCUMENTS.labels(entity, "indexed").inc(result.indexed)
+    DOCUMENTS.labels(entity, "skipped").inc(result.skipped)
+    DOCUMENTS.labels(entity, "failed").inc(len(result.errors))
+    if data:
+        lag = datetime.now(timezone.utc) - data[-1]["modified"]
+        WATERMARK_LAG.labels(entity).set(max(lag.total_seconds(), 0))
+
+
+def observe_success(entity: str) -> None:
+    WATERMARK_LAG.labels(entity).set(0)
+    LAST_SUCCESS.labels(entity).set(time())
@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import NamedTuple, Optional
 
 from pydantic import BaseModel
 
@@ -42,3 +42,10 @@ class ESGenreData(BaseModel):
     id: str
     name: str
     description: str | None
+
+
+class BulkDocument(NamedTuple):
+    """Документ, уже сериализованный для тела bulk-запроса."""
+
+    id: str
+    source: bytes
@@ -0,0 +1,431 @@
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+from time import monotonic
+from typing import Any, Callable, Iterable, Optional
+
+import metrics
+from batch_sizing import get_batch_sizer
+from data_transform import DataTransform
+from dead_letters import get_dead_letters
+from elasticsearch_loader import BulkLoadError, BulkResult, ElasticsearchLoader, external_versions
+from loguru import logger
+from postgres_extractor import PostgresExtractor
+from settings import (
+    ETL_BATCH_SIZE,
+    ETL_DERIVE_FLUSH_SIZE,
+    ETL_PIPELINE_STATS_INTERVAL_SEC,
+    ETL_QUEUE_SIZE,
+)
+from state import State, Watermark
+
+_DONE = object()
+_POLL_INTERVAL_SEC = 0.5
+
+
+@dataclass
+class StageStats:
+    name: str
+    items: int = 0
+    busy_sec: float = 0
+    idle_sec: float = 0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.name}: пакетов {self.items}, работа {self.busy_sec:.2f} с, "
+            f"ожидание {self.idle_sec:.2f} с"
+        )
+
+
+@dataclass
+class QueueStats:
+    """
+    Глубина очереди между этапами. Почти всегда полная очередь означает, что
+    не успевает следующий этап, почти всегда пустая - что не успевает предыдущий.
+    """
+
+    name: str
+    samples: int = 0
+    depth_sum: int = 0
+    depth_max: int = 0
+
+    def observe(self, depth: int) -> None:
+        self.samples += 1
+        self.depth_sum += depth
+        self.depth_max = max(self.depth_max, depth)
+
+    @property
+    def depth_avg(self) -> float:
+        return self.depth_sum / self.samples if self.samples else 0
+
+    def __str__(self) -> str:
+        return f"очередь {self.name}: глубина avg={self.depth_avg:.1f} max={self.depth_max}"
+
+
+class StagedPipeline:
+    """
+    Конвейер extract -> transform -> load, этапы которого работают одновременно
+    в отдельных потоках и связаны ограниченными очередями. Заполненная очередь
+    притормаживает предыдущий этап, поэтому в памяти не больше ETL_QUEUE_SIZE
+    пакетов на каждый стык.
+    """
+
+    def __init__(
+        self,
+        obj_type: str,
+        etl: Any,
+        state: State,
+        extractor: PostgresExtractor,
+        transformer: DataTransform,
+        loader: ElasticsearchLoader,
+        queue_size: int = ETL_QUEUE_SIZE,
+    ):
+        self.obj_type = obj_type
+        self.etl = etl
+        self.state = state
+        self.extractor = extractor
+        self.transformer = transformer
+        self.loader = loader
+        self.batch_sizer = get_batch_sizer(obj_type)
+        self.dead_letters = get_dead_letters()
+
+        self.extracted: Queue = Queue(maxsize=queue_size)
+        self.transformed: Queue = Queue(maxsize=queue_size)
+        self.stop = Event()
+        self.errors: list[Exception] = []
+
+        self.stats = {
+            "extract": StageStats("extract"),
+            "transform": StageStats("transform"),
+            "load": StageStats("load"),
+        }
+        self.queue_stats = {
+            id(self.extracted): QueueStats("extract -> transform"),
+            id(self.transformed): QueueStats("transform -> load"),
+        }
+        self.done = Event()
+        self.deadline: Optional[float] = None
+        self.held: Optional[Callable[[], bool]] = None
+
+    def run(
+        self,
+        watermark: Watermark,
+        budget_sec: Optional[float] = None,
+        held: Optional[Callable[[], bool]] = None,
+    ) -> int:
+        """
+        С budget_sec конвейер останавливается после пакета, на котором бюджет исчерпан,
+        с held - как только held сообщит о потере аренды части. Пакет, загруженный
+        после потери аренды, в watermark не попадает.
+        """
+        self.deadline = monotonic() + budget_sec if budget_sec else None
+        self.held = held
+        threads = [
+            Thread(target=self._extract, args=(watermark,), name=f"{self.obj_type}-extract"),
+            Thread(target=self._transform, name=f"{self.obj_type}-transform"),
+        ]
+        reporter = Thread(target=self._report, name=f"{self.obj_type}-stats", daemon=True)
+        for thread in threads:
+            thread.start()
+        reporter.start()
+
+        try:
+            count = self._load()
+        except Exception as e:
+            self._fail(e)
+            count = 0
+        finally:
+            for thread in threads:
+                thread.join()
+            self.done.set()
+            reporter.join()
+            self._log_stats()
+
+        if self.errors:
+            raise self.errors[0]
+        # Остановленный по бюджету конвейер догнал Postgres не полностью
+        if not self.stop.is_set():
+            metrics.observe_success(self.obj_type)
+        return count
+
+    def _extract(self, watermark: Watermark) -> None:
+        stats = self.stats["extract"]
+        batches = iter(())
+        try:
+            batches = metrics.timed_batches(
+                self.obj_type, self.etl.extract(self.extractor, watermark, self.batch_sizer)
+            )
+            while not self.stop.is_set():
+                started = monotonic()
+                data = next(batches, _DONE)
+                stats.busy_sec += monotonic() - started
+                if data is _DONE:
+                    break
+                stats.items += 1
+                stats.idle_sec += self._put(self.extracted, data)
+        except Exception as e:
+            self._fail(e)
+        finally:
+            # Закрываем генератор в этом же потоке, чтобы освободить серверный курсор
+            getattr(batches, "close", lambda: None)()
+            self._put(self.extracted, _DONE)
+
+    def _transform(self) -> None:
+        stats = self.stats["transform"]
+        # Пакеты в работе у процессов-обработчиков, в порядке выборки
+        pending: deque = deque()
+        try:
+            for data in self._consume(self.extracted, stats):
+                submitted = monotonic()
+                pending.append(
+                    (data, submitted, self.transformer.submit(self.etl.transform_model, data))
+                )
+                if len(pending) >= self.transformer.in_flight:
+                    self._put_transformed(*pending.popleft())
+            while pending and not self.stop.is_set():
+                self._put_transformed(*pending.popleft())
+        except Exception as e:
+            self._fail(e)
+        finally:
+            for _, _, future in pending:
+                future.cancel()
+            self._put(self.transformed, _DONE)
+
+    def _put_transformed(self, data: list[dict], submitted: float, future: Future) -> None:
+        stats = self.stats["transform"]
+        started = monotonic()
+        try:
+            transformed_data = future.result()
+        except ValueError as e:
+            transformed_data = self.dead_letters.isolate(
+                self.transformer, self.obj_type, self.etl.transform_model, data, e
+            )
+        stats.busy_sec += monotonic() - started
+        # Время этапа - от передачи пакета обработчику до готового результата
+        metrics.STAGE_SECONDS.labels(self.obj_type, "transform").observe(monotonic() - submitted)
+        stats.idle_sec += self._put(self.transformed, (data, transformed_data))
+
+    def _load(self) -> int:
+        # Соединение self.extractor занято потоком извлечения, производные документы
+        # выбираются из потока загрузки через свое
+        extractor = PostgresExtractor()
+        try:
+            return self._load_batches(extractor)
+        finally:
+            extractor.close()
+
+    def _load_batches(self, extractor: PostgresExtractor) -> int:
+        stats = self.stats["load"]
+        count = skipped = 0
+        derived = DerivedDocuments(self.state, self.etl, extractor, self.transformer, self.loader)
+        for data, transformed_data in self._consume(self.transformed, stats):
+            started = monotonic()
+            with metrics.stage_timer(self.obj_type, "load"):
+                result = self.loader.load_data(
+                    self.etl.elastic_index_name,
+                    self.etl.elastic_index_params,
+                    transformed_data,
+                    external_versions(data),
+                )
+                self.batch_sizer.observe(result, monotonic() - started)
+            result = self.dead_letters.divert(self.obj_type, data, result)
+            metrics.observe_load(self.obj_type, data, result)
+            count += result.indexed
+            skipped += result.skipped
+            logger.info(f"Загружено всего {count} записей для {self.obj_type}")
+            if self.held and not self.held():
+                logger.warning(f"Конвейер {self.obj_type} остановлен: аренда части потеряна")
+                self.stop.set()
+                break
+            derived.save(data, result)
+            stats.busy_sec += monotonic() - started
+            if self.deadline and monotonic() > self.deadline:
+                logger.info(f"Конвейер {self.obj_type} остановлен по бюджету")
+                # Пакеты, уже выбранные на предыдущих этапах, не загружены и будут
+                # выбраны снова со следующего запуска
+                self.stop.set()
+                break
+        derived.flush()
+        logger.info(
+            f"Конвейер {self.obj_type}: отправлено {count}, без изменений пропущено {skipped}"
+        )
+        return count
+
+    def _consume(self, queue: Queue, stats: StageStats) -> Iterable:
+        while True:
+            started = monotonic()
+            item = self._get(queue)
+            stats.idle_sec += monotonic() - started
+            if item is _DONE:
+                return
+            stats.items += 1
+            yield item
+
+    def _put(self, queue: Queue, item: Any) -> float:
+        """Кладет элемент в очередь, пока конвейер не остановлен. Возвращает время ожидания."""
+        started = monotonic()
+        self.queue_stats[id(queue)].observe(queue.qsize())
+        while True:
+            try:
+                queue.put(item, timeout=_POLL_INTERVAL_SEC)
+                break
+            except Full:
+                if self.stop.is_set():
+                    break
+        return monotonic() - started
+
+    def _get(self, queue: Queue) -> Any:
+        self.queue_stats[id(queue)].observe(queue.qsize())
+        while True:
+            try:
+                return queue.get(timeout=_POLL_INTERVAL_SEC)
+            except Empty:
+                if self.stop.is_set():
+                    return _DONE
+
+    def _fail(self, error: Exception) -> None:
+        logger.error(f"Ошибка в конвейере {self.obj_type}: {error}")
+        self.errors.append(error)
+        self.stop.set()
+
+    def _report(self) -> None:
+        """Периодически пишет статистику, чтобы узкое место было видно по ходу длинного прогона."""
+        while not self.done.wait(ETL_PIPELINE_STATS_INTERVAL_SEC):
+            self._log_stats()
+
+    def _log_stats(self) -> None:
+        bottleneck = max(self.stats.values(), key=lambda stage: stage.busy_sec)
+        for stage in self.stats.values():
+            logger.info(f"Конвейер {self.obj_type}. {stage}")
+        for queue in self.queue_stats.values():
+            logger.info(f"Конвейер {self.obj_type}. {queue}")
+        logger.info(f"Конвейер {self.obj_type}. Узкое место: {bottleneck.name}")
+
+
+def save_checkpoint(state: State, etl: Any, data: list[dict], result: BulkResult) -> None:
+    """
+    Сдвигает watermark на последнюю строку пакета, но не дальше первого документа,
+    который не удалось загрузить: следующий запуск начнет с него. Успешно загруженные
+    строки до него повторно не отправляются.
+    """
+    checkpoint = None
+    failed_ids = result.failed_ids
+    for row in data:
+        if row["id"] in failed_ids:
+            break
+        checkpoint = Watermark(modified=row["modified"], id=row["id"])
+
+    if checkpoint:
+        state.set_watermark(etl.watermark_state_key, checkpoint)
+    if result.errors:
+        raise BulkLoadError(
+            f"{len(result.errors)} документов не загружено в {etl.elastic_index_name}, "
+            f"загрузка будет продолжена с позиции {checkpoint}"
+        )
+
+
+class DerivedDocuments:
+    """
+    Документы сущностей, которые в режиме ETL_DERIVE_PERSONS строятся по пакетам
+    основной (ETL.derives). Идентификаторы затронутых строк копятся между пакетами,
+    поэтому персона из нескольких фильмов выгрузки загружается один раз, а не с
+    каждым пакетом. Watermark основной сущности сдвигается только после загрузки
+    накопленных документов: после сбоя пакеты с последней отметки пройдут заново.
+    """
+
+    def __init__(
+        self,
+        state: State,
+        etl: Any,
+        extractor: PostgresExtractor,
+        transformer: DataTransform,
+        loader: ElasticsearchLoader,
+        flush_size: int = ETL_DERIVE_FLUSH_SIZE,
+    ):
+        self.state = state
+        self.etl = etl
+        self.extractor = extractor
+        self.transformer = transformer
+        self.loader = loader
+        self.flush_size = flush_size
+        # Пока у производной сущности нет своего watermark, ее первый собственный проход
+        # выберет все строки целиком, и строить документы по пакетам незачем
+        self.derived = {
+            obj_type: derived
+            for obj_type, derived in etl.derived_etls().items()
+            if derived.has_watermark(state)
+        }
+        self.pending: dict[str, set[str]] = {obj_type: set() for obj_type in self.derived}
+        self.last_batch: Optional[tuple[list[dict], BulkResult]] = None
+
+    def save(self, data: list[dict], result: BulkResult) -> None:
+        """Запоминает пакет основной сущности вместо немедленного save_checkpoint."""
+        if not self.derived:
+            return save_checkpoint(self.state, self.etl, data, result)
+        for obj_type, derived in self.derived.items():
+            self.pending[obj_type].update(derived.touched_ids(data))
+        self.last_batch = data, result
+        if result.errors or sum(map(len, self.pending.values())) >= self.flush_size:
+            self.flush()
+
+    def flush(self) -> None:
+        for obj_type, derived in self.derived.items():
+            ids = sorted(self.pending[obj_type])
+            for start in range(0, len(ids), ETL_BATCH_SIZE):
+                chunk = ids[start:][:ETL_BATCH_SIZE]
+                self._load(obj_type, derived, chunk)
+            if ids:
+                logger.info(f"Обновлено {len(ids)} документов {obj_type} по пакетам")
+            self.pending[obj_type].clear()
+
+        if self.last_batch:
+            data, result = self.last_batch
+            self.last_batch = None
+            save_checkpoint(self.state, self.etl, data, result)
+
+    def _load(self, obj_type: str, derived: Any, ids: list[str]) -> None:
+        with metrics.stage_timer(obj_type, "extract"):
+            # Соединение берется из пула только при первой выборке
+            self.extractor.create_connection()
+            rows = self.extractor.extract_by_ids(derived.by_ids_query, ids)
+        dead_letters = get_dead_letters()
+        with metrics.stage_timer(obj_type, "transform"):
+            transformed_data = dead_letters.transform(
+                self.transformer, obj_type, derived.transform_model, rows
+            )
+        with metrics.stage_timer(obj_type, "load"):
+            result = self.loader.load_data(
+                derived.elastic_index_name,
+                derived.elastic_index_params,
+                transformed_data,
+                external_versions(rows),
+            )
+        result = dead_letters.divert(obj_type, rows, result)
+        if result.errors:
+            raise BulkLoadError(
+                f"{len(result.errors)} документов не загружено в {derived.elastic_index_name}, "
+                "пакеты основной сущности будут обработаны повторно"
+            )
+
+
+def run_in_parallel(
+    obj_types: Iterable[str], run: Callable[[str], int]
+) -> dict[str, Optional[int]]:
+    """Запускает ETL для каждого типа объектов в своем потоке и ждет завершения всех."""
+    results: dict[str, Optional[int]] = {}
+
+    def target(obj_type: str) -> None:
+        try:
+            results[obj_type] = run(obj_type)
+        except Exception as e:
+            logger.error(f"ETL для {obj_type} завершился с ошибкой: {e}")
+            results[obj_type] = None
+
+    threads = [Thread(target=target, args=(obj_type,), name=obj_type) for obj_type in obj_types]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
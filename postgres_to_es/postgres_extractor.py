@@ -1,19 +1,32 @@
+import os
 from datetime import datetime
-from typing import Iterator
+from itertools import islice
+from typing import Callable, Iterator, Optional
+from uuid import uuid4
 
 import psycopg2
+from connections import postgres_pool
 from decorators import backoff
 from loguru import logger
-from psycopg2.extras import RealDictCursor
-from settings import ETL_BATCH_SIZE, POSTGRES_CONNECTION_SETTINGS
+from settings import (
+    ETL_BATCH_SIZE,
+    ETL_CURSOR_ITERSIZE,
+    ETL_SERVER_SIDE_CURSOR,
+    ETL_WATERMARK_SAFETY_LAG_SEC,
+    POSTGRES_CONNECTION_SETTINGS,
+)
+from state import Watermark
 
-FILMWORKS_QUERY = """
+# version - внешняя версия документа (ES_EXTERNAL_VERSIONS): самое позднее изменение
+# строк, из которых он собран. modified служит позицией выборки и в разных запросах
+# считается по-разному, а version во всех выборках сущности одна и та же, иначе
+# запись по идентификаторам получала бы версию старше уже записанной в индекс
+_FILMWORKS_SELECT = """
         SELECT
            fw.id,
            fw.title,
            fw.description,
            fw.rating as imdb_rating,
-           fw.modified,
            COALESCE (
                json_agg(
                    DISTINCT jsonb_build_object(
@@ -47,18 +60,101 @@ FILMWORKS_QUERY = """
                        'id', g.id,
                        'name', g.name
                    )
-               ),
+               ) FILTER (WHERE g.id is not null),
                '[]'
            ) as genres, 
             COALESCE (array_agg(DISTINCT p.full_name) FILTER ( WHERE  pfw.role = 'actor'), '{}') as actors_names,
             COALESCE (array_agg(DISTINCT p.full_name) FILTER ( WHERE  pfw.role = 'writer'), '{}') as writers_names,
-            COALESCE (array_agg(DISTINCT p.full_name) FILTER ( WHERE  pfw.role = 'director'), '{}') as directors_names
+            COALESCE (array_agg(DISTINCT p.full_name) FILTER ( WHERE  pfw.role = 'director'), '{}') as directors_names,
+            GREATEST(fw.modified, MAX(p.modified), MAX(g.modified)) as modified,
+            GREATEST(
+                fw.modified, MAX(p.modified), MAX(g.modified), MAX(pfw.modified), MAX(gfw.modified)
+            ) as version
         FROM content.film_work fw
         LEFT JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
         LEFT JOIN content.person p ON p.id = pfw.person_id
         LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
         LEFT JOIN content.genre g ON g.id = gfw.genre_id
-        WHERE fw.modified > %s OR p.modified > %s OR g.modified > %s
+"""
+FILMWORKS_QUERY = f"""{_FILMWORKS_SELECT}
+        WHERE fw.id IN (
+            SELECT fw.id
+            FROM content.film_work fw
+            LEFT JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
+            LEFT JOIN content.person p ON p.id = pfw.person_id
+            LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
+            LEFT JOIN content.genre g ON g.id = gfw.genre_id
+            WHERE fw.modified >= %(modified)s
+                OR p.modified >= %(modified)s
+                OR g.modified >= %(modified)s
+        )
+        GROUP BY fw.id
+        HAVING (GREATEST(fw.modified, MAX(p.modified), MAX(g.modified)), fw.id)
+            > (%(modified)s, %(id)s)
+            AND GREATEST(fw.modified, MAX(p.modified), MAX(g.modified)) < %(until)s
+        ORDER BY modified, id
+        """
+# Двухфазное извлечение: сначала дешевыми запросами по индексам на modified собираем
+# идентификаторы изменившихся фильмов из всех исходных таблиц, затем строим документы
+# только для них.
+FILMWORKS_CHANGED_IDS_QUERY = """
+        SELECT
+            changes.id,
+            MAX(changes.modified) as modified
+        FROM (
+            SELECT fw.id, fw.modified
+            FROM content.film_work fw
+            WHERE fw.modified >= %(modified)s
+            UNION ALL
+            SELECT pfw.film_work_id, p.modified
+            FROM content.person p
+            JOIN content.person_film_work pfw ON pfw.person_id = p.id
+            WHERE p.modified >= %(modified)s
+            UNION ALL
+            SELECT gfw.film_work_id, g.modified
+            FROM content.genre g
+            JOIN content.genre_film_work gfw ON gfw.genre_id = g.id
+            WHERE g.modified >= %(modified)s
+            UNION ALL
+            SELECT pfw.film_work_id, pfw.modified
+            FROM content.person_film_work pfw
+            WHERE pfw.modified >= %(modified)s
+            UNION ALL
+            SELECT gfw.film_work_id, gfw.modified
+            FROM content.genre_film_work gfw
+            WHERE gfw.modified >= %(modified)s
+        ) as changes
+        GROUP BY changes.id
+        HAVING (MAX(changes.modified), changes.id) > (%(modified)s, %(id)s)
+            AND MAX(changes.modified) < %(until)s
+        ORDER BY modified, id
+        """
+# Изменения самих фильмов и их связей. Переименования персон и жанров в режиме
+# ETL_RENAMES=script переносятся в документы скриптом, а не повторной выборкой фильмов
+FILMWORKS_LINKS_CHANGED_IDS_QUERY = """
+        SELECT
+            changes.id,
+            MAX(changes.modified) as modified
+        FROM (
+            SELECT fw.id, fw.modified
+            FROM content.film_work fw
+            WHERE fw.modified >= %(modified)s
+            UNION ALL
+            SELECT pfw.film_work_id, pfw.modified
+            FROM content.person_film_work pfw
+            WHERE pfw.modified >= %(modified)s
+            UNION ALL
+            SELECT gfw.film_work_id, gfw.modified
+            FROM content.genre_film_work gfw
+            WHERE gfw.modified >= %(modified)s
+        ) as changes
+        GROUP BY changes.id
+        HAVING (MAX(changes.modified), changes.id) > (%(modified)s, %(id)s)
+            AND MAX(changes.modified) < %(until)s
+        ORDER BY modified, id
+        """
+FILMWORKS_BY_IDS_QUERY = f"""{_FILMWORKS_SELECT}
+        WHERE fw.id = ANY(%(ids)s::uuid[])
         GROUP BY fw.id
         """
 PERSONS_QUERY = """
@@ -81,39 +177,245 @@ PERSONS_QUERY = """
                                            ), '{}'
                                            )
                         )
-                    ), '[]'
-                ) as films
+                    ) FILTER (WHERE fw.id is not null), '[]'
+                ) as films,
+            GREATEST(p.modified, MAX(fw.modified)) as modified,
+            GREATEST(p.modified, MAX(fw.modified), MAX(pfw.modified)) as version
         FROM content.person as p
         LEFT JOIN content.person_film_work pfw ON p.id = pfw.person_id
         LEFT JOIN content.film_work fw ON pfw.film_work_id =fw.id
-        WHERE fw.modified > %s OR p.modified > %s
+        WHERE p.id IN (
+            SELECT p.id
+            FROM content.person as p
+            LEFT JOIN content.person_film_work pfw ON p.id = pfw.person_id
+            LEFT JOIN content.film_work fw ON pfw.film_work_id =fw.id
+            WHERE fw.modified >= %(modified)s OR p.modified >= %(modified)s
+        )
         GROUP BY p.id
+        HAVING (GREATEST(p.modified, MAX(fw.modified)), p.id) > (%(modified)s, %(id)s)
+            AND GREATEST(p.modified, MAX(fw.modified)) < %(until)s
+        ORDER BY modified, id
+        """
+# Персоны с фильмами и ролями без подзапроса на каждую пару (персона, фильм): роли
+# собираются по индексу person_film_work (person_id), film_work нужен только для version
+_PERSONS_SELECT = """
+        SELECT
+            p.id,
+            p.full_name,
+            COALESCE(person_films.films, '[]') as films,
+            p.modified,
+            GREATEST(p.modified, person_films.modified) as version
+        FROM content.person p
+        LEFT JOIN LATERAL (
+            SELECT json_agg(
+                json_build_object('id', roles.film_work_id, 'roles', roles.roles)
+            ) as films,
+            MAX(roles.modified) as modified
+            FROM (
+                SELECT
+                    pfw.film_work_id,
+                    array_agg(pfw.role) as roles,
+                    GREATEST(MAX(pfw.modified), MAX(fw.modified)) as modified
+                FROM content.person_film_work pfw
+                LEFT JOIN content.film_work fw ON fw.id = pfw.film_work_id
+                WHERE pfw.person_id = p.id
+                GROUP BY pfw.film_work_id
+            ) roles
+        ) person_films ON true
+"""
+# Изменения самих персон: связи с фильмами в режиме ETL_DERIVE_PERSONS
+# отслеживаются по выборке фильмов
+PERSONS_OWN_CHANGES_QUERY = f"""{_PERSONS_SELECT}
+        WHERE (p.modified, p.id) > (%(modified)s, %(id)s)
+            AND p.modified < %(until)s
+        ORDER BY p.modified, p.id
+        """
+PERSONS_BY_IDS_QUERY = f"""{_PERSONS_SELECT}
+        WHERE p.id = ANY(%(ids)s::uuid[])
         """
 GENRES_QUERY = """
         SELECT
             g.id,
             g.name,
-            g.description
+            g.description,
+            g.modified,
+            g.modified as version
         FROM content.genre g 
-        WHERE g.modified > %s
+        WHERE (g.modified, g.id) > (%(modified)s, %(id)s)
+            AND g.modified < %(until)s
+        ORDER BY g.modified, g.id
+"""
+GENRES_BY_IDS_QUERY = """
+        SELECT g.id, g.name, g.description, g.modified, g.modified as version
+        FROM content.genre g
+        WHERE g.id = ANY(%(ids)s::uuid[])
+"""
+# Имена персон и жанров, изменившихся после watermark, для переноса в документы фильмов
+PERSON_RENAMES_QUERY = """
+        SELECT p.id, p.full_name as name, p.modified
+        FROM content.person p
+        WHERE (p.modified, p.id) > (%(modified)s, %(id)s)
+            AND p.modified < %(until)s
+        ORDER BY p.modified, p.id
+"""
+GENRE_RENAMES_QUERY = """
+        SELECT g.id, g.name, g.modified
+        FROM content.genre g
+        WHERE (g.modified, g.id) > (%(modified)s, %(id)s)
+            AND g.modified < %(until)s
+        ORDER BY g.modified, g.id
 """
+# Часть выборки для сущности, разделенной на ETL_<СУЩНОСТЬ>_SHARDS частей: строка
+# попадает в часть по хешу идентификатора. Условие на колонку группировки postgresql
+# переносит внутрь запроса, до агрегации, и каждая часть строит только свои строки
+_SHARD_QUERY = """
+        SELECT * FROM ({query}) as shard
+        WHERE mod(hashtext(shard.id::text) & 2147483647, {shards}) = {number}
+        ORDER BY shard.modified, shard.id
+"""
+# Верхняя граница выборки. modified заполняется временем начала пишущей транзакции,
+# поэтому транзакция, которая еще не закоммичена, может позже добавить строки "в прошлое".
+# Граница не заходит дальше начала самой старой открытой транзакции и отстает от
+# текущего времени на ETL_WATERMARK_SAFETY_LAG_SEC. Транзакции других ролей видны
+# в pg_stat_activity только при наличии прав pg_read_all_stats.
+SAFE_CUTOFF_QUERY = """
+        SELECT LEAST(
+            clock_timestamp() - make_interval(secs => %(safety_lag)s),
+            (
+                SELECT MIN(xact_start)
+                FROM pg_stat_activity
+                WHERE backend_type = 'client backend' AND pid <> pg_backend_pid()
+            )
+        ) as until
+"""
+
+INDEXES_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "indexes.sql")
+
+
+def shard_query(query: str, number: int, shards: int) -> str:
+    return _SHARD_QUERY.format(query=query, shards=int(shards), number=int(number))
+
+
+def _resume_extraction(arguments: dict, batch: Optional[list[dict]]) -> None:
+    """Переподключается и продолжает выборку после последнего отданного пакета."""
+    extractor = arguments["self"]
+    extractor.close()
+    extractor.create_connection()
+    if batch:
+        arguments["watermark"] = Watermark(modified=batch[-1]["modified"], id=batch[-1]["id"])
 
 
 class PostgresExtractor:
+    def __init__(self):
+        self.connection = None
+
     @backoff()
     def create_connection(self):
-        self.connection = psycopg2.connect(
-            **POSTGRES_CONNECTION_SETTINGS, cursor_factory=RealDictCursor
-        )
+        """Берет соединение из общего пула, close возвращает его обратно."""
+        if not self.connection:
+            self.connection = postgres_pool.acquire()
         return self.connection
 
     @backoff()
-    def extract_data(self, query: str, param_count: int, date_last_modified: datetime) -> Iterator:
+    def ensure_indexes(self) -> None:
+        """Создает недостающие индексы из indexes.sql. CONCURRENTLY не блокирует запись."""
+        with open(INDEXES_SCRIPT) as script:
+            statements = [
+                statement.strip()
+                for statement in script.read().split(";")
+                if "CREATE INDEX" in statement
+            ]
+
+        connection = psycopg2.connect(**POSTGRES_CONNECTION_SETTINGS)
+        try:
+            # CREATE INDEX CONCURRENTLY нельзя выполнять внутри транзакции
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                for statement in statements:
+                    statement = "\n".join(
+                        line for line in statement.splitlines() if not line.startswith("--")
+                    )
+                    cursor.execute(statement)
+        finally:
+            connection.close()
+        logger.info(f"Индексы для извлечения данных проверены ({len(statements)})")
+
+    def close(self) -> None:
+        if self.connection:
+            connection, self.connection = self.connection, None
+            postgres_pool.release(connection)
+
+    @backoff(resume=_resume_extraction)
+    def extract_data(
+        self,
+        query: str,
+        watermark: Watermark,
+        batch_size: Callable[[], int] = lambda: ETL_BATCH_SIZE,
+    ) -> Iterator:
         if not self.connection:
             raise Exception(
                 "Не создано подключение к postgresql. Воспользуйтесь create_connection."
             )
-        with self.connection.cursor() as cursor:
-            cursor.execute(query, (date_last_modified,) * param_count)
-            while rows := cursor.fetchmany(ETL_BATCH_SIZE):
+        with self._open_cursor() as cursor:
+            cursor.execute(query, self._keyset_params(watermark))
+            while rows := list(islice(cursor, batch_size())):
                 yield rows
+
+    @backoff(resume=_resume_extraction)
+    def extract_changed_data(
+        self,
+        changed_ids_query: str,
+        by_ids_query: str,
+        watermark: Watermark,
+        batch_size: Callable[[], int] = lambda: ETL_BATCH_SIZE,
+    ) -> Iterator:
+        if not self.connection:
+            raise Exception(
+                "Не создано подключение к postgresql. Воспользуйтесь create_connection."
+            )
+        with self._open_cursor() as cursor:
+            cursor.execute(changed_ids_query, self._keyset_params(watermark))
+            while changes := list(islice(cursor, batch_size())):
+                if rows := self._extract_by_ids(by_ids_query, changes):
+                    yield rows
+
+    def get_safe_cutoff(self) -> datetime:
+        with self.connection.cursor() as cursor:
+            cursor.execute(SAFE_CUTOFF_QUERY, {"safety_lag": ETL_WATERMARK_SAFETY_LAG_SEC})
+            return cursor.fetchone()["until"]
+
+    def _keyset_params(self, watermark: Watermark) -> dict:
+        until = self.get_safe_cutoff()
+        logger.debug(f"Выборка после {watermark} до {until}")
+        return {**watermark.dict(), "until": until}
+
+    def extract_by_ids(self, query: str, ids: list[str]) -> list[dict]:
+        if not ids:
+            return []
+        with self.connection.cursor() as cursor:
+            cursor.execute(query, {"ids": ids})
+            return cursor.fetchall()
+
+    def _extract_by_ids(self, query: str, changes: list[dict]) -> list[dict]:
+        ids = [change["id"] for change in changes]
+        rows = {row["id"]: row for row in self.extract_by_ids(query, ids)}
+
+        # Сохраняем порядок первой фазы и ее modified, чтобы по последней строке
+        # пакета можно было сдвинуть watermark
+        batch = []
+        for change in changes:
+            if row := rows.get(change["id"]):
+                row["modified"] = change["modified"]
+                batch.append(row)
+        return batch
+
+    def _open_cursor(self):
+        if not ETL_SERVER_SIDE_CURSOR:
+            return self.connection.cursor()
+
+        # Именованный курсор живет на стороне postgresql: строки приходят порциями
+        # по itersize, а не целиком в память процесса при вызове execute.
+        cursor = self.connection.cursor(name=f"etl_{uuid4().hex}")
+        cursor.itersize = ETL_CURSOR_ITERSIZE
+        logger.debug(f"Открыт серверный курсор {cursor.name} (itersize={cursor.itersize})")
+        return cursor
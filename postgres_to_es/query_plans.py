@@ -0,0 +1,301 @@
+"""
+Планы запросов извлечения без загрузки в elasticsearch.
+
+Для каждой сущности выполняются EXPLAIN (ANALYZE, BUFFERS) тех запросов, которыми
+ETL выбирает данные в текущих настройках (ETL_TWO_PHASE_EXTRACT, ETL_DERIVE_PERSONS),
+с сохраненного watermark. В отчете время и число строк каждого запроса, чтения
+буферов, последовательные чтения больших таблиц и сортировки, не поместившиеся в
+work_mem, с индексами, которые их уберут. Индексы из indexes.sql создаются ключом
+--create-indexes, остальные рекомендации выводятся как SQL.
+
+Запуск: python query_plans.py [filmwork person genre] [--from-start] [--create-indexes]
+"""
+import argparse
+import json
+import re
+from dataclasses import dataclass, field
+from textwrap import shorten
+from typing import Iterator, Optional
+
+from etl import ETLHandler, get_watermark
+from loguru import logger
+from postgres_extractor import INDEXES_SCRIPT, PostgresExtractor
+from settings import ETL_BATCH_SIZE, ETL_DERIVE_PERSONS, ETL_TWO_PHASE_EXTRACT, REDIS_ADAPTER
+from state import RedisStorage, State, Watermark
+
+# Последовательное чтение таблицы, вернувшее или отбросившее больше строк, считается проблемой
+SEQ_SCAN_ROWS = 10_000
+# Сортировка больше этого объема в памяти или любая сортировка на диске
+SORT_SPACE_KB = 4096
+# Условия со списками идентификаторов в отчете обрезаются до этой длины
+CONDITION_LENGTH = 200
+
+EXISTING_INDEXES_QUERY = """
+    SELECT tablename, indexdef FROM pg_indexes WHERE schemaname = 'content'
+"""
+COLUMNS_QUERY = """
+    SELECT table_name, column_name
+    FROM information_schema.columns
+    WHERE table_schema = 'content'
+    ORDER BY table_name, ordinal_position
+"""
+
+
+@dataclass
+class Finding:
+    kind: str
+    detail: str
+    recommendation: Optional[str] = None
+    # Рекомендованный индекс описан в indexes.sql и создается --create-indexes
+    in_script: bool = False
+
+
+@dataclass
+class QueryProfile:
+    entity: str
+    name: str
+    planning_ms: float
+    execution_ms: float
+    rows: int
+    shared_hit: int
+    shared_read: int
+    findings: list[Finding] = field(default_factory=list)
+
+
+def _index_key(table: str, definition: str) -> Optional[tuple[str, str]]:
+    if match := re.search(r"USING btree \((\w+)", definition):
+        return table, match.group(1)
+    return None
+
+
+def load_index_statements() -> dict[tuple[str, str], str]:
+    """Индексы из indexes.sql по (таблица, первая колонка)."""
+    with open(INDEXES_SCRIPT) as script:
+        statements = [statement.strip() for statement in script.read().split(";")]
+    indexes = {}
+    for statement in statements:
+        statement = "\n".join(line for line in statement.splitlines() if not line.startswith("--"))
+        if match := re.search(r"ON content\.(\w+) ", statement):
+            if key := _index_key(match.group(1), statement):
+                indexes[key] = statement.strip()
+    return indexes
+
+
+def load_existing_indexes(extractor: PostgresExtractor) -> set[tuple[str, str]]:
+    """Индексы базы по (таблица, первая колонка)."""
+    with extractor.connection.cursor() as cursor:
+        cursor.execute(EXISTING_INDEXES_QUERY)
+        keys = {_index_key(row["tablename"], row["indexdef"]) for row in cursor.fetchall()}
+    return keys - {None}
+
+
+def walk(plan: dict) -> Iterator[dict]:
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from walk(child)
+
+
+class PlanAdvisor:
+    def __init__(
+        self,
+        columns: dict[str, list[str]],
+        script_indexes: dict[tuple[str, str], str],
+        existing_indexes: set[tuple[str, str]],
+    ):
+        self.columns = columns
+        self.script_indexes = script_indexes
+        self.existing_indexes = existing_indexes
+
+    def finding(self, kind: str, detail: str, table: str, expression: str) -> Finding:
+        """
+        Дополняет находку индексом по колонкам таблицы в порядке их появления в
+        условии или ключе сортировки. Если такой индекс уже есть, планировщик
+        предпочел ему полное чтение: так бывает при выборке большей части таблицы,
+        например с нулевого watermark.
+        """
+        positions = {
+            column: match.start()
+            for column in self.columns.get(table, [])
+            if (match := re.search(rf"\b{column}\b", expression))
+        }
+        columns = sorted(positions, key=positions.get)
+        if not columns:
+            return Finding(kind, detail)
+        key = (table, columns[0])
+        if key in self.existing_indexes:
+            return Finding(kind, f"{detail}; индекс по {columns[0]} есть, но не использован")
+        if statement := self.script_indexes.get(key):
+            return Finding(kind, detail, statement, in_script=True)
+        statement = f"CREATE INDEX CONCURRENTLY ON content.{table} ({', '.join(columns[:2])})"
+        return Finding(kind, detail, statement)
+
+    def findings(self, plan: dict) -> list[Finding]:
+        aliases = {
+            node["Alias"]: node["Relation Name"] for node in walk(plan) if "Relation Name" in node
+        }
+        findings = []
+        for node in walk(plan):
+            loops = node.get("Actual Loops", 1)
+            if node["Node Type"] == "Seq Scan":
+                rows = (node["Actual Rows"] + node.get("Rows Removed by Filter", 0)) * loops
+                if rows < SEQ_SCAN_ROWS:
+                    continue
+                table = node["Relation Name"]
+                condition = node.get("Filter", "")
+                shown = shorten(condition, CONDITION_LENGTH, placeholder="...") or "нет"
+                detail = f"{table}: прочитано {rows} строк, условие {shown}"
+                findings.append(self.finding("seq scan", detail, table, condition))
+            elif node["Node Type"] == "Sort":
+                space = node.get("Sort Space Used", 0)
+                on_disk = node.get("Sort Space Type") == "Disk"
+                if not on_disk and space < SORT_SPACE_KB:
+                    continue
+                keys = node.get("Sort Key", [])
+                detail = (
+                    f"{', '.join(keys)}: {space} КБ, {node.get('Sort Method')}"
+                    f"{' на диске' if on_disk else ''}"
+                )
+                # Ключ вида alias.column сортирует строки одной таблицы
+                match = re.match(r"(\w+)\.", keys[0]) if keys else None
+                if match and match[1] in aliases:
+                    columns = " ".join(key.split(".", 1)[-1] for key in keys)
+                    findings.append(self.finding("sort", detail, aliases[match[1]], columns))
+                else:
+                    findings.append(Finding("sort", detail))
+        return findings
+
+
+class QueryProfiler:
+    def __init__(self, extractor: PostgresExtractor, advisor: PlanAdvisor):
+        self.extractor = extractor
+        self.advisor = advisor
+
+    def explain(self, entity: str, name: str, query: str, params: dict) -> QueryProfile:
+        with self.extractor.connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query}", params)
+            (result,) = cursor.fetchone().values()
+        # psycopg2 разбирает json сам, если тип колонки json, а EXPLAIN возвращает text
+        explained = (json.loads(result) if isinstance(result, str) else result)[0]
+        plan = explained["Plan"]
+        return QueryProfile(
+            entity=entity,
+            name=name,
+            planning_ms=explained["Planning Time"],
+            execution_ms=explained["Execution Time"],
+            rows=plan["Actual Rows"] * plan.get("Actual Loops", 1),
+            shared_hit=plan.get("Shared Hit Blocks", 0),
+            shared_read=plan.get("Shared Read Blocks", 0),
+            findings=self.advisor.findings(plan),
+        )
+
+    def sample(self, query: str, params: dict) -> list[dict]:
+        with self.extractor.connection.cursor() as cursor:
+            cursor.execute(query, params)
+            return cursor.fetchmany(ETL_BATCH_SIZE)
+
+    def profile(self, entity: str, watermark: Watermark) -> list[QueryProfile]:
+        """Планы запросов, которыми сущность выбирается в текущих настройках ETL."""
+        etl = ETLHandler.get_etl(entity)
+        params = {**watermark.dict(), "until": self.extractor.get_safe_cutoff()}
+
+        if ETL_DERIVE_PERSONS and etl.own_changes_query:
+            return [self.explain(entity, "own_changes_query", etl.own_changes_query, params)]
+        if not (ETL_TWO_PHASE_EXTRACT and etl.changed_ids_query):
+            return [self.explain(entity, "sql_query", etl.sql_query, params)]
+
+        profiles = [self.explain(entity, "changed_ids_query", etl.changed_ids_query, params)]
+        # Вторая фаза и производные документы - на идентификаторах первого пакета
+        ids = [row["id"] for row in self.sample(etl.changed_ids_query, params)]
+        profiles.append(self.explain(entity, "by_ids_query", etl.by_ids_query, {"ids": ids}))
+        rows = self.extractor.extract_by_ids(etl.by_ids_query, ids)
+        for derived_entity, derived in etl.derived_etls().items():
+            derived_ids = sorted(derived.touched_ids(rows))
+            profiles.append(
+                self.explain(
+                    entity,
+                    f"{derived_entity}.by_ids_query",
+                    derived.by_ids_query,
+                    {"ids": derived_ids},
+                )
+            )
+        return profiles
+
+
+def load_columns(extractor: PostgresExtractor) -> dict[str, list[str]]:
+    columns: dict[str, list[str]] = {}
+    with extractor.connection.cursor() as cursor:
+        cursor.execute(COLUMNS_QUERY)
+        for row in cursor.fetchall():
+            columns.setdefault(row["table_name"], []).append(row["column_name"])
+    return columns
+
+
+def report(profiles: list[QueryProfile]) -> None:
+    for profile in profiles:
+        print(
+            f"{profile.entity}.{profile.name}: {profile.execution_ms:.1f} мс "
+            f"(план {profile.planning_ms:.1f} мс), строк {profile.rows}, "
+            f"буферы hit={profile.shared_hit} read={profile.shared_read}"
+        )
+        for finding in profile.findings:
+            print(f"    {finding.kind}: {finding.detail}")
+            if finding.recommendation:
+                print(f"        -> {finding.recommendation}")
+
+    findings = [finding for profile in profiles for finding in profile.findings]
+    for title, in_script in (
+        ("Индексы из indexes.sql, создаются с --create-indexes", True),
+        ("Дополнительные индексы", False),
+    ):
+        recommendations = sorted(
+            {
+                finding.recommendation
+                for finding in findings
+                if finding.recommendation and finding.in_script == in_script
+            }
+        )
+        if recommendations:
+            print(f"\n{title}:")
+            for recommendation in recommendations:
+                print(f"    {recommendation};")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Планы запросов извлечения ETL")
+    parser.add_argument(
+        "obj_types",
+        nargs="*",
+        default=list(ETLHandler.PARAMS),
+        help=f"сущности: {', '.join(ETLHandler.PARAMS)}, по умолчанию все",
+    )
+    parser.add_argument(
+        "--from-start", action="store_true", help="планы полной выборки вместо текущего watermark"
+    )
+    parser.add_argument(
+        "--create-indexes",
+        action="store_true",
+        help="создать недостающие индексы из indexes.sql перед замером",
+    )
+    args = parser.parse_args()
+    if unknown := set(args.obj_types) - set(ETLHandler.PARAMS):
+        parser.error(f"неизвестные сущности: {', '.join(sorted(unknown))}")
+
+    state = None if args.from_start else State(RedisStorage(REDIS_ADAPTER))
+    extractor = PostgresExtractor()
+    if args.create_indexes:
+        extractor.ensure_indexes()
+
+    try:
+        extractor.create_connection()
+        advisor = PlanAdvisor(
+            load_columns(extractor), load_index_statements(), load_existing_indexes(extractor)
+        )
+        profiler = QueryProfiler(extractor, advisor)
+        profiles = []
+        for obj_type in args.obj_types:
+            watermark = get_watermark(state, ETLHandler.get_etl(obj_type)) if state else Watermark()
+            logger.info(f"Планы запросов {obj_type} с позиции {watermark}")
+            profiles.extend(profiler.profile(obj_type, watermark))
+        report(profiles)
+    finally:
+        extractor.close()
@@ -0,0 +1,99 @@
+"""
+Полная переиндексация без простоя.
+
+Данные загружаются в новую версию индекса с отключенным обновлением поиска и без
+реплик, после чего индексу возвращаются обычные настройки, сегменты сливаются и
+псевдоним, через который читает сервис фильмов, одним запросом переключается на
+новый индекс. Пока идет загрузка, поиск продолжает работать по старому индексу.
+
+Переиндексация идет одним процессом: сущность выбирается целиком, без разбиения на
+части ETL_SHARDS и без аренд. Запускать ее одновременно в нескольких процессах нельзя.
+
+Запуск: python reindex.py [filmwork person genre] [--keep-old]
+"""
+import argparse
+
+from data_transform import DataTransform, get_transformer
+from elasticsearch_loader import ElasticsearchLoader
+from etl import ETLHandler, run_etl
+from fingerprints import get_fingerprint_storage
+from loguru import logger
+from postgres_extractor import PostgresExtractor
+from settings import REDIS_ADAPTER
+from state import RedisStorage, State, Watermark
+
+
+def reindex(
+    obj_type: str,
+    state: State,
+    extractor: PostgresExtractor,
+    transformer: DataTransform,
+    loader: ElasticsearchLoader,
+    keep_old: bool = False,
+) -> int:
+    etl = ETLHandler.get_etl(obj_type)
+    alias = etl.elastic_index_name
+    index_key = f"reindex_{obj_type}_index"
+    started_key = f"reindex_{obj_type}_started"
+    watermark_key = f"reindex_{obj_type}_watermark"
+
+    # Прерванная переиндексация продолжается в тот же индекс со своей позиции
+    index_name = state.get_state(index_key)
+    started = state.get_watermark(started_key)
+    if not (index_name and started and loader.client.indices.exists(index=index_name)):
+        started = Watermark(modified=extractor.get_safe_cutoff())
+        index_name = loader.create_versioned_index(alias, etl.elastic_index_params)
+        state.set_watermark(watermark_key, Watermark())
+        state.set_watermark(started_key, started)
+        state.set_state(index_key, index_name)
+
+    target = etl.copy(
+        update={"elastic_index_name": index_name, "watermark_state_key": watermark_key}
+    )
+    logger.info(f"Переиндексация {obj_type} в {index_name}")
+    count = run_etl(obj_type, state, extractor, transformer, loader, etl=target)
+
+    loader.finalize_index(index_name, etl.elastic_index_params)
+    old_indices = loader.swap_alias(alias, index_name)
+
+    # Изменения, загруженные инкрементальным ETL в старый индекс во время
+    # переиндексации, догоняем в новый: теперь псевдоним указывает на него
+    state.set_watermark(watermark_key, started)
+    catch_up = etl.copy(update={"watermark_state_key": watermark_key})
+    count += run_etl(obj_type, state, extractor, transformer, loader, etl=catch_up)
+
+    if not keep_old:
+        loader.delete_indices(old_indices)
+    state.set_state(index_key, "")
+    logger.info(f"Переиндексация {obj_type} завершена, загружено {count} записей")
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Полная переиндексация без простоя")
+    parser.add_argument(
+        "obj_types",
+        nargs="*",
+        default=list(ETLHandler.PARAMS),
+        help=f"сущности для переиндексации: {', '.join(ETLHandler.PARAMS)}, по умолчанию все",
+    )
+    parser.add_argument(
+        "--keep-old", action="store_true", help="не удалять предыдущую версию индекса"
+    )
+    args = parser.parse_args()
+    if unknown := set(args.obj_types) - set(ETLHandler.PARAMS):
+        parser.error(f"неизвестные сущности: {', '.join(sorted(unknown))}")
+
+    state = State(RedisStorage(REDIS_ADAPTER))
+    extractor = PostgresExtractor()
+    transformer = get_transformer()
+    loader = ElasticsearchLoader(get_fingerprint_storage())
+
+    try:
+        extractor.create_connection()
+        loader.create_connection()
+        for obj_type in args.obj_types:
+            reindex(obj_type, state, extractor, transformer, loader, args.keep_old)
+    finally:
+        extractor.close()
+        transformer.close()
@@ -0,0 +1,87 @@
+from elasticsearch_loader import ElasticsearchLoader
+from loguru import logger
+
+# Поля документа фильма со ссылками на сущность и поля с массивами их имен
+RENAMED_FIELDS: dict[str, dict[str, str | None]] = {
+    "person": {
+        "actors": "actors_names",
+        "writers": "writers_names",
+        "directors": "directors_names",
+    },
+    "genre": {"genres": None},
+}
+
+# Заменяет имена в ссылках по params.names (идентификатор -> имя) и пересобирает
+# массив имен роли. Документ, в котором имена уже совпадают, не переписывается (noop):
+# изменение персоны или жанра без смены имени ничего не стоит индексу
+RENAME_SCRIPT = """
+    boolean changed = false;
+    for (def entry : params.fields.entrySet()) {
+        List items = ctx._source[entry.getKey()];
+        if (items == null) {
+            continue;
+        }
+        boolean renamed = false;
+        for (def item : items) {
+            String name = params.names[item['id']];
+            if (name != null && !name.equals(item['name'])) {
+                item['name'] = name;
+                renamed = true;
+            }
+        }
+        if (renamed && entry.getValue() != null) {
+            Set names = new TreeSet();
+            for (def item : items) {
+                names.add(item['name']);
+            }
+            ctx._source[entry.getValue()] = new ArrayList(names);
+        }
+        changed = changed || renamed;
+    }
+    if (!changed) {
+        ctx.op = 'noop';
+    }
+"""
+
+
+def rename_query(fields: list[str], ids: list[str], nested: set[str]) -> dict:
+    """Документы, ссылающиеся хотя бы на один из ids в одном из полей fields."""
+    clauses = []
+    for path in fields:
+        terms = {"terms": {f"{path}.id": ids}}
+        clauses.append({"nested": {"path": path, "query": terms}} if path in nested else terms)
+    return {"bool": {"should": clauses, "minimum_should_match": 1}}
+
+
+class RenamePropagator:
+    """
+    Переносит новые имена персон и жанров в документы индекса фильмов частичным
+    обновлением на стороне elasticsearch: вместо повторной выборки и отправки
+    всех фильмов персоны запрос передает только идентификаторы и имена.
+    """
+
+    def __init__(self, loader: ElasticsearchLoader, index_name: str):
+        self.loader = loader
+        self.index_name = index_name
+        # Схема читается из индекса: после reindex.py она может отличаться от
+        # настроек ETL, а запрос без nested по вложенному полю ничего не найдет
+        self.nested = loader.nested_paths(index_name)
+
+    def propagate(self, obj_type: str, names: dict[str, str]) -> int:
+        if self.nested is None or not names:
+            return 0
+        fields = RENAMED_FIELDS[obj_type]
+        updated = self.loader.update_by_query(
+            self.index_name,
+            rename_query(list(fields), list(names), self.nested),
+            {
+                "source": RENAME_SCRIPT,
+                "lang": "painless",
+                "params": {"fields": fields, "names": names},
+            },
+        )
+        logger.info(
+            f"Имена {len(names)} строк {obj_type} перенесены в {updated} документов "
+            f"{self.index_name}"
+        )
+        return updated
@@ -0,0 +1,108 @@
+"""
+Просмотр и повтор строк, отложенных ETL в dead letter (ETL_DEAD_LETTERS).
+
+list показывает по сущностям число отложенных строк и последние причины.
+replay после исправления данных или кода заново выбирает отложенные строки
+из Postgres по идентификаторам, преобразует и загружает их. Записи успешно
+загруженных строк и строк, удаленных из Postgres, удаляются из хранилища.
+Строки, снова не прошедшие проверку или отклоненные, откладываются заново.
+
+Запуск: python replay_dead_letters.py list|replay [filmwork person genre]
+"""
+import argparse
+from collections import Counter
+
+from data_transform import DataTransform, get_transformer
+from dead_letters import DeadLetterQueue, get_dead_letters
+from elasticsearch_loader import BulkLoadError, ElasticsearchLoader, external_versions
+from etl import ETLHandler
+from fingerprints import get_fingerprint_storage
+from loguru import logger
+from postgres_extractor import PostgresExtractor
+from settings import ETL_BATCH_SIZE
+
+
+def show(obj_type: str, queue: DeadLetterQueue, last: int = 5) -> None:
+    letters = queue.storage.read(obj_type)
+    stages = Counter(letter.stage for letter in letters)
+    summary = "".join(f", {stage} {count}" for stage, count in sorted(stages.items()))
+    rows = len({letter.id for letter in letters})
+    print(f"{obj_type}: {len(letters)} записей, строк {rows}{summary}")
+    for letter in letters[-last:]:
+        print(f"    {letter.created} {letter.stage} {letter.id}: {letter.reason}")
+
+
+def replay(
+    obj_type: str,
+    queue: DeadLetterQueue,
+    extractor: PostgresExtractor,
+    transformer: DataTransform,
+    loader: ElasticsearchLoader,
+) -> int:
+    etl = ETLHandler.get_etl(obj_type)
+    letters = queue.storage.read(obj_type)
+    keys_by_id: dict[str, list[str]] = {}
+    for letter in letters:
+        keys_by_id.setdefault(letter.id, []).append(letter.key)
+
+    ids = sorted(keys_by_id)
+    count = 0
+    for start in range(0, len(ids), ETL_BATCH_SIZE):
+        chunk = ids[start:][:ETL_BATCH_SIZE]
+        rows = extractor.extract_by_ids(etl.by_ids_query, chunk)
+        documents = queue.transform(transformer, obj_type, etl.transform_model, rows)
+        result = queue.divert(
+            obj_type,
+            rows,
+            loader.load_data(
+                etl.elastic_index_name,
+                etl.elastic_index_params,
+                documents,
+                external_versions(rows),
+            ),
+        )
+        if result.errors:
+            raise BulkLoadError(
+                f"{len(result.errors)} документов {obj_type} не загружено, записи оставлены"
+            )
+        # Снова отложенные строки записаны заново, прежние записи больше не нужны
+        queue.storage.remove(obj_type, [key for id_ in chunk for key in keys_by_id[id_]])
+        count += result.indexed
+        if missing := len(chunk) - len(rows):
+            logger.info(f"{missing} строк {obj_type} удалены из Postgres, записи сняты")
+    logger.info(f"Повтор {obj_type}: загружено {count} из {len(ids)} строк")
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Строки, отложенные ETL в dead letter")
+    parser.add_argument("command", choices=["list", "replay"])
+    parser.add_argument(
+        "obj_types",
+        nargs="*",
+        default=list(ETLHandler.PARAMS),
+        help=f"сущности: {', '.join(ETLHandler.PARAMS)}, по умолчанию все",
+    )
+    args = parser.parse_args()
+    if unknown := set(args.obj_types) - set(ETLHandler.PARAMS):
+        parser.error(f"неизвестные сущности: {', '.join(sorted(unknown))}")
+
+    queue = get_dead_letters()
+    if queue.storage is None:
+        parser.error("хранилище dead letter отключено: ETL_DEAD_LETTERS=off")
+
+    if args.command == "list":
+        for obj_type in args.obj_types:
+            show(obj_type, queue)
+    else:
+        extractor = PostgresExtractor()
+        transformer = get_transformer()
+        loader = ElasticsearchLoader(get_fingerprint_storage())
+        try:
+            extractor.create_connection()
+            loader.create_connection()
+            for obj_type in args.obj_types:
+                replay(obj_type, queue, extractor, transformer, loader)
+        finally:
+            extractor.close()
+            transformer.close()
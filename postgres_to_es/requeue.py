@@ -0,0 +1,39 @@
+import redis
+from decorators import backoff
+from settings import REDIS_ADAPTER
+
+# Идентификаторов в одной команде SADD
+_ADD_CHUNK_SIZE = 10000
+
+
+class RequeueQueue:
+    """
+    Идентификаторы строк, документы которых ETL загрузит заново вне watermark,
+    например расхождения, найденные verify.py. Очередь - множество Redis
+    requeue:<сущность>: идентификатор в ней один раз, сколько бы раз его ни
+    добавили, а забирает его (SPOP) только один из процессов ETL.
+    """
+
+    def __init__(self, redis_adapter: redis.Redis):
+        self.redis_adapter = redis_adapter
+
+    @staticmethod
+    def _key(entity: str) -> str:
+        return f"requeue:{entity}"
+
+    @backoff()
+    def add(self, entity: str, ids: list[str]) -> None:
+        for start in range(0, len(ids), _ADD_CHUNK_SIZE):
+            self.redis_adapter.sadd(self._key(entity), *ids[start:][:_ADD_CHUNK_SIZE])
+
+    @backoff()
+    def pop(self, entity: str, count: int) -> list[str]:
+        return self.redis_adapter.spop(self._key(entity), count) or []
+
+    @backoff()
+    def size(self, entity: str) -> int:
+        return self.redis_adapter.scard(self._key(entity))
+
+
+def get_requeue() -> RequeueQueue:
+    return RequeueQueue(REDIS_ADAPTER)
@@ -0,0 +1,65 @@
+from dataclasses import dataclass
+from time import monotonic
+from typing import Iterable, Optional
+
+from loguru import logger
+from settings import ETL_WATERMARK_SAFETY_LAG_SEC
+
+
+@dataclass
+class Schedule:
+    interval_sec: float
+    priority: int
+    budget_sec: Optional[float]
+    next_run: float = 0
+    # Запуск по уведомлению повторяется через ETL_WATERMARK_SAFETY_LAG_SEC:
+    # строки моложе этого запаса ETL пропускает
+    trailing: bool = False
+
+
+class Scheduler:
+    """
+    Расписание запусков ETL по сущностям. У каждой сущности свой интервал,
+    приоритет и бюджет времени на один запуск (interval_sec, priority, budget_sec
+    в ETLHandler.PARAMS). Все сущности, чье время подошло, запускаются по одному
+    разу в порядке приоритета (меньше - раньше). Сущность, исчерпавшая бюджет,
+    не закончила выборку и запускается снова в следующем круге: отставание
+    фильмов задерживает персон не больше чем на бюджет.
+    """
+
+    def __init__(self, schedules: dict[str, Schedule]):
+        self.schedules = schedules
+
+    def due(self, now: Optional[float] = None) -> list[str]:
+        """Сущности, чье время подошло, в порядке приоритета."""
+        now = monotonic() if now is None else now
+        due = [
+            obj_type for obj_type, schedule in self.schedules.items() if schedule.next_run <= now
+        ]
+        return sorted(due, key=lambda obj_type: self.schedules[obj_type].priority)
+
+    def sleep_time(self, now: Optional[float] = None) -> float:
+        now = monotonic() if now is None else now
+        return max(min(schedule.next_run for schedule in self.schedules.values()) - now, 0)
+
+    def notify(self, obj_types: Iterable[str], now: Optional[float] = None) -> None:
+        """Запланировать сущности немедленно, например по уведомлению об изменениях."""
+        now = monotonic() if now is None else now
+        for obj_type in obj_types:
+            if schedule := self.schedules.get(obj_type):
+                schedule.next_run = min(schedule.next_run, now)
+                schedule.trailing = True
+
+    def done(self, obj_type: str, started: float, finished: Optional[float] = None) -> None:
+        finished = monotonic() if finished is None else finished
+        schedule = self.schedules[obj_type]
+        elapsed = finished - started
+        if schedule.budget_sec and elapsed >= schedule.budget_sec:
+            # Выборка прервана по бюджету, остаток обрабатывается в следующем круге
+            schedule.next_run = finished
+            logger.info(f"ETL для {obj_type} исчерпал бюджет {schedule.budget_sec} с")
+            return
+        schedule.next_run = started + schedule.interval_sec
+        if schedule.trailing:
+            schedule.next_run = min(schedule.next_run, finished + ETL_WATERMARK_SAFETY_LAG_SEC)
+            schedule.trailing = False
@@ -1,5 +1,7 @@
 import os
+import socket
 import sys
+from typing import Optional
 
 from dotenv import load_dotenv
 from loguru import logger
@@ -19,6 +21,85 @@ REDIS_ADAPTER = Redis(
 )
 
 ETL_BATCH_SIZE: int = int(os.environ.get("ETL_BATCH_SIZE", 100))
+# Подбор размера пакета по объему bulk-запроса и времени его выполнения,
+# ETL_BATCH_SIZE - начальный размер
+ETL_BATCH_ADAPTIVE: bool = os.environ.get("ETL_BATCH_ADAPTIVE", "False") == "True"
+ETL_BATCH_MIN_SIZE: int = int(os.environ.get("ETL_BATCH_MIN_SIZE", 10))
+ETL_BATCH_MAX_SIZE: int = int(os.environ.get("ETL_BATCH_MAX_SIZE", 5000))
+ETL_BATCH_TARGET_BYTES: int = int(os.environ.get("ETL_BATCH_TARGET_BYTES", 5 * 1024 * 1024))
+ETL_BATCH_TARGET_LATENCY_SEC: float = float(os.environ.get("ETL_BATCH_TARGET_LATENCY_SEC", 1))
+ETL_SERVER_SIDE_CURSOR: bool = os.environ.get("ETL_SERVER_SIDE_CURSOR", "True") == "True"
+ETL_CURSOR_ITERSIZE: int = int(os.environ.get("ETL_CURSOR_ITERSIZE", 2000))
+ETL_WATERMARK_SAFETY_LAG_SEC: float = float(os.environ.get("ETL_WATERMARK_SAFETY_LAG_SEC", 5))
+ETL_TWO_PHASE_EXTRACT: bool = os.environ.get("ETL_TWO_PHASE_EXTRACT", "True") == "True"
+ETL_ENSURE_INDEXES: bool = os.environ.get("ETL_ENSURE_INDEXES", "True") == "True"
+# Документы персон строятся по пакетам фильмов: затронутые персоны дочитываются по
+# идентификаторам, а сущность person выбирает только изменения самих персон
+ETL_DERIVE_PERSONS: bool = os.environ.get("ETL_DERIVE_PERSONS", "False") == "True"
+# Сколько затронутых идентификаторов копить до загрузки производных документов
+ETL_DERIVE_FLUSH_SIZE: int = int(os.environ.get("ETL_DERIVE_FLUSH_SIZE", 10000))
+# Переименования персон и жанров в индексе фильмов: reindex - фильмы выбираются и
+# отправляются целиком, script - выборка фильмов следит только за самими фильмами и
+# связями, а новые имена переносятся в документы скриптом (renames.py) на каждом
+# запуске ETL фильмов со своего watermark. Фильмы в этом режиме выбираются в две фазы
+ETL_RENAMES: str = os.environ.get("ETL_RENAMES", "reindex")
+# pydantic - проверка и сериализация через модели pydantic,
+# fast - скомпилированные по моделям проверки и сразу готовые тела документов
+ETL_TRANSFORM_MODE: str = os.environ.get("ETL_TRANSFORM_MODE", "pydantic")
+# Число процессов для преобразования, 0 - в процессе ETL
+ETL_TRANSFORM_WORKERS: int = int(os.environ.get("ETL_TRANSFORM_WORKERS", 0))
+# serial - этапы и сущности обрабатываются по очереди,
+# staged - этапы работают одновременно, сущности обрабатываются параллельно
+ETL_PIPELINE_MODE: str = os.environ.get("ETL_PIPELINE_MODE", "serial")
+ETL_QUEUE_SIZE: int = int(os.environ.get("ETL_QUEUE_SIZE", 4))
+ETL_PIPELINE_STATS_INTERVAL_SEC: int = int(os.environ.get("ETL_PIPELINE_STATS_INTERVAL_SEC", 30))
+# poll - запуск по расписанию ETL_SCHEDULES,
+# notify - запуск по уведомлениям триггеров, расписание остается подстраховкой.
+# Изменение попадает в поиск не раньше чем через ETL_WATERMARK_SAFETY_LAG_SEC,
+# поэтому в этом режиме его стоит уменьшить до 1
+ETL_WAKEUP_MODE: str = os.environ.get("ETL_WAKEUP_MODE", "poll")
+ETL_INSTALL_TRIGGERS: bool = os.environ.get("ETL_INSTALL_TRIGGERS", "True") == "True"
+ETL_NOTIFY_DEBOUNCE_SEC: float = float(os.environ.get("ETL_NOTIFY_DEBOUNCE_SEC", 0.2))
+ETL_NOTIFY_MAX_DELAY_SEC: float = float(os.environ.get("ETL_NOTIFY_MAX_DELAY_SEC", 1))
+# Хранилище хешей загруженных документов: off, redis или file. Документы,
+# содержимое которых не изменилось с прошлой загрузки, повторно не отправляются
+ETL_FINGERPRINTS: str = os.environ.get("ETL_FINGERPRINTS", "redis")
+ETL_FINGERPRINTS_FILE: str = os.environ.get("ETL_FINGERPRINTS_FILE", "./fingerprints.db")
+# Хранилище строк, не прошедших проверку модели или отклоненных elasticsearch:
+# off, redis (поток на сущность) или file. Такие строки откладываются с причиной,
+# остальные строки пакета загружаются. Повтор после исправления - replay_dead_letters.py
+ETL_DEAD_LETTERS: str = os.environ.get("ETL_DEAD_LETTERS", "redis")
+ETL_DEAD_LETTERS_FILE: str = os.environ.get("ETL_DEAD_LETTERS_FILE", "./dead_letters.jsonl")
+ETL_DEAD_LETTERS_MAX_LEN: int = int(os.environ.get("ETL_DEAD_LETTERS_MAX_LEN", 100000))
+# Снимки для snapshot.py: документов в одном файле, уровень сжатия gzip и документов,
+# которые при загрузке снимка одновременно держатся в памяти и отправляются в ES
+ETL_SNAPSHOT_CHUNK_DOCS: int = int(os.environ.get("ETL_SNAPSHOT_CHUNK_DOCS", 20000))
+ETL_SNAPSHOT_COMPRESS_LEVEL: int = int(os.environ.get("ETL_SNAPSHOT_COMPRESS_LEVEL", 6))
+ETL_SNAPSHOT_LOAD_SLICE_DOCS: int = int(os.environ.get("ETL_SNAPSHOT_LOAD_SLICE_DOCS", 5000))
+# backfill.py: строк в одной части диапазона, число потоков загрузки частей (каждому
+# нужно свое соединение из ETL_PG_POOL_SIZE) и период вывода хода загрузки
+ETL_BACKFILL_CHUNK_SIZE: int = int(os.environ.get("ETL_BACKFILL_CHUNK_SIZE", 5000))
+ETL_BACKFILL_WORKERS: int = int(os.environ.get("ETL_BACKFILL_WORKERS", 4))
+ETL_BACKFILL_PROGRESS_SEC: float = float(os.environ.get("ETL_BACKFILL_PROGRESS_SEC", 5))
+# verify.py: шестнадцатеричных знаков идентификатора в корзинах первого уровня
+# (2 - 256 корзин), до скольких документов расходящаяся корзина сравнивается
+# по документам, а не делится дальше, и документов на странице чтения индекса
+ETL_VERIFY_BUCKET_DIGITS: int = int(os.environ.get("ETL_VERIFY_BUCKET_DIGITS", 2))
+ETL_VERIFY_LEAF_SIZE: int = int(os.environ.get("ETL_VERIFY_LEAF_SIZE", 1000))
+ETL_VERIFY_PAGE_SIZE: int = int(os.environ.get("ETL_VERIFY_PAGE_SIZE", 5000))
+# Повторы после временных ошибок: число попыток и время, после которых ошибка
+# пробрасывается выше. Пустое значение - без ограничения
+ETL_RETRY_MAX_ATTEMPTS: Optional[int] = (
+    int(os.environ.get("ETL_RETRY_MAX_ATTEMPTS", 10) or 0) or None
+)
+ETL_RETRY_DEADLINE_SEC: Optional[float] = (
+    float(os.environ.get("ETL_RETRY_DEADLINE_SEC", 300) or 0) or None
+)
+# off, http - эндпоинт Prometheus на ETL_METRICS_PORT,
+# textfile - файл для textfile-коллектора node_exporter, обновляется после каждого цикла
+ETL_METRICS_MODE: str = os.environ.get("ETL_METRICS_MODE", "http")
+ETL_METRICS_PORT: int = int(os.environ.get("ETL_METRICS_PORT", 9108))
+ETL_METRICS_TEXTFILE: str = os.environ.get("ETL_METRICS_TEXTFILE", "./etl.prom")
 
 POSTGRES_CONNECTION_SETTINGS = {
     "host": os.environ.get("DB_HOST"),
@@ -26,9 +107,81 @@ POSTGRES_CONNECTION_SETTINGS = {
     "dbname": os.environ.get("DB_NAME"),
     "user": os.environ.get("DB_USER"),
     "password": os.environ.get("DB_PASSWORD"),
+    # TCP keep-alive: обрыв простаивающего соединения обнаруживается без ожидания запроса
+    "keepalives": 1,
+    "keepalives_idle": int(os.environ.get("DB_KEEPALIVES_IDLE_SEC", 30)),
+    "keepalives_interval": 10,
+    "keepalives_count": 3,
 }
+# Соединения ETL с postgresql берутся из общего пула и живут между циклами.
+# Простоявшее дольше ETL_CONNECTION_CHECK_INTERVAL_SEC соединение перед выдачей проверяется
+# Конвейеру staged с ETL_DERIVE_PERSONS нужно два соединения: для извлечения и для
+# производных документов, которые выбираются из потока загрузки
+ETL_PG_POOL_SIZE: int = int(os.environ.get("ETL_PG_POOL_SIZE", 4))
+ETL_CONNECTION_CHECK_INTERVAL_SEC: float = float(
+    os.environ.get("ETL_CONNECTION_CHECK_INTERVAL_SEC", 30)
+)
 
 ELASTIC_SEARCH_URL = f'http://{os.environ.get("ELASTIC_HOST", "elasticsearch")}:{os.environ.get("ELASTIC_PORT", 9200)}'
 
+# bulk - один вызов helpers.bulk на пакет, streaming - потоковая отправка с повтором 429,
+# parallel - параллельная отправка частей пакета в ES_BULK_WORKERS потоков.
+# Загрузчик получает за раз один пакет ETL_BATCH_SIZE: части по ES_BULK_CHUNK_SIZE
+# документов и ES_BULK_MAX_CHUNK_BYTES байт имеют смысл, только если пакет больше части.
+ES_BULK_MODE: str = os.environ.get("ES_BULK_MODE", "streaming")
+ES_BULK_WORKERS: int = int(os.environ.get("ES_BULK_WORKERS", 4))
+ES_BULK_CHUNK_SIZE: int = int(os.environ.get("ES_BULK_CHUNK_SIZE", 500))
+ES_BULK_MAX_CHUNK_BYTES: int = int(os.environ.get("ES_BULK_MAX_CHUNK_BYTES", 5 * 1024 * 1024))
+ES_BULK_MAX_RETRIES: int = int(os.environ.get("ES_BULK_MAX_RETRIES", 3))
+# Число реплик, которое возвращается индексу после полной переиндексации,
+# если оно не задано в es_schema
+ES_INDEX_REPLICAS: int = int(os.environ.get("ES_INDEX_REPLICAS", 1))
+ES_FORCEMERGE_TIMEOUT_SEC: int = int(os.environ.get("ES_FORCEMERGE_TIMEOUT_SEC", 3600))
+ES_UPDATE_BY_QUERY_TIMEOUT_SEC: int = int(os.environ.get("ES_UPDATE_BY_QUERY_TIMEOUT_SEC", 300))
+# Схема индексов: default или search - с сортировкой индекса и нормализованными
+# подполями raw для фильтров (es_schema.search_optimized). Применяется через reindex.py
+ES_INDEX_MAPPING: str = os.environ.get("ES_INDEX_MAPPING", "default")
+# Сжатие тел запросов gzip и число keep-alive соединений с каждым узлом
+ES_HTTP_COMPRESS: bool = os.environ.get("ES_HTTP_COMPRESS", "True") == "True"
+ES_CONNECTIONS_PER_NODE: int = int(os.environ.get("ES_CONNECTIONS_PER_NODE", 10))
 
 ETL_REPEAT_INTERVAL_TIME_SEC: int = int(os.environ.get("ETL_REPEAT_INTERVAL_TIME_SEC", 60))
+
+# single - один процесс ETL, leases - несколько процессов делят сущности и их части
+# через аренды в Redis: аренда продлевается, пока процесс жив, и после истечения
+# ETL_LEASE_TTL_SEC ее забирает другой процесс
+ETL_WORKERS_MODE: str = os.environ.get("ETL_WORKERS_MODE", "single")
+ETL_WORKER_ID: str = os.environ.get("ETL_WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+ETL_LEASE_TTL_SEC: float = float(os.environ.get("ETL_LEASE_TTL_SEC", 30))
+# На сколько частей по идентификаторам делятся filmwork и person, у каждой части свой
+# watermark. Число частей сущности задается и отдельно: ETL_<СУЩНОСТЬ>_SHARDS
+ETL_SHARDS: int = int(os.environ.get("ETL_SHARDS", 1))
+# Версия документа в elasticsearch по version строки (external_gte): запись более
+# старых данных, опоздавшая после более новых, отклоняется. Включена при ETL_SHARDS > 1
+ES_EXTERNAL_VERSIONS: bool = os.environ.get("ES_EXTERNAL_VERSIONS", str(ETL_SHARDS > 1)) == "True"
+
+
+def _schedule(
+    entity: str, interval_sec: float, priority: int, budget_sec: float, shards: int = 1
+) -> dict:
+    """
+    Расписание сущности: ETL_<СУЩНОСТЬ>_INTERVAL_SEC, _PRIORITY и _BUDGET_SEC,
+    и число ее частей ETL_<СУЩНОСТЬ>_SHARDS.
+    """
+    prefix = f"ETL_{entity.upper()}_"
+    return {
+        "interval_sec": float(os.environ.get(f"{prefix}INTERVAL_SEC", interval_sec)),
+        "priority": int(os.environ.get(f"{prefix}PRIORITY", priority)),
+        "budget_sec": float(os.environ.get(f"{prefix}BUDGET_SEC", budget_sec) or 0) or None,
+        "shards": max(int(os.environ.get(f"{prefix}SHARDS", shards)), 1),
+    }
+
+
+# Интервал между запусками, приоритет (меньше - раньше) и бюджет времени на
+# один запуск, после которого выборка прерывается до следующего круга.
+# Пустой или нулевой бюджет - без ограничения
+ETL_SCHEDULES: dict[str, dict] = {
+    "filmwork": _schedule("filmwork", ETL_REPEAT_INTERVAL_TIME_SEC, 0, 30, ETL_SHARDS),
+    "person": _schedule("person", ETL_REPEAT_INTERVAL_TIME_SEC, 1, 30, ETL_SHARDS),
+    "genre": _schedule("genre", 3600, 2, 0),
+}
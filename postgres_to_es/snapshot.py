@@ -0,0 +1,292 @@
+"""
+Снимки индексов на диске: выгрузка документов из Postgres в файлы и загрузка
+файлов в elasticsearch без обращения к Postgres.
+
+dump выбирает сущности целиком тем же ETL, что и инкрементальная загрузка, и
+пишет готовые документы в формате bulk NDJSON в сжатые gzip файлы по
+ETL_SNAPSHOT_CHUNK_DOCS документов. В manifest.json для каждой сущности
+записываются файлы, число документов, параметры индекса и watermark, до
+которого дошла выгрузка.
+
+load загружает снимок в новую версию индекса так же, как reindex.py: без
+обновления поиска и реплик, с переключением псевдонима в конце. Файлы читаются
+через mmap и распаковываются потоково, по ETL_SNAPSHOT_LOAD_SLICE_DOCS документов,
+которые отправляются параллельно в ES_BULK_WORKERS потоков. С --set-watermark
+инкрементальный ETL, в том числе каждая из частей ETL_SHARDS, продолжает с позиции
+снимка и догружает изменения, сделанные после выгрузки.
+
+Запуск:
+    python snapshot.py dump DIR [filmwork person genre]
+    python snapshot.py load DIR [filmwork person genre] [--keep-old] [--set-watermark]
+"""
+import argparse
+import gzip
+import json
+import mmap
+import os
+from datetime import datetime
+from itertools import islice
+from typing import Iterator, Optional
+
+import orjson
+from data_transform import get_transformer
+from elasticsearch_loader import BulkLoadError, BulkResult, ElasticsearchLoader
+from etl import ETLHandler, run_etl
+from fingerprints import get_fingerprint_storage
+from loguru import logger
+from models import BulkDocument
+from postgres_extractor import PostgresExtractor
+from pydantic import BaseModel
+from settings import (
+    ETL_SNAPSHOT_CHUNK_DOCS,
+    ETL_SNAPSHOT_COMPRESS_LEVEL,
+    ETL_SNAPSHOT_LOAD_SLICE_DOCS,
+    REDIS_ADAPTER,
+)
+from state import BaseStorage, RedisStorage, State, Watermark
+
+MANIFEST = "manifest.json"
+
+
+class MemoryStorage(BaseStorage):
+    """
+    Состояние выгрузки. Прерванная выгрузка начинается заново: позиция в
+    выборке опережает последний закрытый файл, и продолжить с нее нельзя.
+    """
+
+    def __init__(self):
+        self.state: dict = {}
+
+    def save_state(self, state: dict) -> None:
+        self.state = dict(state)
+
+    def retrieve_state(self) -> dict:
+        return dict(self.state)
+
+
+class SnapshotWriter:
+    """
+    Загрузчик для run_etl, который вместо elasticsearch пишет документы в файлы
+    DIR/<сущность>/NNNNN.ndjson.gz: строка действия index с _id и строка тела.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        chunk_docs: int = ETL_SNAPSHOT_CHUNK_DOCS,
+        compress_level: int = ETL_SNAPSHOT_COMPRESS_LEVEL,
+    ):
+        self.directory = directory
+        self.chunk_docs = chunk_docs
+        self.compress_level = compress_level
+        self.files: list[dict] = []
+        self._file: Optional[gzip.GzipFile] = None
+        self._file_docs = 0
+
+    def create_connection(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        # Файлы предыдущего снимка сущности заменяются целиком
+        for name in os.listdir(self.directory):
+            if name.endswith(".ndjson.gz"):
+                os.remove(os.path.join(self.directory, name))
+
+    def load_data(
+        self,
+        index_name: str,
+        index_params: dict,
+        data: list[BaseModel | BulkDocument],
+        versions: Optional[dict[str, int]] = None,
+    ) -> BulkResult:
+        result = BulkResult()
+        for row in data:
+            source = row.source if isinstance(row, BulkDocument) else orjson.dumps(row.dict())
+            if self._file is None:
+                self._open()
+            self._file.write(orjson.dumps({"index": {"_id": str(row.id)}}) + b"\n")
+            self._file.write(source + b"\n")
+            self._file_docs += 1
+            result.indexed += 1
+            result.payload_bytes += len(source)
+            if self._file_docs >= self.chunk_docs:
+                self.close()
+        return result
+
+    def _open(self) -> None:
+        name = f"{len(self.files):05d}.ndjson.gz"
+        self._file = gzip.open(
+            os.path.join(self.directory, name), "wb", compresslevel=self.compress_level
+        )
+        self.files.append({"name": name, "documents": 0})
+        self._file_docs = 0
+
+    def close(self) -> None:
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        name = self.files[-1]["name"]
+        self.files[-1].update(
+            documents=self._file_docs,
+            bytes=os.path.getsize(os.path.join(self.directory, name)),
+        )
+
+
+def read_manifest(directory: str) -> dict:
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return {"entities": {}}
+    with open(path) as manifest_file:
+        return json.load(manifest_file)
+
+
+def write_manifest(directory: str, manifest: dict) -> None:
+    # Файл подменяется целиком, чтобы прерванная запись не испортила прежний манифест
+    path = os.path.join(directory, MANIFEST)
+    with open(f"{path}.tmp", "w") as manifest_file:
+        json.dump(manifest, manifest_file, ensure_ascii=False, indent=2, default=str)
+    os.replace(f"{path}.tmp", path)
+
+
+def dump(obj_type: str, directory: str, extractor: PostgresExtractor, transformer) -> dict:
+    etl = ETLHandler.get_etl(obj_type)
+    state = State(MemoryStorage())
+    writer = SnapshotWriter(os.path.join(directory, obj_type))
+    writer.create_connection()
+    try:
+        count = run_etl(obj_type, state, extractor, transformer, writer, etl=etl)
+    finally:
+        writer.close()
+
+    watermark = state.get_watermark(etl.watermark_state_key) or Watermark()
+    entry = {
+        "index": etl.elastic_index_name,
+        "index_params": etl.elastic_index_params,
+        "watermark": json.loads(watermark.json()),
+        "documents": count,
+        "files": writer.files,
+        "created": datetime.utcnow().isoformat(),
+    }
+    logger.info(f"Снимок {obj_type}: {count} документов в {len(writer.files)} файлах")
+    return entry
+
+
+def read_chunk(path: str, index_name: str) -> Iterator[dict]:
+    """
+    Действия bulk из файла снимка. Файл отображается в память, и страницы
+    сжатых данных читает система по мере распаковки, а не копирует read().
+    """
+    with open(path, "rb") as chunk_file, mmap.mmap(
+        chunk_file.fileno(), 0, access=mmap.ACCESS_READ
+    ) as mapped, gzip.GzipFile(fileobj=mapped) as lines:
+        for action in lines:
+            source = next(lines)
+            yield {
+                "_index": index_name,
+                "_id": orjson.loads(action)["index"]["_id"],
+                "_source": source.rstrip(b"\n"),
+            }
+
+
+def load(
+    obj_type: str,
+    directory: str,
+    entry: dict,
+    loader: ElasticsearchLoader,
+    state: State,
+    keep_old: bool = False,
+    set_watermark: bool = False,
+    slice_docs: int = ETL_SNAPSHOT_LOAD_SLICE_DOCS,
+) -> int:
+    alias = entry["index"]
+    # Документы снимка построены по схеме на момент выгрузки, с ней и создается индекс
+    index_name = loader.create_versioned_index(alias, entry["index_params"])
+    count = 0
+    try:
+        for chunk in entry["files"]:
+            path = os.path.join(directory, obj_type, chunk["name"])
+            documents = read_chunk(path, index_name)
+            while batch := list(islice(documents, slice_docs)):
+                result = loader.load_prepared(index_name, batch)
+                if result.errors:
+                    raise BulkLoadError(
+                        f"{len(result.errors)} документов из {path} не загружено в {index_name}"
+                    )
+                count += result.indexed
+            logger.info(f"Загружено {count} из {entry['documents']} документов {obj_type}")
+    except Exception:
+        loader.delete_indices([index_name])
+        raise
+
+    loader.finalize_index(index_name, entry["index_params"])
+    old_indices = loader.swap_alias(alias, index_name)
+    if not keep_old:
+        loader.delete_indices(old_indices)
+    if set_watermark:
+        etl = ETLHandler.get_etl(obj_type)
+        watermark = Watermark(**entry["watermark"])
+        # Watermark части важнее общего: частям записывается та же позиция снимка
+        for key in {etl.watermark_state_key} | {
+            etl.shard(number).watermark_state_key for number in range(etl.shards)
+        }:
+            state.set_watermark(key, watermark)
+    logger.info(f"Снимок {obj_type} загружен в {index_name}, документов {count}")
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Снимки индексов на диске")
+    commands = parser.add_subparsers(dest="command", required=True)
+    dump_parser = commands.add_parser("dump", help="выгрузить документы из Postgres в файлы")
+    load_parser = commands.add_parser("load", help="загрузить файлы снимка в elasticsearch")
+    for command_parser in (dump_parser, load_parser):
+        command_parser.add_argument("directory", help="каталог снимка")
+        command_parser.add_argument(
+            "obj_types",
+            nargs="*",
+            default=list(ETLHandler.PARAMS),
+            help=f"сущности: {', '.join(ETLHandler.PARAMS)}, по умолчанию все",
+        )
+    load_parser.add_argument(
+        "--keep-old", action="store_true", help="не удалять предыдущую версию индекса"
+    )
+    load_parser.add_argument(
+        "--set-watermark",
+        action="store_true",
+        help="продолжить инкрементальный ETL с позиции снимка",
+    )
+    args = parser.parse_args()
+    if unknown := set(args.obj_types) - set(ETLHandler.PARAMS):
+        parser.error(f"неизвестные сущности: {', '.join(sorted(unknown))}")
+
+    manifest = read_manifest(args.directory)
+
+    if args.command == "dump":
+        extractor = PostgresExtractor()
+        transformer = get_transformer()
+        try:
+            extractor.create_connection()
+            for obj_type in args.obj_types:
+                manifest["entities"][obj_type] = dump(
+                    obj_type, args.directory, extractor, transformer
+                )
+                write_manifest(args.directory, manifest)
+        finally:
+            extractor.close()
+            transformer.close()
+
+    else:
+        if missing := set(args.obj_types) - set(manifest["entities"]):
+            parser.error(f"в снимке нет сущностей: {', '.join(sorted(missing))}")
+        loader = ElasticsearchLoader(get_fingerprint_storage())
+        loader.create_connection()
+        state = State(RedisStorage(REDIS_ADAPTER))
+        for obj_type in args.obj_types:
+            load(
+                obj_type,
+                args.directory,
+                manifest["entities"][obj_type],
+                loader,
+                state,
+                args.keep_old,
+                args.set_watermark,
+            )
@@ -1,9 +1,24 @@
 import abc
 import json
+from datetime import datetime
+from threading import Lock
 from typing import Any, Optional
 
 import redis
 from decorators import backoff
+from pydantic import BaseModel
+
+INITIAL_ID = "00000000-0000-0000-0000-000000000000"
+
+
+class Watermark(BaseModel):
+    """
+    Позиция ETL в выборке, упорядоченной по (modified, id).
+    Следующая выборка начинается строго после этой пары.
+    """
+
+    modified: datetime = datetime.min
+    id: str = INITIAL_ID
 
 
 class BaseStorage(metaclass=abc.ABCMeta):
@@ -19,16 +34,26 @@ class BaseStorage(metaclass=abc.ABCMeta):
 class State:
     def __init__(self, storage: BaseStorage):
         self.storage = storage
+        self._lock = Lock()
 
     @backoff()
     def set_state(self, key: str, value: Any) -> None:
-        state = self.storage.retrieve_state()
-        state[key] = value
-        self.storage.save_state(state)
+        # ETL разных сущностей может сохранять состояние из параллельных потоков
+        with self._lock:
+            state = self.storage.retrieve_state()
+            state[key] = value
+            self.storage.save_state(state)
 
     def get_state(self, key: str) -> Any:
         return self.storage.retrieve_state().get(key)
 
+    def set_watermark(self, key: str, watermark: Watermark) -> None:
+        self.set_state(key, watermark.json())
+
+    def get_watermark(self, key: str) -> Optional[Watermark]:
+        value = self.get_state(key)
+        return Watermark.parse_raw(value) if value else None
+
 
 class JsonFileStorage(BaseStorage):
     def __init__(self, file_path: Optional[str] = "./state.json"):
@@ -0,0 +1,78 @@
+import orjson
+import psycopg2
+import pytest
+from elasticsearch_loader import BulkResult, ElasticsearchLoader
+from postgres_extractor import PostgresExtractor
+from requeue import RequeueQueue
+from settings import POSTGRES_CONNECTION_SETTINGS
+
+
+class MemoryLoader(ElasticsearchLoader):
+    """Индекс в памяти, который, как elasticsearch, отклоняет запись с меньшей внешней версией."""
+
+    def __init__(self, fingerprints=None):
+        super().__init__(fingerprints)
+        self.client = object()
+        self.documents: dict[str, dict] = {}
+        self.versions: dict[str, int] = {}
+
+    def _ensure_index(self, index_name: str, index_params: dict) -> None:
+        pass
+
+    def _bulk(self, index_name: str, documents: list[dict]) -> BulkResult:
+        result = BulkResult()
+        for document in documents:
+            id_, version = document["_id"], document.get("_version")
+            if version is not None and version < self.versions.get(id_, 0):
+                self._collect(result, False, {"index": {"_id": id_, "status": 409}})
+                continue
+            self.documents[id_] = orjson.loads(document["_source"])
+            if version is not None:
+                self.versions[id_] = version
+            self._collect(result, True, {"index": {"_id": id_, "status": 201}})
+        return result
+
+
+class MemoryRequeue(RequeueQueue):
+    def __init__(self):
+        super().__init__(redis_adapter=None)
+        self.ids: dict[str, set[str]] = {}
+
+    def add(self, entity: str, ids: list[str]) -> None:
+        self.ids.setdefault(entity, set()).update(ids)
+
+    def pop(self, entity: str, count: int) -> list[str]:
+        ids = self.ids.get(entity, set())
+        return [ids.pop() for _ in range(min(count, len(ids)))]
+
+    def size(self, entity: str) -> int:
+        return len(self.ids.get(entity, ()))
+
+
+@pytest.fixture
+def loader():
+    return MemoryLoader()
+
+
+@pytest.fixture
+def requeue():
+    return MemoryRequeue()
+
+
+@pytest.fixture
+def versioned(monkeypatch):
+    monkeypatch.setattr("elasticsearch_loader.ES_EXTERNAL_VERSIONS", True)
+
+
+@pytest.fixture
+def extractor():
+    """Извлечение из базы DB_*, тесты без нее пропускаются."""
+    try:
+        psycopg2.connect(**POSTGRES_CONNECTION_SETTINGS, connect_timeout=3).close()
+    except psycopg2.OperationalError as e:
+        pytest.skip(f"postgresql недоступен: {e}")
+    extractor = PostgresExtractor()
+    extractor.create_connection()
+    yield extractor
+    extractor.connection.rollback()
+    extractor.close()
@@ -0,0 +1,40 @@
+import pytest
+from decorators import backoff
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    monkeypatch.setattr("decorators.sleep", lambda seconds: None)
+
+
+def resume_after(arguments: dict, last) -> None:
+    if last is not None:
+        arguments["start"] = last + 1
+
+
+def test_stream_failing_after_every_item_gives_up():
+    calls = []
+
+    @backoff(max_attempts=3, deadline=None, resume=resume_after)
+    def numbers(start: int = 0):
+        calls.append(start)
+        yield start
+        raise ConnectionError("обрыв")
+
+    with pytest.raises(ConnectionError):
+        list(numbers())
+    assert calls == [0, 1, 2]
+
+
+def test_stream_resumes_after_last_item():
+    failed = set()
+
+    @backoff(max_attempts=3, deadline=None, resume=resume_after)
+    def numbers(start: int = 0):
+        for number in range(start, 5):
+            if number in (2, 4) and number not in failed:
+                failed.add(number)
+                raise ConnectionError("обрыв")
+            yield number
+
+    assert list(numbers()) == [0, 1, 2, 3, 4]
@@ -0,0 +1,19 @@
+from data_transform import DataTransform
+from etl import ETLHandler, run_etl
+from state import JsonFileStorage, State
+
+
+def test_batch_loop_stops_when_lease_is_lost(tmp_path, extractor, loader):
+    state_file = tmp_path / "state.json"
+    state_file.write_text("{}")
+    state = State(JsonFileStorage(str(state_file)))
+    etl = ETLHandler.get_etl("genre")
+
+    count = run_etl("genre", state, extractor, DataTransform(), loader, etl=etl, held=lambda: False)
+
+    # Пакет, загруженный после потери аренды, в watermark не попадает
+    assert count
+    assert state.get_watermark(etl.watermark_state_key) is None
+
+    assert run_etl("genre", state, extractor, DataTransform(), loader, etl=etl, held=lambda: True)
+    assert state.get_watermark(etl.watermark_state_key) is not None
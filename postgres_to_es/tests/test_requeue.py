@@ -0,0 +1,102 @@
+from datetime import datetime, timedelta, timezone
+
+from data_transform import DataTransform
+from elasticsearch_loader import external_versions
+from etl import ETLHandler, run_requeued
+from postgres_extractor import FILMWORKS_BY_IDS_QUERY, FILMWORKS_CHANGED_IDS_QUERY
+from state import Watermark
+from verify import Drift, Verifier
+
+MODIFIED = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+class GenreExtractor:
+    def __init__(self, rows: list[dict]):
+        self.rows = {row["id"]: row for row in rows}
+
+    def extract_by_ids(self, query: str, ids: list[str]) -> list[dict]:
+        return [self.rows[id_] for id_ in ids if id_ in self.rows]
+
+
+def genre(id_: str, name: str, version: datetime) -> dict:
+    return {"id": id_, "name": name, "description": None, "modified": MODIFIED, "version": version}
+
+
+def test_requeued_row_is_loaded(loader, requeue, versioned):
+    loader.documents["g1"] = {"id": "g1", "name": "Old", "description": None}
+    loader.versions.update(external_versions([genre("g1", "Old", MODIFIED)]))
+    requeue.add("genre", ["g1"])
+
+    loaded = run_requeued(
+        "genre", requeue, GenreExtractor([genre("g1", "Drama", MODIFIED)]), DataTransform(), loader
+    )
+
+    assert loaded == 1
+    assert loader.documents["g1"]["name"] == "Drama"
+    assert requeue.size("genre") == 0
+
+
+def test_requeued_row_rejected_as_stale_is_not_counted(loader, requeue, versioned):
+    newer = genre("g1", "Newer", MODIFIED + timedelta(seconds=1))
+    loader.documents["g1"] = {"id": "g1", "name": "Newer", "description": None}
+    loader.versions.update(external_versions([newer]))
+    requeue.add("genre", ["g1"])
+
+    loaded = run_requeued(
+        "genre", requeue, GenreExtractor([genre("g1", "Drama", MODIFIED)]), DataTransform(), loader
+    )
+
+    assert loaded == 0
+    assert loader.documents["g1"]["name"] == "Newer"
+    # Повтор с той же версией снова был бы отклонен
+    assert requeue.size("genre") == 0
+
+
+def test_repair_rewrites_film_written_by_two_phase_extraction(
+    extractor, loader, requeue, versioned
+):
+    """
+    Двухфазная выборка находит фильм по изменению связи, которое новее самого фильма,
+    его персон и жанров. Запись по идентификаторам при исправлении расхождения
+    должна получить ту же версию и не отклоняться как устаревшая.
+    """
+    with extractor.connection.cursor() as cursor:
+        cursor.execute(
+            """
+            UPDATE content.person_film_work
+            SET modified = now() - interval '1 minute'
+            WHERE film_work_id = (SELECT film_work_id FROM content.person_film_work LIMIT 1)
+            RETURNING film_work_id, modified
+            """
+        )
+        film = cursor.fetchone()
+    film_id = str(film["film_work_id"])
+    watermark = Watermark(modified=film["modified"] - timedelta(seconds=1))
+    rows = [
+        row
+        for batch in extractor.extract_changed_data(
+            FILMWORKS_CHANGED_IDS_QUERY, FILMWORKS_BY_IDS_QUERY, watermark
+        )
+        for row in batch
+    ]
+    etl = ETLHandler.get_etl("filmwork")
+    transformer = DataTransform()
+    loader.load_data(
+        etl.elastic_index_name,
+        etl.elastic_index_params,
+        transformer.transform(etl.transform_model, rows),
+        external_versions(rows),
+    )
+    (by_ids,) = extractor.extract_by_ids(FILMWORKS_BY_IDS_QUERY, [film_id])
+    # Версия по modified строки была бы старше записанной в индекс
+    previous_formula = external_versions([{**by_ids, "version": by_ids["modified"]}])
+    assert loader.versions[film_id] > previous_formula[film_id]
+
+    expected = {id_: dict(document) for id_, document in loader.documents.items()}
+    for document in loader.documents.values():
+        document["title"] = "drift"
+    Verifier("filmwork", extractor, loader).repair(Drift(changed=set(expected)), requeue)
+    loaded = run_requeued("filmwork", requeue, extractor, transformer, loader)
+
+    assert loaded == len(expected)
+    assert loader.documents == expected
@@ -0,0 +1,62 @@
+import json
+from datetime import datetime
+
+from elasticsearch_loader import BulkResult
+from etl import ETLHandler, get_watermark
+from models import BulkDocument
+from snapshot import SnapshotWriter, load
+from state import JsonFileStorage, State, Watermark
+
+
+class SnapshotLoader:
+    def __init__(self):
+        self.batches: list[list[dict]] = []
+
+    def create_versioned_index(self, alias: str, index_params: dict) -> str:
+        return f"{alias}_v2"
+
+    def load_prepared(self, index_name: str, documents: list[dict]) -> BulkResult:
+        self.batches.append(documents)
+        return BulkResult(indexed=len(documents))
+
+    def finalize_index(self, index_name: str, index_params: dict) -> None:
+        pass
+
+    def swap_alias(self, alias: str, index_name: str) -> list[str]:
+        return []
+
+    def delete_indices(self, index_names: list[str]) -> None:
+        pass
+
+
+def test_load_sends_bounded_slices_and_sets_shard_watermarks(tmp_path, monkeypatch):
+    writer = SnapshotWriter(str(tmp_path / "genre"), chunk_docs=7)
+    writer.create_connection()
+    documents = [BulkDocument(id=f"g{number}", source=b"{}") for number in range(10)]
+    writer.load_data("genres", {}, documents)
+    writer.close()
+
+    monkeypatch.setitem(ETLHandler.PARAMS, "genre", {**ETLHandler.PARAMS["genre"], "shards": 2})
+    etl = ETLHandler.get_etl("genre")
+    state_file = tmp_path / "state.json"
+    state_file.write_text("{}")
+    state = State(JsonFileStorage(str(state_file)))
+    # Watermark части от прежних запусков иначе скрыл бы позицию снимка
+    state.set_watermark(etl.shard(1).watermark_state_key, Watermark(modified=datetime(2020, 1, 1)))
+
+    snapshot_watermark = Watermark(modified=datetime(2024, 1, 1), id="g9")
+    entry = {
+        "index": "genres",
+        "index_params": {},
+        "watermark": json.loads(snapshot_watermark.json()),
+        "documents": len(documents),
+        "files": writer.files,
+    }
+    loader = SnapshotLoader()
+
+    count = load("genre", str(tmp_path), entry, loader, state, set_watermark=True, slice_docs=3)
+
+    assert count == 10
+    assert [len(batch) for batch in loader.batches] == [3, 3, 1, 3]
+    for number in range(etl.shards):
+        assert get_watermark(state, etl.shard(number)) == snapshot_watermark
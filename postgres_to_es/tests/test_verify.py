@@ -0,0 +1,32 @@
+import verify
+from postgres_extractor import PERSONS_BY_IDS_QUERY
+from verify import person_content
+
+
+def test_person_content_skips_null_roles():
+    source = {
+        "full_name": "Ann",
+        "films": [{"id": "f2", "roles": ["writer", None, "actor"]}, {"id": "f1", "roles": [None]}],
+    }
+
+    assert person_content(source) == "Ann\x1ff1:\x1ef2:actor,writer"
+
+
+def test_person_content_matches_postgres_with_null_roles(extractor):
+    with extractor.connection.cursor() as cursor:
+        cursor.execute(
+            """
+            UPDATE content.person_film_work SET role = NULL
+            WHERE id = (SELECT id FROM content.person_film_work LIMIT 1)
+            RETURNING person_id
+            """
+        )
+        person_id = str(cursor.fetchone()["person_id"])
+        cursor.execute(
+            "SELECT docs.content FROM ({}) docs".format(verify.PERSON_CONTENT_QUERY),
+            verify.id_range(person_id.replace("-", "")),
+        )
+        (row,) = cursor.fetchall()
+    (person,) = extractor.extract_by_ids(PERSONS_BY_IDS_QUERY, [person_id])
+
+    assert person_content(person) == row["content"]
@@ -0,0 +1,48 @@
+-- Уведомления об изменении контента для ETL_WAKEUP_MODE=notify.
+-- Скрипт идемпотентен, ETL выполняет его при старте, если ETL_INSTALL_TRIGGERS=True:
+--     psql -d <db> -f postgres_to_es/triggers.sql
+-- В аргументах триггера перечислены колонки с идентификаторами, которые попадают
+-- в уведомление, для удаленной строки - из ее последней версии. Одинаковые уведомления
+-- в одной транзакции Postgres отправляет один раз.
+BEGIN;
+
+CREATE OR REPLACE FUNCTION content.etl_notify_change() RETURNS trigger AS $$
+DECLARE
+    changed jsonb;
+    ids jsonb := '{}';
+    i int;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        changed := to_jsonb(OLD);
+    ELSE
+        changed := to_jsonb(NEW);
+    END IF;
+    FOR i IN 0 .. TG_NARGS - 1 LOOP
+        ids := ids || jsonb_build_object(TG_ARGV[i], changed -> TG_ARGV[i]);
+    END LOOP;
+    PERFORM pg_notify('etl_changes', jsonb_build_object('table', TG_TABLE_NAME, 'ids', ids)::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS etl_notify_change ON content.film_work;
+CREATE TRIGGER etl_notify_change AFTER INSERT OR UPDATE OR DELETE ON content.film_work
+    FOR EACH ROW EXECUTE FUNCTION content.etl_notify_change('id');
+
+DROP TRIGGER IF EXISTS etl_notify_change ON content.person;
+CREATE TRIGGER etl_notify_change AFTER INSERT OR UPDATE OR DELETE ON content.person
+    FOR EACH ROW EXECUTE FUNCTION content.etl_notify_change('id');
+
+DROP TRIGGER IF EXISTS etl_notify_change ON content.genre;
+CREATE TRIGGER etl_notify_change AFTER INSERT OR UPDATE OR DELETE ON content.genre
+    FOR EACH ROW EXECUTE FUNCTION content.etl_notify_change('id');
+
+DROP TRIGGER IF EXISTS etl_notify_change ON content.person_film_work;
+CREATE TRIGGER etl_notify_change AFTER INSERT OR UPDATE OR DELETE ON content.person_film_work
+    FOR EACH ROW EXECUTE FUNCTION content.etl_notify_change('film_work_id', 'person_id');
+
+DROP TRIGGER IF EXISTS etl_notify_change ON content.genre_film_work;
+CREATE TRIGGER etl_notify_change AFTER INSERT OR UPDATE OR DELETE ON content.genre_film_work
+    FOR EACH ROW EXECUTE FUNCTION content.etl_notify_change('film_work_id');
+
+COMMIT;
@@ -0,0 +1,390 @@
+"""
+Проверка согласованности индексов elasticsearch с content.* в Postgres без
+полной переиндексации.
+
+Документы сущности делятся на корзины по первым знакам идентификатора. У корзины
+считаются число документов и сумма 64-битных хешей их содержимого: в Postgres -
+агрегатом SQL по тем же данным, из которых ETL строит документы, в elasticsearch -
+по нужным полям _source, прочитанным через point in time. Сумма корзины равна
+сумме ее частей, поэтому совпавшая корзина дальше не проверяется, а расходящаяся
+делится на 16 частей по следующему знаку, пока в ней не останется не больше
+ETL_VERIFY_LEAF_SIZE документов, и тогда сравнивается по документам.
+
+Документы, которых нет в индексе или содержимое которых отличается, ставятся в
+очередь requeue, и ETL загрузит их заново на следующем запуске. Документы без
+строки в Postgres удаляются из индекса. С --dry-run расхождения только выводятся.
+
+Запуск: python verify.py [filmwork person genre] [--dry-run]
+"""
+import argparse
+from dataclasses import dataclass, field
+from hashlib import md5
+from time import monotonic
+from typing import Callable, Iterator, NamedTuple, Optional
+from uuid import UUID
+
+from elasticsearch_loader import ElasticsearchLoader
+from etl import ETLHandler
+from fingerprints import get_fingerprint_storage
+from loguru import logger
+from postgres_extractor import PostgresExtractor
+from requeue import RequeueQueue, get_requeue
+from settings import (
+    ETL_BATCH_SIZE,
+    ETL_VERIFY_BUCKET_DIGITS,
+    ETL_VERIFY_LEAF_SIZE,
+    ETL_VERIFY_PAGE_SIZE,
+)
+
+# Содержимое документа для хеша: поля через chr(31), элементы списков через chr(30)
+# в порядке байт. Запросы содержимого строят его из тех же таблиц, что и запросы ETL
+FILMWORK_CONTENT_QUERY = """
+        SELECT
+            fw.id,
+            concat_ws(
+                chr(31),
+                fw.title,
+                COALESCE(fw.description, ''),
+                COALESCE(fw.rating::text, ''),
+                COALESCE(
+                    string_agg(DISTINCT (p.id::text || ':' || p.full_name) COLLATE "C", chr(30)
+                        ORDER BY (p.id::text || ':' || p.full_name) COLLATE "C")
+                        FILTER (WHERE p.id is not null and pfw.role = 'actor'),
+                    ''
+                ),
+                COALESCE(
+                    string_agg(DISTINCT (p.id::text || ':' || p.full_name) COLLATE "C", chr(30)
+                        ORDER BY (p.id::text || ':' || p.full_name) COLLATE "C")
+                        FILTER (WHERE p.id is not null and pfw.role = 'writer'),
+                    ''
+                ),
+                COALESCE(
+                    string_agg(DISTINCT (p.id::text || ':' || p.full_name) COLLATE "C", chr(30)
+                        ORDER BY (p.id::text || ':' || p.full_name) COLLATE "C")
+                        FILTER (WHERE p.id is not null and pfw.role = 'director'),
+                    ''
+                ),
+                COALESCE(
+                    string_agg(DISTINCT (g.id::text || ':' || g.name) COLLATE "C", chr(30)
+                        ORDER BY (g.id::text || ':' || g.name) COLLATE "C")
+                        FILTER (WHERE g.id is not null),
+                    ''
+                ),
+                COALESCE(
+                    string_agg(DISTINCT p.full_name COLLATE "C", chr(30)
+                        ORDER BY p.full_name COLLATE "C") FILTER (WHERE pfw.role = 'actor'),
+                    ''
+                ),
+                COALESCE(
+                    string_agg(DISTINCT p.full_name COLLATE "C", chr(30)
+                        ORDER BY p.full_name COLLATE "C") FILTER (WHERE pfw.role = 'writer'),
+                    ''
+                ),
+                COALESCE(
+                    string_agg(DISTINCT p.full_name COLLATE "C", chr(30)
+                        ORDER BY p.full_name COLLATE "C") FILTER (WHERE pfw.role = 'director'),
+                    ''
+                )
+            ) as content
+        FROM content.film_work fw
+        LEFT JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
+        LEFT JOIN content.person p ON p.id = pfw.person_id
+        LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
+        LEFT JOIN content.genre g ON g.id = gfw.genre_id
+        WHERE fw.id BETWEEN %(id_from)s::uuid AND %(id_to)s::uuid
+        GROUP BY fw.id
+"""
+PERSON_CONTENT_QUERY = """
+        SELECT
+            p.id,
+            concat_ws(chr(31), p.full_name, COALESCE(person_films.films, '')) as content
+        FROM content.person p
+        LEFT JOIN LATERAL (
+            SELECT string_agg(roles.film, chr(30) ORDER BY roles.film COLLATE "C") as films
+            FROM (
+                SELECT
+                    pfw.film_work_id::text || ':' || COALESCE(
+                        string_agg(pfw.role, ',' ORDER BY pfw.role COLLATE "C"), ''
+                    ) as film
+                FROM content.person_film_work pfw
+                WHERE pfw.person_id = p.id
+                GROUP BY pfw.film_work_id
+            ) roles
+        ) person_films ON true
+        WHERE p.id BETWEEN %(id_from)s::uuid AND %(id_to)s::uuid
+"""
+GENRE_CONTENT_QUERY = """
+        SELECT g.id, concat_ws(chr(31), g.name, COALESCE(g.description, '')) as content
+        FROM content.genre g
+        WHERE g.id BETWEEN %(id_from)s::uuid AND %(id_to)s::uuid
+"""
+# Хеш содержимого - первые 8 байт md5 как знаковое 64-битное число, сумма - numeric
+_DIGEST = "('x' || left(md5(docs.content), 16))::bit(64)::bigint"
+BUCKETS_QUERY = f"""
+        SELECT
+            left(replace(docs.id::text, '-', ''), %(digits)s) as bucket,
+            COUNT(*) as documents,
+            SUM({_DIGEST}) as digest
+        FROM ({{content_query}}) docs
+        GROUP BY bucket
+"""
+DIGESTS_QUERY = f"""
+        SELECT docs.id::text as id, {_DIGEST} as digest
+        FROM ({{content_query}}) docs
+"""
+
+
+def _items(values) -> str:
+    return "\x1e".join(sorted(set(values)))
+
+
+def _number(value: Optional[float]) -> str:
+    """Число в записи Postgres: кратчайшая точная, у целых без дробной части."""
+    return "" if value is None else repr(float(value)).removesuffix(".0")
+
+
+def filmwork_content(source: dict) -> str:
+    return "\x1f".join(
+        [
+            source["title"],
+            source.get("description") or "",
+            _number(source.get("imdb_rating")),
+            *(
+                _items(f"{item['id']}:{item['name']}" for item in source.get(path) or [])
+                for path in ("actors", "writers", "directors", "genres")
+            ),
+            *(
+                _items(source.get(path) or [])
+                for path in ("actors_names", "writers_names", "directors_names")
+            ),
+        ]
+    )
+
+
+def person_content(source: dict) -> str:
+    # string_agg в Postgres пропускает роли NULL
+    films = (
+        f"{film['id']}:{','.join(sorted(role for role in film['roles'] if role is not None))}"
+        for film in source.get("films") or []
+    )
+    return "\x1f".join([source["full_name"], _items(films)])
+
+
+def genre_content(source: dict) -> str:
+    return "\x1f".join([source["name"], source.get("description") or ""])
+
+
+class Content(NamedTuple):
+    """Содержимое документов сущности: запрос Postgres, поля _source и сборка по ним."""
+
+    query: str
+    fields: list[str]
+    build: Callable[[dict], str]
+
+
+CONTENTS = {
+    "filmwork": Content(
+        FILMWORK_CONTENT_QUERY,
+        [
+            "title",
+            "description",
+            "imdb_rating",
+            "actors",
+            "writers",
+            "directors",
+            "genres",
+            "actors_names",
+            "writers_names",
+            "directors_names",
+        ],
+        filmwork_content,
+    ),
+    "person": Content(PERSON_CONTENT_QUERY, ["full_name", "films"], person_content),
+    "genre": Content(GENRE_CONTENT_QUERY, ["name", "description"], genre_content),
+}
+
+
+def digest(content: str) -> int:
+    return int.from_bytes(md5(content.encode()).digest()[:8], "big", signed=True)
+
+
+def id_range(prefix: str) -> dict:
+    """Границы идентификаторов, шестнадцатеричная запись которых начинается с prefix."""
+    return {
+        "id_from": str(UUID(prefix.ljust(32, "0"))),
+        "id_to": str(UUID(prefix.ljust(32, "f"))),
+    }
+
+
+@dataclass
+class Drift:
+    # Строки без документа, документы с другим содержимым и документы без строки
+    missing: set[str] = field(default_factory=set)
+    changed: set[str] = field(default_factory=set)
+    orphans: set[str] = field(default_factory=set)
+    # Сколько корзин сравнено по сумме и сколько документов поштучно
+    buckets: int = 0
+    documents: int = 0
+
+
+class Verifier:
+    def __init__(
+        self,
+        obj_type: str,
+        extractor: PostgresExtractor,
+        loader: ElasticsearchLoader,
+        bucket_digits: int = ETL_VERIFY_BUCKET_DIGITS,
+        leaf_size: int = ETL_VERIFY_LEAF_SIZE,
+        page_size: int = ETL_VERIFY_PAGE_SIZE,
+    ):
+        self.obj_type = obj_type
+        self.etl = ETLHandler.get_etl(obj_type)
+        self.content = CONTENTS[obj_type]
+        self.extractor = extractor
+        self.loader = loader
+        self.bucket_digits = bucket_digits
+        self.leaf_size = leaf_size
+        self.page_size = page_size
+
+    def verify(self) -> Drift:
+        drift = Drift()
+        started = monotonic()
+        prefixes, digits = [""], self.bucket_digits
+        while prefixes:
+            deeper = []
+            for prefix in prefixes:
+                postgres = self._postgres_buckets(prefix, digits)
+                elastic = self._elastic_buckets(prefix, digits)
+                drift.buckets += len(postgres.keys() | elastic.keys())
+                for bucket in sorted(postgres.keys() | elastic.keys()):
+                    expected, actual = postgres.get(bucket, (0, 0)), elastic.get(bucket, (0, 0))
+                    if expected == actual:
+                        continue
+                    if max(expected[0], actual[0]) <= self.leaf_size or digits == 32:
+                        self._compare_documents(bucket, drift)
+                    else:
+                        deeper.append(bucket)
+            if deeper:
+                logger.info(
+                    f"{self.obj_type}: расходятся {len(deeper)} корзин по {digits} знакам, "
+                    f"сравнение по {digits + 1}"
+                )
+            prefixes, digits = deeper, digits + 1
+        logger.info(
+            f"{self.obj_type}: сравнено корзин {drift.buckets}, документов {drift.documents} "
+            f"за {monotonic() - started:.1f} с. Нет в индексе {len(drift.missing)}, "
+            f"отличаются {len(drift.changed)}, без строки в Postgres {len(drift.orphans)}"
+        )
+        return drift
+
+    def repair(self, drift: Drift, requeue: RequeueQueue) -> None:
+        """Ставит в очередь недостающие и отличающиеся документы и удаляет лишние."""
+        index_name = self.etl.elastic_index_name
+        # Строка могла появиться после сравнения, и ее документ не лишний, а устаревший
+        orphans = sorted(drift.orphans)
+        existing = {
+            str(row["id"])
+            for start in range(0, len(orphans), ETL_BATCH_SIZE)
+            for row in self._extract_by_ids(orphans[start:][:ETL_BATCH_SIZE])
+        }
+        if requeued := sorted(drift.missing | drift.changed | existing):
+            # Сохраненные хеши не описывают содержимое индекса, и загрузчик пропустил бы
+            # эти документы как неизмененные
+            if self.loader.fingerprints:
+                self.loader.fingerprints.remove(index_name, requeued)
+            requeue.add(self.obj_type, requeued)
+            logger.info(
+                f"{len(requeued)} строк {self.obj_type} поставлено в очередь, "
+                f"в очереди {requeue.size(self.obj_type)}"
+            )
+        if deleted := [id_ for id_ in orphans if id_ not in existing]:
+            self.loader.delete_data(index_name, deleted)
+            logger.info(f"Из {index_name} удалено {len(deleted)} документов без строки в Postgres")
+
+    def _query(self, query: str, params: dict) -> list[dict]:
+        try:
+            with self.extractor.connection.cursor() as cursor:
+                cursor.execute(query.format(content_query=self.content.query), params)
+                return cursor.fetchall()
+        finally:
+            # Открытая транзакция удерживала бы SAFE_CUTOFF_QUERY работающего ETL
+            self.extractor.connection.rollback()
+
+    def _extract_by_ids(self, ids: list[str]) -> list[dict]:
+        try:
+            return self.extractor.extract_by_ids(self.etl.by_ids_query, ids)
+        finally:
+            self.extractor.connection.rollback()
+
+    def _postgres_buckets(self, prefix: str, digits: int) -> dict[str, tuple[int, int]]:
+        return {
+            row["bucket"]: (row["documents"], int(row["digest"]))
+            for row in self._query(BUCKETS_QUERY, {**id_range(prefix), "digits": digits})
+        }
+
+    def _elastic_documents(self, prefix: str) -> Iterator[tuple[str, int]]:
+        bounds = id_range(prefix)
+        query = {"range": {"id": {"gte": bounds["id_from"], "lte": bounds["id_to"]}}}
+        for page in self.loader.scan(
+            self.etl.elastic_index_name, query, self.content.fields, self.page_size
+        ):
+            for hit in page:
+                yield hit["_id"], digest(self.content.build(hit["_source"]))
+
+    def _elastic_buckets(self, prefix: str, digits: int) -> dict[str, tuple[int, int]]:
+        buckets: dict[str, tuple[int, int]] = {}
+        for id_, document_digest in self._elastic_documents(prefix):
+            bucket = id_.replace("-", "")[:digits]
+            documents, total = buckets.get(bucket, (0, 0))
+            buckets[bucket] = (documents + 1, total + document_digest)
+        return buckets
+
+    def _compare_documents(self, prefix: str, drift: Drift) -> None:
+        expected = {
+            row["id"]: row["digest"] for row in self._query(DIGESTS_QUERY, id_range(prefix))
+        }
+        actual = dict(self._elastic_documents(prefix))
+        drift.documents += len(expected.keys() | actual.keys())
+        drift.missing |= expected.keys() - actual.keys()
+        drift.orphans |= actual.keys() - expected.keys()
+        drift.changed |= {
+            id_ for id_ in expected.keys() & actual.keys() if expected[id_] != actual[id_]
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Проверка индексов по данным Postgres")
+    parser.add_argument(
+        "obj_types",
+        nargs="*",
+        default=list(ETLHandler.PARAMS),
+        help=f"сущности: {', '.join(ETLHandler.PARAMS)}, по умолчанию все",
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="только вывести расхождения, ничего не исправлять"
+    )
+    args = parser.parse_args()
+    if unknown := set(args.obj_types) - set(ETLHandler.PARAMS):
+        parser.error(f"неизвестные сущности: {', '.join(sorted(unknown))}")
+
+    extractor = PostgresExtractor()
+    loader = ElasticsearchLoader(get_fingerprint_storage())
+    requeue = get_requeue()
+    try:
+        extractor.create_connection()
+        loader.create_connection()
+        for obj_type in args.obj_types:
+            verifier = Verifier(obj_type, extractor, loader)
+            drift = verifier.verify()
+            if not args.dry_run:
+                verifier.repair(drift, requeue)
+                continue
+            for kind, ids in (
+                ("missing", drift.missing),
+                ("changed", drift.changed),
+                ("orphan", drift.orphans),
+            ):
+                for id_ in sorted(ids):
+                    print(f"{obj_type} {kind} {id_}")
+    finally:
+        extractor.close()